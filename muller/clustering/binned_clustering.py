@@ -0,0 +1,237 @@
+"""
+	Clusters datasets which are too large to calculate every pairwise distance. The trajectories are first split into bins
+	of trajectories with the same coarse signature (the timepoints each trajectory was first detected, first fixed and
+	peaked at). Each bin is clustered separately, then the mean trajectories of the clusters are clustered again so that
+	clusters which were split between bins can be merged. When there are more clusters than the maximum bin size, the
+	cluster means are sorted by their signature and clustered in windows of at most the maximum bin size, alternating
+	between two window offsets, until a round merges nothing or the remaining clusters fit in a single window (see
+	`BinnedCluster.merge_clusters`). No more than the maximum bin size of trajectories or cluster means are compared at
+	once, so the time depends on the sum of the squared bin and window sizes and the memory on the square of the maximum
+	bin size rather than the square of the number of trajectories.
+
+	This is an approximation of `HierarchalCluster.run`, and the genotypes are not always the same. Trajectories in
+	different bins are never merged before the second stage, and the distance between two cluster means is not the
+	distance the full linkage would use between the two clusters. The cluster means are weighted by the number of
+	trajectories in each cluster (see `hierarchy.weighted_linkage`) so the ward merge heights of the second stage are on
+	the same scale as the distance cutoff, but some genotypes may still be merged or split differently. Clusters whose
+	means are never in the same window are not merged.
+
+	The distance cutoff is the same quantile of the pairwise distances used by `HierarchalCluster.run`, estimated from the
+	distances between a random sample of trajectories.
+"""
+import math
+import time
+from typing import Dict, List, Optional
+
+import numpy
+import pandas
+from loguru import logger
+
+try:
+	from muller.clustering import hierarchy
+	from muller.clustering.metrics import DistanceCalculator
+	from muller.dataio import projectdata
+except ModuleNotFoundError:
+	from . import hierarchy
+	from .metrics import DistanceCalculator
+	from ..dataio import projectdata
+
+# Larger bins are split into groups of trajectories with a similar maximum frequency.
+DEFAULT_MAXIMUM_BIN_SIZE = 2000
+# The number of trajectories used to estimate the distance cutoff.
+DEFAULT_SAMPLE_SIZE = 2000
+
+
+def get_signatures(values: numpy.ndarray, dlimit: float, flimit: float) -> numpy.ndarray:
+	"""
+		Returns the position of the first detected timepoint, the first fixed timepoint and the maximum frequency of each
+		row of `values`. Trajectories which were never detected or never fixed are given a position of -1.
+	"""
+	detected = values > dlimit
+	fixed = values >= flimit
+	first_detected = numpy.where(detected.any(axis = 1), detected.argmax(axis = 1), -1)
+	first_fixed = numpy.where(fixed.any(axis = 1), fixed.argmax(axis = 1), -1)
+	peak = numpy.nan_to_num(values, nan = -math.inf).argmax(axis = 1)
+	return numpy.stack([first_detected, first_fixed, peak], axis = 1)
+
+
+def get_bins(values: numpy.ndarray, dlimit: float, flimit: float, maximum_bin_size: int = DEFAULT_MAXIMUM_BIN_SIZE) -> List[numpy.ndarray]:
+	""" Groups the rows of `values` by their signature (see `get_signatures`). Returns the positions of the rows in each bin."""
+	_, inverse = numpy.unique(get_signatures(values, dlimit, flimit), axis = 0, return_inverse = True)
+	inverse = inverse.reshape(-1)
+	order = numpy.argsort(inverse, kind = 'stable')
+	bins = numpy.split(order, numpy.flatnonzero(numpy.diff(inverse[order])) + 1)
+
+	maximum_frequency = numpy.nanmax(values, axis = 1) if len(values) else numpy.empty(0)
+	result = list()
+	for positions in bins:
+		if len(positions) <= maximum_bin_size:
+			result.append(positions)
+		else:
+			positions = positions[numpy.argsort(maximum_frequency[positions], kind = 'stable')]
+			result += [positions[start:start + maximum_bin_size] for start in range(0, len(positions), maximum_bin_size)]
+	return result
+
+
+def get_windows(total: int, window_size: int, offset: int = 0) -> List[numpy.ndarray]:
+	""" Splits the positions `0..total` into consecutive windows of at most `window_size` positions. The first window ends at `offset`, if given."""
+	boundaries = list(range(offset if offset else window_size, total, window_size))
+	return numpy.split(numpy.arange(total), boundaries)
+
+
+def merge_known_genotypes(clusters: List[List[str]], starting_genotypes: List[List[str]]) -> List[List[str]]:
+	""" Merges any clusters which contain trajectories from the same known genotype."""
+	membership = {label: index for index, cluster in enumerate(clusters) for label in cluster}
+	parents = list(range(len(clusters)))
+
+	def find(element: int) -> int:
+		while parents[element] != element:
+			parents[element] = parents[parents[element]]
+			element = parents[element]
+		return element
+
+	for genotype in starting_genotypes:
+		indices = [membership[label] for label in genotype if label in membership]
+		for index in indices[1:]:
+			parents[find(index)] = find(indices[0])
+
+	merged: Dict[int, List[str]] = dict()
+	for index, cluster in enumerate(clusters):
+		merged.setdefault(find(index), list()).extend(cluster)
+	return list(merged.values())
+
+
+class BinnedCluster:
+	"""
+		Clusters the trajectories in two stages. See the module docstring.
+	Parameters
+	----------
+	distance_calculator: DistanceCalculator
+		Calculates the pairwise distances within each bin.
+	clusterer: hierarchy.HierarchalCluster
+		Provides the linkage method, clustering method and quantile method.
+	maximum_bin_size: int
+		The maximum number of trajectories in each bin, and the maximum number of cluster means clustered at once when
+		merging the clusters from every bin.
+	sample_size: int
+		The number of trajectories used to estimate the distance cutoff.
+	seed: int
+		Selects the sampled trajectories.
+	"""
+
+	def __init__(self, distance_calculator: DistanceCalculator, clusterer: hierarchy.HierarchalCluster,
+			maximum_bin_size: int = DEFAULT_MAXIMUM_BIN_SIZE, sample_size: int = DEFAULT_SAMPLE_SIZE, seed: int = 0):
+		self.distance_calculator = distance_calculator
+		self.clusterer = clusterer
+		self.maximum_bin_size = maximum_bin_size
+		self.sample_size = sample_size
+		self.seed = seed
+
+	def estimate_distance_cutoff(self, trajectories: pandas.DataFrame, quantile: float) -> float:
+		""" Calculates the distance cutoff from the distances between a random sample of trajectories."""
+		if len(trajectories) > self.sample_size:
+			generator = numpy.random.default_rng(self.seed)
+			positions = numpy.sort(generator.choice(len(trajectories), self.sample_size, replace = False))
+			trajectories = trajectories.iloc[positions]
+		distances = self.distance_calculator.run_condensed(trajectories)
+		return self.clusterer.adjust_similarity_cutoff(quantile, distances.triangle(), self.clusterer.quantile_method)
+
+	def cluster_table(self, trajectories: pandas.DataFrame, distance_cutoff: float, weights: Optional[numpy.ndarray] = None) -> List[List[str]]:
+		""" Clusters every trajectory in `trajectories` at `distance_cutoff`. `weights` is the number of trajectories each row stands for."""
+		if len(trajectories) == 1:
+			return [list(trajectories.index)]
+		distances = self.distance_calculator.run_condensed(trajectories)
+		linkage_table = self.clusterer.link_clusters(distances.triangle(), len(distances.labels), weights = weights)
+		return self.clusterer.cluster(linkage_table[['left', 'right', 'distance', 'observations']], distance_cutoff, distances.labels)
+
+	def merge_windows(self, trajectories: pandas.DataFrame, clusters: List[List[str]], distance_cutoff: float,
+			offset: int = 0) -> List[List[str]]:
+		"""
+			Clusters the mean trajectory of each cluster, weighted by the size of the cluster. The cluster means are sorted by
+			their signature (see `get_signatures`) and clustered in windows of at most `maximum_bin_size` cluster means, so
+			only neighbouring clusters can be merged when there are more clusters than fit in a single window.
+		"""
+		representatives = pandas.DataFrame(
+			[trajectories.loc[cluster].mean() for cluster in clusters],
+			index = [f"cluster-{index}" for index in range(len(clusters))],
+			columns = trajectories.columns
+		)
+		members = dict(zip(representatives.index, clusters))
+		weights = numpy.array([len(cluster) for cluster in clusters])
+
+		values = representatives.values.astype(float)
+		signatures = get_signatures(values, self.distance_calculator.detection_limit, self.distance_calculator.fixed_limit)
+		maximum_frequency = numpy.nanmax(values, axis = 1)
+		# `numpy.lexsort` sorts by the last key first.
+		order = numpy.lexsort((maximum_frequency, signatures[:, 2], signatures[:, 1], signatures[:, 0]))
+
+		merged = list()
+		for window in get_windows(len(order), self.maximum_bin_size, offset):
+			positions = order[window]
+			merged += self.cluster_table(representatives.iloc[positions], distance_cutoff, weights = weights[positions])
+		return [[label for representative in group for label in members[representative]] for group in merged]
+
+	def merge_clusters(self, trajectories: pandas.DataFrame, clusters: List[List[str]], distance_cutoff: float) -> List[List[str]]:
+		"""
+			Merges the clusters which were split between bins. Clusters are merged in windows of at most `maximum_bin_size`
+			cluster means (see `merge_windows`) until a round merges nothing with either window offset, or the remaining
+			clusters fit in a single window, which is clustered once.
+		"""
+		offsets = [0, self.maximum_bin_size // 2]
+		rounds_without_merges = 0
+		while len(clusters) > self.maximum_bin_size and rounds_without_merges < len(offsets):
+			offset = offsets[rounds_without_merges]
+			logger.info(f"Merging {len(clusters)} clusters in windows of {self.maximum_bin_size}")
+			merged = self.merge_windows(trajectories, clusters, distance_cutoff, offset)
+			rounds_without_merges = rounds_without_merges + 1 if len(merged) == len(clusters) else 0
+			clusters = merged
+
+		if len(clusters) <= self.maximum_bin_size:
+			logger.info(f"Merging {len(clusters)} clusters")
+			clusters = self.merge_windows(trajectories, clusters, distance_cutoff)
+		return clusters
+
+	def run(self, trajectories: pandas.DataFrame, similarity_cutoff: Optional[float] = None,
+			starting_genotypes: Optional[List[List[str]]] = None) -> projectdata.DataHierarchalCluster:
+		"""
+		Parameters
+		----------
+		trajectories: pandas.DataFrame
+		similarity_cutoff: Optional[float]
+			The quantile of the pairwise distances to use as the distance cutoff. Defaults to 0.05, as in `HierarchalCluster.run`.
+		starting_genotypes: Optional[List[List[str]]]
+			Trajectories known to be in the same genotype. Any clusters containing the same known genotype are merged.
+		"""
+		quantile = 0.05 if similarity_cutoff is None else similarity_cutoff
+		timings = dict()
+		start = time.perf_counter()
+		distance_cutoff = self.estimate_distance_cutoff(trajectories, quantile)
+		timings['cutoff'] = time.perf_counter() - start
+
+		start = time.perf_counter()
+		bins = get_bins(trajectories.values.astype(float), self.distance_calculator.detection_limit,
+			self.distance_calculator.fixed_limit, self.maximum_bin_size)
+		total_pairs = sum(len(i) * (len(i) - 1) // 2 for i in bins)
+		logger.info(f"Clustering {len(trajectories)} trajectories in {len(bins)} bins ({total_pairs} pairs) with distance cutoff {distance_cutoff}")
+		clusters = list()
+		for positions in bins:
+			clusters += self.cluster_table(trajectories.iloc[positions], distance_cutoff)
+		timings['bins'] = time.perf_counter() - start
+
+		start = time.perf_counter()
+		clusters = self.merge_clusters(trajectories, clusters, distance_cutoff)
+		timings['representatives'] = time.perf_counter() - start
+
+		if starting_genotypes:
+			clusters = merge_known_genotypes(clusters, starting_genotypes)
+		# Use the same order as `HierarchalCluster`, which lists the clusters and members in the order of `trajectories`.
+		positions = {label: position for position, label in enumerate(trajectories.index)}
+		clusters = sorted((sorted(cluster, key = positions.get) for cluster in clusters), key = lambda s: positions[s[0]])
+
+		return projectdata.DataHierarchalCluster(
+			clusters = clusters,
+			table_linkage = None,
+			distance_cutoff = distance_cutoff,
+			distance_quantile = quantile,
+			timings = timings
+		)
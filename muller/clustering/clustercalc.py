@@ -5,20 +5,20 @@ from typing import Dict, List, Tuple, Union
 
 from loguru import logger
 
-from muller.clustering.metrics import DistanceCache
+from muller.clustering.metrics import CondensedDistanceCache, DistanceCache
 
 ClusterType = List[str]
 
 
 class ClusterSet:
 	""" Provides descriptive statistics for a set of clusters."""
-	def __init__(self, clusters: List[ClusterType], distances: Union[DistanceCache, Dict[Tuple[str, str], float]]):
-		if not isinstance(distances, DistanceCache):
+	def __init__(self, clusters: List[ClusterType], distances: Union[DistanceCache, CondensedDistanceCache, Dict[Tuple[str, str], float]]):
+		if isinstance(distances, dict):
 			self.distances = DistanceCache(distances)
 		else:
 			self.distances = distances
 
-		self.number_of_points = len(self.distances.squareform().index)
+		self.number_of_points = len(self.distances.labels)
 
 		self.clusters = clusters
 		self._genotypes = None  # Cache for the `self.genotypes` property.
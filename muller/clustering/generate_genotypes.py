@@ -1,18 +1,20 @@
 import re
+import time
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Sequence, Tuple
 
+import numpy
 import pandas
 from loguru import logger
 
 try:
-	from muller.clustering import metrics, genotype_reorder, hierarchy
+	from muller.clustering import binned_clustering, metrics, genotype_reorder, hierarchy, iterative_clustering, trajectory_duplicates
 	from muller import filters
 	from muller.dataio import projectdata
 except ModuleNotFoundError as exception:
 	logger.warning(str(exception))
 	from .. import filters
-	from . import metrics, hierarchy
+	from . import binned_clustering, metrics, hierarchy, iterative_clustering, trajectory_duplicates
 def is_trajectory_labeled_by_genotype(label):
 	regex = "trajectory-[a-z]+-[0-9]+"
 	match = re.search(regex, label)
@@ -49,31 +51,116 @@ class ClusterMutations:
 	starting_genotypes: List[List[str]]
 		A list of genotypes to start the clustering algorithm with. The distance metrics will be modified so that the trajectories specified are
 		grouped together.
+	engine: {'pairwise', 'vectorized'}
+		Selects how the pairwise distances are calculated. See `metrics.DistanceCalculator`.
+	filename_memmap: Optional[Path]
+		If given, the pairwise distances are written to a memory-mapped file at this location rather than held in memory.
+	filename_pairwise: Optional[Path]
+		Pairwise distances calculated in a previous run. Either the binary distance file (tables/.distance.bin) or the
+		square table of distances (tables/.distance.tsv). If trajectories were added or modified since the previous run,
+		only the distances involving those trajectories are calculated.
+	filename_distance_cache: Optional[Path]
+		An sqlite database used to share pairwise distances between runs. See `metrics.DistanceStore`.
+	distance_cache_size: Optional[int]
+		The maximum number of distances to keep in the distance cache.
+	prune_cutoff: Optional[float]
+		If given, the pairs which are provably further apart than this distance are not calculated, and the trajectories are
+		clustered with single linkage at this distance. See `metrics.DistanceCalculator.run_sparse`.
+	quantile_method: {'exact', 'approximate'}
+		How the distance cutoff is calculated from the similarity cutoff. 'approximate' estimates the quantile of the
+		pairwise distances in a single pass, which is faster for out-of-core distance matrices.
+	binned: bool
+		Clusters the trajectories in coarse bins, then merges the clusters from each bin, rather than calculating every
+		pairwise distance. Used for datasets which are too large for hierarchical clustering. See `binned_clustering`.
+	maximum_bin_size: Optional[int]
+		The maximum number of trajectories in each bin when `binned` is set.
+	collapse_tolerance: Optional[float]
+		If given, trajectories with the same frequencies after rounding to the nearest multiple of this value are replaced
+		by a single representative before the pairwise distances are calculated. 0 only collapses identical trajectories.
+		See `trajectory_duplicates`. Not used with `binned`.
+	method: {'hierarchy', 'matlab', 'twostep'}
+		'hierarchy' uses hierarchical clustering. 'matlab' and 'twostep' use the iterative methods from the original
+		matlab scripts (see `iterative_clustering`). Not used with `binned`.
+	difference_cutoff: float
+		The quantile of the pairwise distances used to unlink genotypes when `method` is 'twostep'.
 	"""
 
 	def __init__(self, metric: str, dlimit: float, flimit: float,
-			starting_genotypes: Optional[List[List[str]]] = None, threads: Optional[int] = None):
+			starting_genotypes: Optional[List[List[str]]] = None, threads: Optional[int] = None, engine: str = 'vectorized',
+			filename_memmap: Optional[Path] = None, filename_pairwise: Optional[Path] = None,
+			filename_distance_cache: Optional[Path] = None, distance_cache_size: Optional[int] = None, prune_cutoff: Optional[float] = None,
+			quantile_method: str = 'exact', binned: bool = False, maximum_bin_size: Optional[int] = None,
+			collapse_tolerance: Optional[float] = None, method: str = 'hierarchy', difference_cutoff: float = 0.10):
 		self.metric: str = metric
 		self.dlimit: float = dlimit
 		self.flimit: float = flimit
 		self.known_genotypes: List[List[str]] = starting_genotypes if starting_genotypes else []
-		self.filename_pairwise = None
+		self.filename_pairwise = filename_pairwise # Used to reuse the pairwise distances from a previous run.
+		self.prune_cutoff = prune_cutoff
+		self.collapse_tolerance = collapse_tolerance
 		self.pairwise_distances_full = None # overwritten in self.get_pairwise_distances.
 
-		#self.filename_pairwise = filename_pairwise # Could be used to reuse a table of pairwise distances.
 		# The `breakpoints` value is a bit arbitrary, so it should be safe to hard-code it.
 		# 	This will actually prevent the most common error when sorting genotypes (i.e. no breakpoints given) so it's worth
 		#	hard-coding it to prevent that issue.
 		self.breakpoints = [1.0, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2, 0.1, 0.0]
 
+		if filename_distance_cache:
+			if distance_cache_size:
+				distance_store = metrics.DistanceStore(filename_distance_cache, distance_cache_size)
+			else:
+				distance_store = metrics.DistanceStore(filename_distance_cache)
+		else:
+			distance_store = None
+
 		self.distance_calculator = metrics.DistanceCalculator(
 			detection_limit = self.dlimit,
 			fixed_limit = self.flimit,
 			metric = self.metric,
-			threads = threads
+			threads = threads,
+			engine = engine,
+			filename_memmap = filename_memmap,
+			distance_store = distance_store,
+			prune_cutoff = prune_cutoff
 		)
 
-		self.clusterer = hierarchy.HierarchalCluster()
+		# Only single linkage can be calculated exactly when some of the pairwise distances are skipped.
+		linkage_method = 'single' if prune_cutoff is not None else 'ward'
+		self.clusterer = hierarchy.HierarchalCluster(linkage_method, quantile_method = quantile_method)
+
+		if method in iterative_clustering.ACCEPTED_METHODS:
+			if prune_cutoff is not None:
+				message = f"The '{method}' clustering method requires every pairwise distance, so `prune_cutoff` cannot be used."
+				raise ValueError(message)
+			self.iterative_clusterer = iterative_clustering.IterativeCluster(
+				method,
+				fixed_limit = self.flimit,
+				difference_cutoff = difference_cutoff,
+				quantile_method = quantile_method
+			)
+		elif method == 'hierarchy':
+			self.iterative_clusterer = None
+		else:
+			message = f"'{method}' is not a supported clustering method. Expected 'hierarchy' or one of {iterative_clustering.ACCEPTED_METHODS}"
+			raise ValueError(message)
+
+		if binned:
+			# Each bin is small enough to keep in memory, and every pair within a bin is calculated.
+			bin_calculator = metrics.DistanceCalculator(
+				detection_limit = self.dlimit,
+				fixed_limit = self.flimit,
+				metric = self.metric,
+				threads = threads,
+				engine = engine,
+				distance_store = distance_store
+			)
+			self.binned_clusterer = binned_clustering.BinnedCluster(
+				bin_calculator,
+				hierarchy.HierarchalCluster(quantile_method = quantile_method),
+				maximum_bin_size = maximum_bin_size if maximum_bin_size else binned_clustering.DEFAULT_MAXIMUM_BIN_SIZE
+			)
+		else:
+			self.binned_clusterer = None
 
 		self.organizer = genotype_reorder.SortGenotypeTableWorkflow(
 			dlimit = dlimit,
@@ -106,23 +193,14 @@ class ClusterMutations:
 		return mean_genotype_timeseries
 
 	@staticmethod
-	def _load_pairwise_distances(filename: Path) -> Dict[Tuple[str, str], float]:
-		""" Reads pre-computed pairwise distances from a previous run. Typically found in the /tables/.distance.tsv table."""
-		table_distance_pairwise = pandas.read_csv(filename, sep = "\t")
-
-		pair_array = dict()
-		for index, row in table_distance_pairwise.iterrows():
-			values = {(index, i): row[i] for i in table_distance_pairwise.columns}
-			values_inverse = {k[::-1]: v for k, v in
-				values.items()}  # Faster to include reversed keys rather than trying to get (l,r) and (r,l) keys.
-
-			pair_array.update(values)
-			pair_array.update(values_inverse)
-
-		return pair_array
-
-
+	def _load_pairwise_distances(filename: Path) -> metrics.CondensedDistanceCache:
+		""" Reads pre-computed pairwise distances from a previous run. Typically found in the /tables/.distance.bin or /tables/.distance.tsv table."""
+		if metrics.is_binary_distance_file(filename):
+			return metrics.CondensedDistanceCache.read_binary(filename)
 
+		table_distance_pairwise = pandas.read_csv(filename, sep = "\t", index_col = 0)
+		table_distance_pairwise.index = table_distance_pairwise.index.astype(str)
+		return metrics.CondensedDistanceCache.from_squareform(table_distance_pairwise)
 
 	def calculate_mean_genotype(self, all_genotypes: List[List[str]], timeseries: pandas.DataFrame) -> pandas.DataFrame:
 		"""
@@ -175,12 +253,34 @@ class ClusterMutations:
 		return mean_genotypes, genotype_members
 
 	def get_pairwise_distances(self, trajectories: pandas.DataFrame):
+		# Use the same (sorted) label order as `DistanceCache.squareform()` so the genotypes are numbered consistently.
+		labels = sorted(trajectories.index)
 		if self.filename_pairwise:
-			pair_array = self._load_pairwise_distances(self.filename_pairwise)
+			logger.info(f"Reading the pairwise distances from '{self.filename_pairwise}'")
+			previous = self._load_pairwise_distances(self.filename_pairwise)
+			changed = previous.get_changed_labels(labels, metrics.hash_trajectories(trajectories.loc[labels].values))
+			is_compatible = not previous.parameters or previous.parameters == self.distance_calculator.parameters
+			if not changed:
+				if not is_compatible:
+					logger.warning(f"The pairwise distances were calculated with {previous.parameters} rather than {self.distance_calculator.parameters}")
+				pair_array = previous
+				if len(pair_array.labels) != len(trajectories.index):
+					pair_array = pair_array.reduce(trajectories.index)
+			elif is_compatible:
+				# Only calculate the distances for the new or modified trajectories.
+				pair_array = self.distance_calculator.run_condensed(trajectories.loc[labels], previous = previous)
+			else:
+				logger.warning(
+					f"The pairwise distances were calculated with {previous.parameters} rather than {self.distance_calculator.parameters} "
+					f"and are missing {len(changed)} trajectories. Recalculating all pairwise distances."
+				)
+				pair_array = self.distance_calculator.run_condensed(trajectories.loc[labels])
+		elif self.prune_cutoff is not None:
+			pair_array = self.distance_calculator.run_sparse(trajectories.loc[labels])
 		else:
-			pair_array = self.distance_calculator.run(trajectories)
+			pair_array = self.distance_calculator.run_condensed(trajectories.loc[labels])
 
-		self.pairwise_distances_full = metrics.DistanceCache(pair_array)  # Keep a record of the pairwise distances before filtering.
+		self.pairwise_distances_full = pair_array  # Keep a record of the pairwise distances before filtering.
 		return self.pairwise_distances_full
 
 	def run(self, trajectories: pandas.DataFrame, distance_cutoff:Optional[float] = None) -> projectdata.DataGenotypeInference:
@@ -201,15 +301,26 @@ class ClusterMutations:
 
 		modified_trajectories = trajectories.copy(deep = True)  # To avoid unintended changes
 
-		# Calculate the pairwise distances between each pair of mutational trajectories.
-		pairwise_distances = self.get_pairwise_distances(modified_trajectories)
-
-		# Calculate the genotypes
-		cluster_result = self.clusterer.run(
-			pairwise_distances,
-			starting_genotypes = self.known_genotypes,
-			similarity_cutoff = distance_cutoff
-		)
+		if self.binned_clusterer is not None:
+			# Only the distances within each bin are calculated, so the full distance matrix is not available.
+			pairwise_distances = None
+			labels = sorted(modified_trajectories.index)
+			cluster_result = self.binned_clusterer.run(
+				modified_trajectories.loc[labels],
+				similarity_cutoff = distance_cutoff,
+				starting_genotypes = self.known_genotypes
+			)
+		elif self.collapse_tolerance is not None:
+			cluster_result, pairwise_distances = self.run_collapsed(modified_trajectories, distance_cutoff)
+		else:
+			# Calculate the pairwise distances between each pair of mutational trajectories.
+			start = time.perf_counter()
+			pairwise_distances = self.get_pairwise_distances(modified_trajectories)
+			duration_distances = time.perf_counter() - start
+
+			# Calculate the genotypes
+			cluster_result = self.cluster(pairwise_distances, modified_trajectories, self.known_genotypes, distance_cutoff)
+			cluster_result.timings['distances'] = duration_distances
 		genotype_table, genotype_members = self.generate_genotype_table(modified_trajectories, cluster_result.clusters)
 
 		sorted_genotype_table = self.organizer.run(genotype_table)
@@ -224,3 +335,92 @@ class ClusterMutations:
 
 		return output_data
 
+	def cluster(self, pairwise_distances, trajectories: pandas.DataFrame, known_genotypes: List[List[str]],
+			similarity_cutoff: Optional[float] = None, weights: Optional[pandas.Series] = None) -> projectdata.DataHierarchalCluster:
+		""" Groups the trajectories in `pairwise_distances` with the selected clustering method."""
+		if self.iterative_clusterer is not None:
+			return self.iterative_clusterer.run(
+				pairwise_distances,
+				trajectories,
+				starting_genotypes = known_genotypes,
+				similarity_cutoff = similarity_cutoff,
+				weights = weights
+			)
+		return self.clusterer.run(
+			pairwise_distances,
+			starting_genotypes = known_genotypes,
+			similarity_cutoff = similarity_cutoff,
+			distance_cutoff = self.prune_cutoff,
+			weights = weights
+		)
+
+	def run_collapsed(self, trajectories: pandas.DataFrame, distance_cutoff: Optional[float] = None):
+		"""
+			Clusters the trajectories after replacing each group of duplicate trajectories with a single representative.
+			Returns the clusters of the original trajectories and the pairwise distances between the representatives.
+		"""
+		labels = sorted(trajectories.index)
+		start = time.perf_counter()
+		groups = trajectory_duplicates.get_duplicate_groups(trajectories.loc[labels], self.collapse_tolerance)
+		# Only collapse the groups whose members are 0 apart with the selected metric.
+		duplicated = [label for label, members in groups.items() if len(members) > 1]
+		if duplicated:
+			self_distances = self.distance_calculator.calculate_self_distances(trajectories.loc[duplicated])
+			inexact = [label for label, distance in zip(duplicated, self_distances) if not numpy.isclose(distance, 0)]
+			if inexact:
+				logger.info(f"Not collapsing {len(inexact)} groups of duplicate trajectories which are not 0 apart with the '{self.metric}' metric.")
+				groups = trajectory_duplicates.split_groups(groups, inexact)
+		representatives = trajectory_duplicates.collapse_trajectories(trajectories, groups)
+		duration_collapse = time.perf_counter() - start
+		logger.info(f"Collapsed {len(trajectories) - len(representatives)} duplicate trajectories into {len(representatives)} representatives.")
+
+		# The known genotypes now refer to the representative of each trajectory.
+		representative_of = {member: label for label, members in groups.items() for member in members}
+		known_genotypes = list()
+		for genotype in self.known_genotypes:
+			members = list(dict.fromkeys(representative_of.get(label, label) for label in genotype))
+			if len(members) > 1:
+				known_genotypes.append(members)
+
+		start = time.perf_counter()
+		pairwise_distances = self.get_pairwise_distances(representatives)
+		duration_distances = time.perf_counter() - start
+		cluster_result = self.cluster(
+			pairwise_distances, representatives, known_genotypes, distance_cutoff, trajectory_duplicates.get_weights(groups)
+		)
+		cluster_result.clusters = trajectory_duplicates.expand_clusters(cluster_result.clusters, groups, labels)
+		cluster_result.duplicates = {label: members for label, members in groups.items() if len(members) > 1}
+		cluster_result.timings['collapse'] = duration_collapse
+		cluster_result.timings['distances'] = duration_distances
+		return cluster_result, pairwise_distances
+
+	def sweep(self, result: projectdata.DataGenotypeInference, quantiles: Sequence[float],
+			selected: Sequence[float] = ()) -> projectdata.DataClusterSweep:
+		"""
+			Regroups the trajectories at each of several similarity cutoffs, reusing the pairwise distances and linkage from `run`.
+		Parameters
+		----------
+		result: projectdata.DataGenotypeInference
+			The output of `self.run`.
+		quantiles: Sequence[float]
+			The similarity cutoffs to test.
+		selected: Sequence[float]
+			A genotype table is generated for each of these similarity cutoffs. They are added to `quantiles` if needed.
+		"""
+		if result.clusterdata is not None and result.clusterdata.duplicates:
+			message = f"The similarity cutoff cannot be swept when duplicate trajectories were collapsed."
+			raise ValueError(message)
+		if self.iterative_clusterer is not None:
+			message = f"The similarity cutoff can only be swept with hierarchical clustering."
+			raise ValueError(message)
+		quantiles = list(quantiles) + [i for i in selected if i not in quantiles]
+		linkage_table = result.clusterdata.table_linkage if result.clusterdata is not None else None
+		# The known genotypes were already merged into the pairwise distances by `run`.
+		data = self.clusterer.sweep(result.matrix_distance, quantiles, linkage_table = linkage_table)
+		for quantile in selected:
+			table_genotypes, genotype_members = self.generate_genotype_table(result.table_trajectories, data.clusters[quantile])
+			table_genotypes = self.organizer.run(table_genotypes)
+			table_genotypes['members'] = ['|'.join(genotype_members[i]) for i in table_genotypes.index]
+			data.table_genotypes[quantile] = table_genotypes
+		return data
+
@@ -1,17 +1,22 @@
 import itertools
+import math
+import time
 from typing import *
 
 import numpy
 import pandas
 from loguru import logger
 from scipy.cluster import hierarchy
-from scipy.spatial import distance
 
 try:
-	from muller.clustering.metrics.distance_cache import DistanceCache
+	from muller.clustering.metrics import distance_memmap, distance_quantile
+	from muller.clustering.metrics.distance_kernels import get_condensed_index
+	from muller.clustering.metrics.distance_cache import CondensedDistanceCache, DistanceCache, SparseDistanceCache
 	from muller.dataio import projectdata
 except ModuleNotFoundError:
-	from muller.clustering.metrics.distance_cache import DistanceCache
+	from muller.clustering.metrics import distance_memmap, distance_quantile
+	from muller.clustering.metrics.distance_kernels import get_condensed_index
+	from muller.clustering.metrics.distance_cache import CondensedDistanceCache, DistanceCache, SparseDistanceCache
 	from muller.dataio import projectdata
 
 
@@ -28,10 +33,286 @@ def format_linkage_matrix(linkage_table, total_members: Optional[int]) -> pandas
 	return linkage_dataframe
 
 
+def single_linkage_sparse(pair_array: SparseDistanceCache) -> numpy.ndarray:
+	"""
+		Calculates the single linkage matrix from the known distances in `pair_array`. Single linkage only depends on the
+		minimum spanning tree, so this is exact as long as every pair which is not known is further apart than every pair
+		which is. Groups which are not connected by any known distance are merged at `pair_array.far`.
+		Returns the same linkage matrix as `hierarchy.linkage(pair_array.triangle(), method = 'single')`, apart from the order of ties.
+	"""
+	from scipy.sparse import csgraph
+	total = len(pair_array.labels)
+	graph = pair_array.to_csgraph()
+	# `minimum_spanning_tree` ignores edges with a weight of 0, so shift every weight up and look up the original weights afterwards.
+	graph.data = graph.data - graph.data.min() + 1 if graph.nnz else graph.data
+	tree = csgraph.minimum_spanning_tree(graph).tocoo()
+	lefts = numpy.minimum(tree.row, tree.col)
+	rights = numpy.maximum(tree.row, tree.col)
+	weights = numpy.array([pair_array.get(pair_array.labels[i], pair_array.labels[j]) for i, j in zip(lefts, rights)], dtype = float)
+	order = numpy.argsort(weights, kind = 'stable')
+	edges = [(lefts[i], rights[i], weights[i]) for i in order]
+
+	# Any components left over are joined at the distance assigned to the skipped pairs.
+	_, components = csgraph.connected_components(graph, directed = False)
+	representatives = sorted({component: position for position, component in reversed(list(enumerate(components)))}.values())
+	edges += [(representatives[0], other, pair_array.far) for other in representatives[1:]]
+
+	# Merge the clusters with a union-find structure, using the cluster numbering from `scipy.cluster.hierarchy.linkage`.
+	parents = list(range(total))
+	cluster_ids = list(range(total))
+	sizes = [1] * total
+
+	def find(element: int) -> int:
+		while parents[element] != element:
+			parents[element] = parents[parents[element]]
+			element = parents[element]
+		return element
+
+	linkage_table = list()
+	for left, right, weight in edges:
+		left_root = find(left)
+		right_root = find(right)
+		left_id, right_id = sorted([cluster_ids[left_root], cluster_ids[right_root]])
+		size = sizes[left_root] + sizes[right_root]
+		parents[right_root] = left_root
+		sizes[left_root] = size
+		cluster_ids[left_root] = total + len(linkage_table)
+		linkage_table.append([left_id, right_id, weight, size])
+	return numpy.array(linkage_table, dtype = float).reshape(-1, 4)
+
+
+# The linkage methods which depend on the number of trajectories in each cluster. See `weighted_linkage`.
+WEIGHTED_LINKAGE_METHODS = ['ward', 'average']
+
+
+def weighted_linkage(distances: numpy.ndarray, weights: numpy.ndarray, method: str = 'ward') -> numpy.ndarray:
+	"""
+		Calculates the linkage matrix of a set of points where each point stands for `weights` identical trajectories. This
+		is the same linkage as `hierarchy.linkage` on the table where each point is repeated, after the repeated points are
+		merged at a distance of 0. The points are merged with the nearest-neighbor chain algorithm used by
+		`hierarchy.linkage`, and the Lance-Williams updates use the number of trajectories in each cluster rather than the
+		number of points. The last column of the result is the number of points in each cluster.
+	Parameters
+	----------
+	distances: numpy.ndarray
+		The condensed distance vector between the points.
+	weights: numpy.ndarray
+		The number of trajectories each point stands for.
+	method: {'ward', 'average', 'single', 'complete'}
+		Single and complete linkage do not depend on the weights, so they use `hierarchy.linkage` directly.
+	"""
+	if method not in WEIGHTED_LINKAGE_METHODS:
+		if method not in ('single', 'complete'):
+			logger.warning(f"'{method}' linkage cannot use the number of trajectories each point stands for.")
+		return hierarchy.linkage(distances, method = method)
+	from scipy.spatial import distance as scipy_distance
+
+	weights = numpy.array(weights, dtype = float)
+	total = len(weights)
+	square = scipy_distance.squareform(numpy.asarray(distances, dtype = float))
+	if method == 'ward':
+		# The ward distance between two groups of identical trajectories grows with the size of each group.
+		square = square * numpy.sqrt(2 * numpy.outer(weights, weights) / numpy.add.outer(weights, weights))
+	numpy.fill_diagonal(square, numpy.inf)
+	sizes = numpy.ones(total)
+	is_active = numpy.ones(total, dtype = bool)
+
+	merges = list()
+	chain = list()
+	for _ in range(total - 1):
+		if not chain:
+			chain.append(int(numpy.argmax(is_active)))
+		while True:
+			x = chain[-1]
+			y = int(numpy.argmin(square[x]))
+			# Keep the previous point in the chain when it is tied with the nearest point, as `hierarchy.linkage` does.
+			if len(chain) > 1 and square[x, chain[-2]] <= square[x, y]:
+				y = chain[-2]
+			if len(chain) > 1 and y == chain[-2]:
+				break
+			chain.append(y)
+		chain = chain[:-2]
+		x, y = min(x, y), max(x, y)
+		distance = square[x, y]
+		merges.append((x, y, distance, sizes[x] + sizes[y]))
+
+		# Merge `x` into `y` with the Lance-Williams update.
+		wx, wy = weights[x], weights[y]
+		if method == 'ward':
+			updated = numpy.sqrt(
+				((wx + weights) * square[x] ** 2 + (wy + weights) * square[y] ** 2 - weights * distance ** 2) / (wx + wy + weights)
+			)
+		else:
+			updated = (wx * square[x] + wy * square[y]) / (wx + wy)
+		updated[[x, y]] = numpy.inf
+		square[y] = updated
+		square[:, y] = updated
+		square[x] = numpy.inf
+		square[:, x] = numpy.inf
+		is_active[x] = False
+		weights[y] = wx + wy
+		sizes[y] += sizes[x]
+
+	# Sort the merges by distance and number the clusters in the same way as `hierarchy.linkage`.
+	order = numpy.argsort([merge[2] for merge in merges], kind = 'stable')
+	parents = list(range(2 * total - 1))
+
+	def find(element: int) -> int:
+		while parents[element] != element:
+			parents[element] = parents[parents[element]]
+			element = parents[element]
+		return element
+
+	linkage_table = list()
+	for index in order:
+		x, y, distance, size = merges[index]
+		left, right = sorted([find(x), find(y)])
+		node = total + len(linkage_table)
+		parents[left] = parents[right] = node
+		linkage_table.append([left, right, distance, size])
+	return numpy.array(linkage_table, dtype = float).reshape(-1, 4)
+
+
+ACCEPTED_LEAF_ORDERINGS = ['optimal', 'approximate', 'none']
+
+
+def order_leaves_approximate(linkage_table: numpy.ndarray, distances: Union[numpy.ndarray, SparseDistanceCache]) -> numpy.ndarray:
+	"""
+		A greedy alternative to `scipy.cluster.hierarchy.optimal_leaf_ordering`. Each merge is oriented so that the two leaves
+		placed next to each other are as close as possible, given the orientation of each branch below it. Only one distance
+		is read for each of the four orientations of each merge, so this scales to trees which are too large to order optimally.
+		Returns a copy of `linkage_table` with the left and right branches of some merges swapped.
+		`distances` is either the condensed distance vector or a `SparseDistanceCache`, where only the known pairs are read.
+	"""
+	linkage_table = numpy.array(linkage_table, dtype = float)
+	total = len(linkage_table) + 1
+	# The first and last leaf of each branch (leaves first, then merges) before any branch is reversed.
+	first = list(range(total)) + [0] * len(linkage_table)
+	last = list(range(total)) + [0] * len(linkage_table)
+	# Whether the left and right branch of each merge should be reversed.
+	orientations = list()
+
+	def distance(a: int, b: int) -> float:
+		if a == b:
+			return 0.0
+		if isinstance(distances, SparseDistanceCache):
+			return distances.get_by_position(a, b)
+		return float(distances[get_condensed_index(total, min(a, b), max(a, b))])
+
+	for index, (left, right, _, _) in enumerate(linkage_table):
+		left, right = int(left), int(right)
+		options = [
+			(distance(last[left], first[right]), False, False),
+			(distance(last[left], last[right]), False, True),
+			(distance(first[left], first[right]), True, False),
+			(distance(first[left], last[right]), True, True)
+		]
+		_, reverse_left, reverse_right = min(options, key = lambda s: s[0])
+		orientations.append((reverse_left, reverse_right))
+		node = total + index
+		first[node] = last[left] if reverse_left else first[left]
+		last[node] = first[right] if reverse_right else last[right]
+
+	# Walk down from the root. A reversed merge lists its right branch first, and each branch below it is also reversed.
+	reversed_nodes = numpy.zeros(2 * total - 1, dtype = bool)
+	for index in range(len(linkage_table) - 1, -1, -1):
+		is_reversed = reversed_nodes[total + index]
+		left, right = int(linkage_table[index, 0]), int(linkage_table[index, 1])
+		reverse_left, reverse_right = orientations[index]
+		reversed_nodes[left] = reverse_left != is_reversed
+		reversed_nodes[right] = reverse_right != is_reversed
+		if is_reversed:
+			linkage_table[index, [0, 1]] = linkage_table[index, [1, 0]]
+	return linkage_table
+
+
+def get_ordered_linkage(clusterdata: projectdata.DataHierarchalCluster, distances: Union[numpy.ndarray, SparseDistanceCache],
+		method: str = 'optimal') -> pandas.DataFrame:
+	"""
+		Reorders the leaves of `clusterdata.table_linkage` so that similar trajectories are next to each other in the
+		dendrogram. The clusters do not depend on the order of the leaves, so this is only done when a figure needs it.
+		The result is saved to `clusterdata`, so each ordering is only calculated once.
+	Parameters
+	----------
+	clusterdata: projectdata.DataHierarchalCluster
+	distances: Union[numpy.ndarray, SparseDistanceCache]
+		The condensed distance vector the linkage was calculated from. A `SparseDistanceCache` can only be used with the
+		'approximate' and 'none' orderings.
+	method: {'optimal', 'approximate', 'none'}
+		'optimal' uses `scipy.cluster.hierarchy.optimal_leaf_ordering`, which is much slower than the linkage itself
+		for thousands of trajectories. 'approximate' uses `order_leaves_approximate`.
+	"""
+	if method in clusterdata.tables_linkage_ordered:
+		return clusterdata.tables_linkage_ordered[method]
+	if method == 'optimal' and isinstance(distances, SparseDistanceCache):
+		message = f"The optimal leaf ordering requires every pairwise distance. Use the 'approximate' ordering instead."
+		raise ValueError(message)
+	table_linkage = clusterdata.table_linkage
+	linkage_table = table_linkage[['left', 'right', 'distance', 'observations']].values
+	start = time.perf_counter()
+	if method == 'optimal':
+		linkage_table = hierarchy.optimal_leaf_ordering(linkage_table, numpy.asarray(distances, dtype = float))
+	elif method == 'approximate':
+		linkage_table = order_leaves_approximate(linkage_table, distances)
+	elif method != 'none':
+		message = f"'{method}' is not a valid leaf ordering. Expected one of {ACCEPTED_LEAF_ORDERINGS}"
+		raise ValueError(message)
+	clusterdata.timings[f'leafOrdering.{method}'] = time.perf_counter() - start
+	logger.debug(f"Ordered the leaves of the linkage ({method}) in {clusterdata.timings[f'leafOrdering.{method}']:.2f} seconds")
+
+	table_ordered = format_linkage_matrix(linkage_table, len(linkage_table) + 1)
+	clusterdata.tables_linkage_ordered[method] = table_ordered
+	return table_ordered
+
+
+def get_cluster_separation(linkage_table: numpy.ndarray, distances: numpy.ndarray, cutoffs: Sequence[float],
+		chunk_size: int = distance_memmap.DEFAULT_CHUNK_SIZE) -> pandas.DataFrame:
+	"""
+		Calculates the mean distance between the trajectories in the same cluster and in different clusters when the linkage
+		is cut at each of `cutoffs` with the 'distance' criterion, without having to compare the clusters at each cutoff.
+		Two trajectories are in the same cluster whenever their cophenetic distance (the height they are joined at) is no
+		greater than the cutoff, so each pair only has to be assigned to the first cutoff it falls under.
+		The separation is `1 - mean within / mean between`. Larger values indicate tighter, better separated clusters.
+	Parameters
+	----------
+	linkage_table: numpy.ndarray
+		A monotonic linkage matrix, as generated by `scipy.cluster.hierarchy.linkage`.
+	distances: numpy.ndarray
+		The condensed distance vector the linkage was calculated from. May be a `numpy.memmap`.
+	cutoffs: Sequence[float]
+	chunk_size: int
+	"""
+	cutoffs = numpy.asarray(cutoffs, dtype = float)
+	order = numpy.argsort(cutoffs, kind = 'stable')
+	sorted_cutoffs = cutoffs[order]
+	cophenetic = hierarchy.cophenet(linkage_table)
+	# The sum and number of distances which first fall under each cutoff. The last bin holds the pairs above every cutoff.
+	sums = numpy.zeros(len(cutoffs) + 1)
+	counts = numpy.zeros(len(cutoffs) + 1, dtype = numpy.int64)
+	for chunk in distance_memmap.iterate_chunks(len(cophenetic), chunk_size):
+		bins = numpy.searchsorted(sorted_cutoffs, cophenetic[chunk], side = 'left')
+		sums += numpy.bincount(bins, weights = distances[chunk], minlength = len(sums))
+		counts += numpy.bincount(bins, minlength = len(counts))
+
+	within_sums = numpy.empty(len(cutoffs))
+	within_counts = numpy.empty(len(cutoffs))
+	within_sums[order] = numpy.cumsum(sums[:-1])
+	within_counts[order] = numpy.cumsum(counts[:-1])
+	between_sums = sums.sum() - within_sums
+	between_counts = counts.sum() - within_counts
+	with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+		mean_within = numpy.where(within_counts > 0, within_sums / within_counts, math.nan)
+		mean_between = numpy.where(between_counts > 0, between_sums / between_counts, math.nan)
+		separation = 1 - mean_within / mean_between
+	return pandas.DataFrame({'meanWithin': mean_within, 'meanBetween': mean_between, 'separation': separation})
+
+
 class HierarchalCluster:
-	def __init__(self, linkage: str = 'ward', cluster: str = 'distance'):
+	def __init__(self, linkage: str = 'ward', cluster: str = 'distance', quantile_method: str = 'exact'):
 		self.linkage_method = linkage
 		self.cluster_method = cluster
+		# Whether the distance cutoff is the exact quantile of the distances or is estimated with a t-digest.
+		self.quantile_method = quantile_method
 
 	@staticmethod
 	def _add_starting_genotypes(pair_array, starting_genotypes) -> Dict[str, str]:
@@ -77,8 +358,12 @@ class HierarchalCluster:
 		return list(cluster_map.values())
 
 
-	def link_clusters(self, distances: numpy.ndarray, num: int) -> pandas.DataFrame:
-		Z = hierarchy.linkage(distances, method = self.linkage_method, optimal_ordering = True)
+	def link_clusters(self, distances: numpy.ndarray, num: int, weights: Optional[numpy.ndarray] = None) -> pandas.DataFrame:
+		# The order of the leaves does not affect the clusters. See `get_ordered_linkage`.
+		if weights is not None:
+			Z = weighted_linkage(distances, weights, method = self.linkage_method)
+		else:
+			Z = hierarchy.linkage(distances, method = self.linkage_method)
 
 		return format_linkage_matrix(Z, num)
 
@@ -101,49 +386,153 @@ class HierarchalCluster:
 
 		return clusters
 	@staticmethod
-	def adjust_similarity_cutoff(quantile:float, distances: List[float])->float:
-		""" Adjusts the `similarity_cutoff` value to work with the distance observations."""
+	def adjust_similarity_cutoff(quantile: float, distances: Iterable[float], method: str = 'exact',
+			weights: Optional[numpy.ndarray] = None) -> float:
+		""" Adjusts the `similarity_cutoff` value to work with the distance observations.
+			`distances` should be the condensed distance vector. The quantile is calculated as if each pair were included
+			in both directions (as in `DistanceCache.values`), so the cutoff does not depend on how the distances are stored.
+			`method` is either 'exact' or 'approximate' (see `distance_quantile.get_filtered_quantile`). `weights` is the
+			number of identical trajectories each element of the distance matrix stands for.
+		"""
+		if not isinstance(distances, numpy.ndarray):
+			distances = numpy.asarray(distances, dtype = float)
+		return distance_quantile.get_filtered_quantile(distances, quantile, method, weights = weights)
 
-		#result = pandas.Series(distances).quantile(quantile)
-		result = pandas.Series([i for i in distances if 0 < i < max(distances)]).quantile(quantile)
-		return result
+	def run_sparse(self, pair_array: SparseDistanceCache, cutoff: float) -> projectdata.DataHierarchalCluster:
+		"""
+			Clusters the distances which were kept after skipping every pair further apart than `cutoff`. The linkage can only
+			be calculated exactly from the known distances with single linkage, so single linkage is used regardless of
+			`self.linkage_method`, and `cutoff` is used directly as the distance cutoff.
+		"""
+		if self.linkage_method != 'single':
+			logger.warning(f"Using single linkage rather than '{self.linkage_method}' linkage since some pairwise distances were skipped.")
+		labels = pair_array.labels
+		start = time.perf_counter()
+		linkage_table = format_linkage_matrix(single_linkage_sparse(pair_array), len(labels))
+		reduced_linkage_table = linkage_table[['left', 'right', 'distance', 'observations']]
+		timings = {'linkage': time.perf_counter() - start}
+		logger.debug(f"Using Hierarchical Clustering with distance cutoff {cutoff} ({pair_array.prune_ratio:.1%} of pairs skipped)")
+		start = time.perf_counter()
+		clusters = self.cluster(reduced_linkage_table, cutoff, labels)
+		timings['clustering'] = time.perf_counter() - start
+
+		return projectdata.DataHierarchalCluster(
+			clusters = clusters,
+			table_linkage = linkage_table,
+			distance_cutoff = cutoff,
+			distance_quantile = math.nan,
+			timings = timings
+		)
+
+	def sweep(self, pair_array: Union[DistanceCache, CondensedDistanceCache], quantiles: Sequence[float],
+			starting_genotypes: List[List[str]] = None, linkage_table: Optional[pandas.DataFrame] = None) -> projectdata.DataClusterSweep:
+		"""
+			Clusters the trajectories at each similarity cutoff in `quantiles`. The linkage does not depend on the cutoff, so
+			it is only calculated once (or reused from `run`), and only `hierarchy.fcluster` is run for each cutoff.
+		Parameters
+		----------
+		pair_array: Union[DistanceCache, CondensedDistanceCache]
+			Every pairwise distance is required, so a `SparseDistanceCache` cannot be used.
+		quantiles: Sequence[float]
+			The similarity cutoffs to test (see `run`).
+		starting_genotypes: List[List[str]]
+		linkage_table: Optional[pandas.DataFrame]
+			The linkage table generated by `run` from the same `pair_array`, if available.
+		"""
+		if isinstance(pair_array, SparseDistanceCache):
+			message = f"The similarity cutoff cannot be swept when some of the pairwise distances were skipped."
+			raise ValueError(message)
+		if self.cluster_method != 'distance':
+			message = f"The similarity cutoff can only be swept with the 'distance' clustering method, not '{self.cluster_method}'."
+			raise ValueError(message)
+		if starting_genotypes:
+			pair_array = self._add_starting_genotypes(pair_array, starting_genotypes)
+		labels = pair_array.labels
+		distance_array = pair_array.triangle()
+		if linkage_table is None:
+			linkage_table = self.link_clusters(distance_array, len(labels))
+		reduced_linkage_table = linkage_table[['left', 'right', 'distance', 'observations']].values
+
+		quantiles = [float(i) for i in quantiles]
+		distance_cutoffs = distance_quantile.get_filtered_quantiles(distance_array, quantiles, self.quantile_method)
+		logger.debug(f"Sweeping the similarity cutoff over {len(quantiles)} values")
+		table_separation = get_cluster_separation(reduced_linkage_table, distance_array, distance_cutoffs)
 
+		rows = list()
+		clusters = dict()
+		for quantile, distance_cutoff in zip(quantiles, distance_cutoffs):
+			members = self._label_clusters(self._cluster_by_distance(reduced_linkage_table, distance_cutoff), labels)
+			sizes = sorted((len(i) for i in members), reverse = True)
+			clusters[quantile] = members
+			rows.append({
+				'quantile':        quantile,
+				'distanceCutoff':  distance_cutoff,
+				'genotypes':       len(members),
+				'singletons':      sizes.count(1),
+				'largestGenotype': sizes[0] if sizes else 0,
+				'sizes':           '|'.join(map(str, sizes))
+			})
+		table_sweep = pandas.concat([pandas.DataFrame(rows), table_separation], axis = 1)
+		return projectdata.DataClusterSweep(table_sweep = table_sweep, clusters = clusters)
 
-	def run(self, pair_array: DistanceCache, starting_genotypes: List[List[str]] = None, similarity_cutoff: Optional[float] = None) -> projectdata.DataHierarchalCluster:
+	def run(self, pair_array: Union[DistanceCache, CondensedDistanceCache, SparseDistanceCache], starting_genotypes: List[List[str]] = None,
+			similarity_cutoff: Optional[float] = None, distance_cutoff: Optional[float] = None,
+			weights: Optional[pandas.Series] = None) -> projectdata.DataHierarchalCluster:
 		"""
 		Parameters
 		----------
-		pair_array
+		pair_array: Union[DistanceCache, CondensedDistanceCache, SparseDistanceCache]
+			The linkage is calculated directly from `pair_array.triangle()`, so the labels are in the same order as `pair_array.labels`.
+			A `SparseDistanceCache` is clustered with single linkage (see `run_sparse`).
 		starting_genotypes: List[List[str]]
 			Each element should be a list of trajectories known to be in the same genotype.
 		similarity_cutoff: Optional[float]
 			If not given, the similarity cutoff will be generated automatically.
+		distance_cutoff: Optional[float]
+			The distance the pairs were pruned at. Required when `pair_array` is a `SparseDistanceCache`.
+		weights: Optional[pandas.Series]
+			The number of identical trajectories each label stands for, if duplicate trajectories were collapsed. The
+			linkage and the distance cutoff are the same as if every trajectory were included. Not used for single linkage.
 		"""
 
 		# If known genotypes are given, modify the pair_array so that they will be grouped together.
 		if starting_genotypes:
 			pair_array = self._add_starting_genotypes(pair_array, starting_genotypes)
-		squaremap = pair_array.squareform()
-		distance_array = distance.squareform(squaremap.values)
-		linkage_table = self.link_clusters(distance_array, len(squaremap.index))
+		if isinstance(pair_array, SparseDistanceCache):
+			if distance_cutoff is None:
+				message = f"A distance cutoff is required to cluster a sparse distance matrix."
+				raise ValueError(message)
+			return self.run_sparse(pair_array, distance_cutoff)
+		labels = pair_array.labels
+		distance_array = pair_array.triangle()
+		if weights is not None:
+			weights = weights.loc[list(labels)].values
+		start = time.perf_counter()
+		linkage_table = self.link_clusters(distance_array, len(labels), weights)
 		reduced_linkage_table = linkage_table[['left', 'right', 'distance', 'observations']]  # Removes the extra column
+		timings = {'linkage': time.perf_counter() - start}
 
 		if similarity_cutoff is None:
 			quantile = 0.05
 		else:
 			quantile = similarity_cutoff
 
-		distance_cutoff = self.adjust_similarity_cutoff(quantile, list(pair_array.pairwise_values.values()))
+		start = time.perf_counter()
+		distance_cutoff = self.adjust_similarity_cutoff(quantile, distance_array, self.quantile_method, weights)
+		timings['cutoff'] = time.perf_counter() - start
 
 		logger.debug(f"Using Hierarchical Clustering with similarity cutoff {distance_cutoff}")
 
-		clusters = self.cluster(reduced_linkage_table, distance_cutoff, squaremap.index)
+		start = time.perf_counter()
+		clusters = self.cluster(reduced_linkage_table, distance_cutoff, labels)
+		timings['clustering'] = time.perf_counter() - start
 
 		result = projectdata.DataHierarchalCluster(
 			clusters = clusters,
 			table_linkage = linkage_table,
 			distance_cutoff = distance_cutoff,
-			distance_quantile = quantile
+			distance_quantile = quantile,
+			timings = timings
 		)
 
 		return result
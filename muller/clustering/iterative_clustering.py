@@ -0,0 +1,227 @@
+"""
+	The iterative clustering methods from the original matlab scripts. The trajectories which fix and the trajectories which
+	never fix are clustered separately. Within each group, the two closest genotypes are merged until no two genotypes are
+	closer than the distance cutoff, where the distance between two genotypes is the mean distance between their members.
+	The 'twostep' method then unlinks any genotype with a pair of members which are further apart than the difference
+	cutoff (see `unlink_genotypes`).
+
+	Both steps read the condensed distance vector directly. After each merge, the mean distance from the new genotype to
+	every other genotype is updated from the means of the two merged genotypes, so the distances between the members are
+	never read again. The closest pair of genotypes is found with the nearest-neighbor chain algorithm, so each merge only
+	reads a few rows of the distance matrix.
+"""
+import math
+import time
+from typing import List, Optional, Union
+
+import numpy
+import pandas
+from loguru import logger
+
+try:
+	from muller.clustering import hierarchy
+	from muller.clustering.metrics import distance_quantile
+	from muller.clustering.metrics.distance_kernels import get_condensed_index, get_row_offset
+	from muller.clustering.metrics.distance_cache import CondensedDistanceCache, DistanceCache, SparseDistanceCache
+	from muller.dataio import projectdata
+except ModuleNotFoundError:
+	from . import hierarchy
+	from .metrics import distance_quantile
+	from .metrics.distance_kernels import get_condensed_index, get_row_offset
+	from .metrics.distance_cache import CondensedDistanceCache, DistanceCache, SparseDistanceCache
+	from ..dataio import projectdata
+
+ACCEPTED_METHODS = ['matlab', 'twostep']
+
+
+def get_row_positions(total: int, row: int) -> numpy.ndarray:
+	""" The position of each pair (`row`, column) in a condensed distance vector of `total` elements. The position of (`row`, `row`) is 0."""
+	positions = numpy.zeros(total, dtype = numpy.int64)
+	positions[:row] = get_condensed_index(total, numpy.arange(row, dtype = numpy.int64), row)
+	positions[row + 1:] = get_row_offset(total, row) + numpy.arange(total - row - 1, dtype = numpy.int64)
+	return positions
+
+
+def merge_genotypes(distances: numpy.ndarray, groups: numpy.ndarray, cutoff: float,
+		weights: Optional[numpy.ndarray] = None) -> List[List[int]]:
+	"""
+		Repeatedly merges the two closest genotypes in the same group until every pair of genotypes is further apart than
+		`cutoff`. Returns the positions of the members of each genotype.
+	Parameters
+	----------
+	distances: numpy.ndarray
+		The condensed distance vector. It is not modified.
+	groups: numpy.ndarray
+		Genotypes are only merged with genotypes in the same group.
+	cutoff: float
+	weights: Optional[numpy.ndarray]
+		The number of trajectories each element stands for. Used as the initial size of each genotype.
+	"""
+	total = len(groups)
+	distances = numpy.array(distances, dtype = float)
+	sizes = numpy.ones(total) if weights is None else numpy.array(weights, dtype = float)
+	is_active = numpy.ones(total, dtype = bool)
+	is_merged = numpy.zeros(total, dtype = bool)
+	members = [[index] for index in range(total)]
+
+	def get_row(row: int) -> numpy.ndarray:
+		values = distances[get_row_positions(total, row)]
+		values[~is_active | (groups != groups[row])] = math.inf
+		values[row] = math.inf
+		return values
+
+	# Average linkage is reducible, so merging reciprocal nearest neighbors in any order gives the same genotypes as
+	# always merging the closest pair. A genotype whose nearest neighbor is further than `cutoff` can never be merged.
+	chain: List[int] = list()
+	while is_active.sum() > 1:
+		if not chain:
+			chain.append(int(numpy.argmax(is_active)))
+		x = chain[-1]
+		row = get_row(x)
+		y = int(numpy.argmin(row))
+		if len(chain) > 1 and row[chain[-2]] <= row[y]:
+			y = chain[-2]
+		if not row[y] <= cutoff:
+			is_active[x] = False
+			chain.pop()
+			continue
+		if len(chain) < 2 or y != chain[-2]:
+			chain.append(y)
+			continue
+		chain = chain[:-2]
+
+		# Merge `x` into `y` and update the mean distance between `y` and every other genotype.
+		positions_x = get_row_positions(total, x)
+		positions_y = get_row_positions(total, y)
+		is_updated = is_active.copy()
+		is_updated[[x, y]] = False
+		distances[positions_y[is_updated]] = (
+			(sizes[x] * distances[positions_x[is_updated]] + sizes[y] * distances[positions_y[is_updated]]) / (sizes[x] + sizes[y])
+		)
+		sizes[y] += sizes[x]
+		members[y] += members[x]
+		is_active[x] = False
+		is_merged[x] = True
+	return [sorted(members[index]) for index in range(total) if not is_merged[index]]
+
+
+def unlink_genotypes(distances: numpy.ndarray, genotypes: List[List[int]], cutoff: float) -> List[List[int]]:
+	"""
+		Splits each genotype with a pair of members which are further apart than `cutoff`. The two members which are furthest
+		apart start two new genotypes, and every other member is moved to the new genotype of whichever of the two it is
+		closer to. This is repeated until no genotype has a pair of members further apart than `cutoff`.
+	"""
+	total = int(round((1 + math.sqrt(1 + 8 * len(distances))) / 2)) if len(distances) else 1
+	result = list()
+	remaining = [sorted(genotype) for genotype in genotypes]
+	while remaining:
+		genotype = remaining.pop()
+		if len(genotype) < 2:
+			result.append(genotype)
+			continue
+		positions = numpy.array(genotype, dtype = numpy.int64)
+		lower = numpy.minimum.outer(positions, positions)
+		upper = numpy.maximum.outer(positions, positions)
+		square = distances[get_condensed_index(total, lower, upper)]
+		numpy.fill_diagonal(square, 0)
+		left, right = numpy.unravel_index(numpy.argmax(square), square.shape)
+		if not square[left, right] > cutoff:
+			result.append(genotype)
+			continue
+		is_left = square[:, left] <= square[:, right]
+		is_left[left] = True
+		is_left[right] = False
+		remaining.append(positions[is_left].tolist())
+		remaining.append(positions[~is_left].tolist())
+	return result
+
+
+class IterativeCluster:
+	"""
+		Clusters trajectories with the iterative methods from the original matlab scripts. See the module docstring.
+	Parameters
+	----------
+	method: {'matlab', 'twostep'}
+		'twostep' also unlinks genotypes with members further apart than the difference cutoff.
+	fixed_limit: float
+		Trajectories which reach this frequency are only clustered with other trajectories which reach this frequency.
+	difference_cutoff: float
+		The quantile of the pairwise distances used as the maximum distance between two members of a genotype. Only used by 'twostep'.
+	quantile_method: {'exact', 'approximate'}
+		How the distance cutoffs are calculated from the quantiles. See `distance_quantile.get_filtered_quantiles`.
+	"""
+
+	def __init__(self, method: str, fixed_limit: float, difference_cutoff: float = 0.10, quantile_method: str = 'exact'):
+		if method not in ACCEPTED_METHODS:
+			message = f"'{method}' is not an iterative clustering method. Expected one of {ACCEPTED_METHODS}"
+			raise ValueError(message)
+		self.method = method
+		self.fixed_limit = fixed_limit
+		self.difference_cutoff = difference_cutoff
+		self.quantile_method = quantile_method
+
+	def get_groups(self, trajectories: pandas.DataFrame, labels: List[str], starting_genotypes: List[List[str]]) -> numpy.ndarray:
+		""" Whether each trajectory in `labels` fixes. The members of each known genotype are placed with the first member."""
+		is_fixed = (trajectories.loc[labels].values >= self.fixed_limit).any(axis = 1)
+		positions = {label: position for position, label in enumerate(labels)}
+		for genotype in starting_genotypes:
+			indices = [positions[label] for label in genotype if label in positions]
+			if indices:
+				is_fixed[indices] = is_fixed[indices[0]]
+		return is_fixed.astype(int)
+
+	def run(self, pair_array: Union[DistanceCache, CondensedDistanceCache], trajectories: pandas.DataFrame,
+			starting_genotypes: List[List[str]] = None, similarity_cutoff: Optional[float] = None,
+			weights: Optional[pandas.Series] = None) -> projectdata.DataHierarchalCluster:
+		"""
+		Parameters
+		----------
+		pair_array: Union[DistanceCache, CondensedDistanceCache]
+			Every pairwise distance is required, so a `SparseDistanceCache` cannot be used.
+		trajectories: pandas.DataFrame
+			Used to find which trajectories fix. Should include every label in `pair_array`.
+		starting_genotypes: List[List[str]]
+			Each element should be a list of trajectories known to be in the same genotype.
+		similarity_cutoff: Optional[float]
+			The quantile of the pairwise distances used as the maximum distance between two merged genotypes. Defaults to 0.05.
+		weights: Optional[pandas.Series]
+			The number of identical trajectories each label stands for, if duplicate trajectories were collapsed.
+		"""
+		if isinstance(pair_array, SparseDistanceCache):
+			message = f"The '{self.method}' clustering method requires every pairwise distance."
+			raise ValueError(message)
+		starting_genotypes = starting_genotypes if starting_genotypes else []
+		if starting_genotypes:
+			pair_array = hierarchy.HierarchalCluster._add_starting_genotypes(pair_array, starting_genotypes)
+		labels = list(pair_array.labels)
+		distance_array = pair_array.triangle()
+		if weights is not None:
+			weights = weights.loc[labels].values
+		quantile = 0.05 if similarity_cutoff is None else similarity_cutoff
+
+		timings = dict()
+		start = time.perf_counter()
+		distance_cutoff, difference_cutoff = distance_quantile.get_filtered_quantiles(
+			distance_array, [quantile, self.difference_cutoff], self.quantile_method, weights = weights
+		)
+		timings['cutoff'] = time.perf_counter() - start
+		logger.debug(f"Using the '{self.method}' clustering method with distance cutoff {distance_cutoff}")
+
+		start = time.perf_counter()
+		groups = self.get_groups(trajectories, labels, starting_genotypes)
+		genotypes = merge_genotypes(distance_array, groups, distance_cutoff, weights)
+		timings['clustering'] = time.perf_counter() - start
+		if self.method == 'twostep':
+			start = time.perf_counter()
+			genotypes = unlink_genotypes(distance_array, genotypes, difference_cutoff)
+			timings['unlinking'] = time.perf_counter() - start
+
+		# Use the same order as `HierarchalCluster`, which lists the genotypes in the order of their first member.
+		clusters = [[labels[index] for index in genotype] for genotype in sorted(map(sorted, genotypes))]
+		return projectdata.DataHierarchalCluster(
+			clusters = clusters,
+			table_linkage = None,
+			distance_cutoff = float(distance_cutoff),
+			distance_quantile = quantile,
+			timings = timings
+		)
@@ -1,3 +1,4 @@
-from .distance_cache import DistanceCache
+from .distance_cache import CondensedDistanceCache, DistanceCache, SparseDistanceCache, is_binary_distance_file
 from .distance_calculator import DistanceCalculator
-
+from .distance_store import DistanceStore, hash_trajectories
+from .trajectory_states import TrajectoryStates
@@ -1,12 +1,82 @@
 import itertools
+import json
+import struct
 from pathlib import Path
-from typing import Dict, Iterable, List, Tuple
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
+import numpy
 import pandas
 from scipy.spatial import distance
 
+try:
+	from muller.clustering.metrics import distance_memmap
+	from muller.clustering.metrics.distance_kernels import get_condensed_index, get_row_offset
+except ModuleNotFoundError:
+	from . import distance_memmap
+	from .distance_kernels import get_condensed_index, get_row_offset
+
 PairwiseArrayType = Dict[Tuple[str, str], float]
 
+# The binary distance file consists of `BINARY_MAGIC`, the length of the header as a little-endian uint64, a json header
+# with the labels and the parameters used to calculate the distances, and then the raw condensed distance vector.
+# The vector may be followed by a bitmask (see `numpy.packbits`) of the pairs which could not be calculated.
+BINARY_MAGIC = b"LOLIPOP-DISTANCES-1\n"
+# The header is padded so that the distance vector is aligned in the file.
+BINARY_ALIGNMENT = 64
+
+
+def _to_builtin(value: Any) -> Any:
+	# Labels and parameters may be numpy scalars, which can't be serialized with json.
+	if hasattr(value, 'item'):
+		return value.item()
+	return str(value)
+
+
+def build_binary_header(labels: List[str], dtype, parameters: Optional[Dict[str, Any]] = None,
+		hashes: Optional[numpy.ndarray] = None, missing: bool = False) -> bytes:
+	""" Generates the header of a binary distance file. The distances should be written immediately after the header."""
+	header = {
+		'labels':     list(labels),
+		'dtype':      numpy.dtype(dtype).str,
+		'parameters': parameters if parameters else dict(),
+		'hashes':     hashes.tolist() if hashes is not None else None,
+		'missing':    missing
+	}
+	contents = json.dumps(header, default = _to_builtin).encode('utf-8')
+	size = len(BINARY_MAGIC) + 8 + len(contents)
+	# json ignores trailing whitespace.
+	contents += b' ' * (-size % BINARY_ALIGNMENT)
+	return BINARY_MAGIC + struct.pack('<Q', len(contents)) + contents
+
+
+def read_binary_header(filename: Path) -> Tuple[Dict[str, Any], int]:
+	""" Reads the header of a binary distance file. Returns the header and the position of the distance vector in the file."""
+	with Path(filename).open('rb') as handle:
+		magic = handle.read(len(BINARY_MAGIC))
+		if magic != BINARY_MAGIC:
+			message = f"'{filename}' is not a binary distance file."
+			raise ValueError(message)
+		size, = struct.unpack('<Q', handle.read(8))
+		header = json.loads(handle.read(size).decode('utf-8'))
+	return header, len(BINARY_MAGIC) + 8 + size
+
+
+def is_binary_distance_file(filename: Path) -> bool:
+	with Path(filename).open('rb') as handle:
+		return handle.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+def create_binary_distance_file(filename: Path, labels: List[str], dtype = numpy.float64,
+		parameters: Optional[Dict[str, Any]] = None, hashes: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+	"""
+		Creates a binary distance file for `labels` and returns the writable distance vector, mapped into memory.
+		Used by the out-of-core mode so that the distances are calculated directly into a file which can be reloaded later.
+		The bitmask of missing pairs is appended by `CondensedDistanceCache.save_binary`.
+	"""
+	total_pairs = len(labels) * (len(labels) - 1) // 2
+	header = build_binary_header(labels, dtype, parameters, hashes, missing = True)
+	return distance_memmap.create_distance_memmap(filename, total_pairs, dtype, header = header)
+
 # TODO: Refactor using UserDict
 class DistanceCache:
 	"""
@@ -37,10 +107,15 @@ class DistanceCache:
 	def asdict(self) -> PairwiseArrayType:
 		return self.pairwise_values
 
+	@property
+	def labels(self) -> List[str]:
+		""" The labels in the same order as the rows of `self.squareform()`."""
+		return sorted(set(itertools.chain.from_iterable(self.pairwise_values.keys())))
+
 	def squareform(self)->pandas.DataFrame:
 		""" Converts a dictionary with all pairwise values for a set of points into a square matrix representation.
 		"""
-		keys = sorted(set(itertools.chain.from_iterable(self.pairwise_values.keys())))
+		keys = self.labels
 		_square_map = dict()
 		for left in keys:
 			series = dict()
@@ -103,7 +178,7 @@ class DistanceCache:
 	@classmethod
 	def read(cls, filename: Path) -> 'DistanceCache':
 		contents = filename.read_text().split('\n')
-		contents = [i.split('\t') for i in contents]
+		contents = [i.split('\t') for i in contents if i]
 		data = dict()
 		for line in contents:
 			left, right, value = line
@@ -121,3 +196,422 @@ class DistanceCache:
 				data[left,right] = value
 				data[right,left] = value
 		return DistanceCache(data)
+
+
+class CondensedDistanceCache:
+	"""
+		Holds the distances for all pairwise elements as a single condensed vector (the upper triangle of the square matrix,
+		ordered as `itertools.combinations(labels, 2)`) rather than as a dictionary with the forward and reverse key of every pair.
+		Implements the same interface as `DistanceCache`.
+	Parameters
+	----------
+	labels: Iterable[str]
+		The label of each element. The order of the labels determines the order of `values`.
+	values: Optional[numpy.ndarray]
+		The condensed distance vector. Pairs are `nan` if not given.
+	dtype: {numpy.float64, numpy.float32}
+		`numpy.float32` halves the memory required, at the cost of precision.
+	parameters: Optional[Dict[str, Any]]
+		The parameters used to calculate the distances (ex. the metric, dlimit and flimit). Saved with `save_binary`.
+	hashes: Optional[numpy.ndarray]
+		A hash of the trajectory each label refers to (see `distance_store.hash_trajectories`). Used to detect trajectories
+		which changed since the distances were calculated.
+	missing: Optional[numpy.ndarray]
+		A bitmask (see `numpy.packbits`) of the pairs which could not be calculated and were assigned the maximum distance.
+	"""
+
+	def __init__(self, labels: Optional[Iterable[str]] = None, values: Optional[numpy.ndarray] = None, dtype = numpy.float64,
+			parameters: Optional[Dict[str, Any]] = None, hashes: Optional[numpy.ndarray] = None,
+			missing: Optional[numpy.ndarray] = None):
+		self.parameters: Dict[str, Any] = parameters if parameters else dict()
+		self.hashes: Optional[numpy.ndarray] = numpy.asarray(hashes, dtype = numpy.int64) if hashes is not None else None
+		self.missing: Optional[numpy.ndarray] = missing
+		# Set when the distances are stored in a file because they are too large to keep in memory.
+		self.out_of_core = False
+		self.labels: List[str] = list(labels) if labels is not None else list()
+		self.index: Dict[str, int] = {label: position for position, label in enumerate(self.labels)}
+		if len(self.index) != len(self.labels):
+			message = f"The labels of a distance cache must be unique."
+			raise ValueError(message)
+
+		total_pairs = self._get_total_pairs(len(self.labels))
+		if values is None:
+			values = numpy.full(total_pairs, numpy.nan, dtype = dtype)
+		elif not (isinstance(values, numpy.ndarray) and values.dtype == dtype and values.ndim == 1):
+			# Avoid copying arrays which are already in the correct format, such as `numpy.memmap` files.
+			values = numpy.asarray(values, dtype = dtype).reshape(-1)
+		if len(values) != total_pairs:
+			message = f"Expected {total_pairs} distances for {len(self.labels)} labels, got {len(values)}"
+			raise ValueError(message)
+		self.array: numpy.ndarray = values
+
+	@staticmethod
+	def _get_total_pairs(total_labels: int) -> int:
+		return total_labels * (total_labels - 1) // 2
+
+	def __bool__(self) -> bool:
+		return len(self.array) > 0
+
+	def __len__(self) -> int:
+		""" The number of unique pairs."""
+		return len(self.array)
+
+	def __getitem__(self, item: Tuple[str, str]) -> float:
+		return float(self.array[self._get_position(*item)])
+
+	def _get_position(self, left: str, right: str) -> int:
+		i = self.index[left]
+		j = self.index[right]
+		if i == j:
+			raise KeyError((left, right))
+		if i > j:
+			i, j = j, i
+		return get_condensed_index(len(self.labels), i, j)
+
+	@property
+	def pairwise_values(self) -> PairwiseArrayType:
+		return self.asdict()
+
+	@property
+	def is_memmap(self) -> bool:
+		""" Whether the distances are stored in a `numpy.memmap` file rather than in memory."""
+		return isinstance(self.array, numpy.memmap)
+
+	@property
+	def values(self) -> numpy.ndarray:
+		""" The distance of each unique pair. Unlike `DistanceCache.values`, each pair is only included once."""
+		return self.array
+
+	def asdict(self) -> PairwiseArrayType:
+		pair_array = dict()
+		for (left, right), value in zip(itertools.combinations(self.labels, 2), self.array.tolist()):
+			pair_array[left, right] = value
+			pair_array[right, left] = value
+		return pair_array
+
+	def squareform(self) -> pandas.DataFrame:
+		""" Converts the condensed vector into a square matrix with a diagonal of 0."""
+		if len(self.labels) < 2:
+			square = numpy.zeros((len(self.labels), len(self.labels)))
+		else:
+			square = distance.squareform(self.triangle(), checks = False)
+		return pandas.DataFrame(square, index = self.labels, columns = self.labels)
+
+	def triangle(self) -> numpy.ndarray:
+		""" Returns the condensed squareform of the pair array. `scipy.cluster.hierarchy` requires double precision."""
+		return self.array.astype(float, copy = False)
+
+	def get(self, left, right, default = None) -> float:
+		try:
+			result = self[left, right]
+		except KeyError:
+			result = default
+		return result
+
+	def _take(self, positions: List[int], array: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+		""" Returns the condensed vector of the elements at `positions`, which should be sorted. Defaults to `self.array`."""
+		if array is None:
+			array = self.array
+		total = len(self.labels)
+		positions = numpy.asarray(positions, dtype = int)
+		result = numpy.empty(self._get_total_pairs(len(positions)), dtype = array.dtype)
+		start = 0
+		for index, row in enumerate(positions[:-1]):
+			columns = positions[index + 1:]
+			result[start:start + len(columns)] = array[get_row_offset(total, row) + columns - row - 1]
+			start += len(columns)
+		return result
+
+	def get_missing(self) -> Optional[numpy.ndarray]:
+		""" Returns a boolean array indicating which pairs could not be calculated, if known."""
+		if self.missing is None:
+			return None
+		return numpy.unpackbits(self.missing, count = len(self.array)).astype(bool)
+
+	def get_changed_labels(self, labels: Iterable[str], hashes: Optional[numpy.ndarray] = None) -> List[str]:
+		"""
+			Returns the labels which are not in the cache, or which refer to a different trajectory than the one used to
+			calculate the distances. Trajectories can only be compared when both `hashes` and `self.hashes` are available.
+		"""
+		labels = list(labels)
+		changed = [label for label in labels if label not in self.index]
+		if hashes is not None and self.hashes is not None:
+			changed += [
+				label for label, value in zip(labels, hashes)
+				if label in self.index and self.hashes[self.index[label]] != value
+			]
+		return changed
+
+	def reduce(self, labels: Iterable[str]) -> 'CondensedDistanceCache':
+		"""
+			Removes all labels that are not present in `labels`
+		"""
+		labels = set(labels)
+		positions = [position for position, label in enumerate(self.labels) if label in labels]
+		if self.missing is not None:
+			self.missing = numpy.packbits(self._take(positions, self.get_missing()))
+		if self.hashes is not None:
+			self.hashes = self.hashes[positions]
+		self.array = self._take(positions)
+		self.labels = [self.labels[position] for position in positions]
+		self.index = {label: position for position, label in enumerate(self.labels)}
+		return self
+
+	def _extend(self, labels: Iterable[str]):
+		""" Adds any labels not already in the cache. The distances to the new labels are `nan`."""
+		new_labels = [label for label in dict.fromkeys(labels) if label not in self.index]
+		if not new_labels:
+			return
+		total_old = len(self.labels)
+		total_new = total_old + len(new_labels)
+		array = numpy.full(self._get_total_pairs(total_new), numpy.nan, dtype = self.array.dtype)
+		# The new labels are appended, so the existing pairs of each row remain contiguous.
+		for row in range(total_old - 1):
+			old_start = get_row_offset(total_old, row)
+			new_start = get_row_offset(total_new, row)
+			length = total_old - row - 1
+			array[new_start:new_start + length] = self.array[old_start:old_start + length]
+		self.array = array
+		self.labels += new_labels
+		self.index = {label: position for position, label in enumerate(self.labels)}
+		# The trajectories of the new labels are not known.
+		self.hashes = None
+
+	def update(self, pair_array: PairwiseArrayType) -> 'CondensedDistanceCache':
+		self._extend(itertools.chain.from_iterable(pair_array.keys()))
+		# The distances are set directly, so it is no longer known which of them were calculated.
+		self.missing = None
+		for (left, right), value in pair_array.items():
+			if left != right:
+				self.array[self._get_position(left, right)] = value
+		return self
+
+	def unique(self) -> Iterable[Tuple[str, str]]:
+		yield from itertools.combinations(self.labels, 2)
+
+	def save(self, filename: Path):
+		with filename.open('w') as output:
+			for (left, right), value in zip(self.unique(), self.array.tolist()):
+				output.write(f"{left}\t{right}\t{value}\n")
+
+	@classmethod
+	def from_pair_array(cls, pair_array: PairwiseArrayType, dtype = numpy.float64) -> 'CondensedDistanceCache':
+		labels = sorted(set(itertools.chain.from_iterable(pair_array.keys())))
+		return cls(labels, dtype = dtype).update(pair_array)
+
+	@classmethod
+	def read(cls, filename: Path) -> 'CondensedDistanceCache':
+		data = dict()
+		for line in filename.read_text().split('\n'):
+			if not line:
+				continue
+			left, right, value = line.split('\t')
+			data[left, right] = float(value)
+		return cls.from_pair_array(data)
+
+	@property
+	def filename(self) -> Optional[Path]:
+		""" The file the distances are mapped from, if any."""
+		if self.is_memmap and self.array.filename:
+			return Path(self.array.filename)
+		return None
+
+	def save_binary(self, filename: Path):
+		""" Saves the labels, parameters and condensed vector as a binary distance file. See `read_binary`."""
+		filename = Path(filename)
+		if self.filename is not None and self.filename.resolve() == filename.resolve():
+			# The distances were calculated directly into this file, which already has a header.
+			self.array.flush()
+			if self.missing is not None:
+				with filename.open('r+b') as output:
+					output.seek(self.array.offset + self.array.nbytes)
+					output.write(self.missing.tobytes())
+					output.truncate()
+			return
+		array = numpy.ascontiguousarray(self.array)
+		with filename.open('wb') as output:
+			output.write(build_binary_header(self.labels, array.dtype, self.parameters, self.hashes, self.missing is not None))
+			# Writes the array's buffer directly, without converting it.
+			array.tofile(output)
+			if self.missing is not None:
+				output.write(self.missing.tobytes())
+
+	@classmethod
+	def read_binary(cls, filename: Path, mode: str = 'c') -> 'CondensedDistanceCache':
+		"""
+			Loads a binary distance file created by `save_binary`. The distance vector is mapped from the file rather than read,
+			so this takes about the same time regardless of the number of pairs.
+		Parameters
+		----------
+		filename: Path
+		mode: {'c', 'r', 'r+'}
+			The `numpy.memmap` mode. The default, 'c', allows the distances to be modified in memory without changing the file.
+		"""
+		header, offset = read_binary_header(filename)
+		labels = header['labels']
+		dtype = numpy.dtype(header['dtype'])
+		total_pairs = cls._get_total_pairs(len(labels))
+		if total_pairs:
+			values = numpy.memmap(filename, dtype = dtype, mode = mode, offset = offset, shape = (total_pairs,))
+		else:
+			values = numpy.empty(0, dtype = dtype)
+
+		missing = None
+		if header.get('missing'):
+			missing_offset = offset + total_pairs * dtype.itemsize
+			missing_size = (total_pairs + 7) // 8
+			# The bitmask is only appended once the distances are calculated.
+			if Path(filename).stat().st_size >= missing_offset + missing_size:
+				missing = numpy.fromfile(filename, dtype = numpy.uint8, count = missing_size, offset = missing_offset)
+		return cls(labels, values, dtype = dtype, parameters = header['parameters'], hashes = header.get('hashes'), missing = missing)
+
+	@classmethod
+	def from_squareform(cls, square: pandas.DataFrame) -> 'CondensedDistanceCache':
+		values = distance.squareform(square.values, checks = False) if len(square) > 1 else None
+		return cls(square.index, values)
+
+
+class SparseDistanceCache:
+	"""
+		Holds the distances for only some of the pairwise elements. Every other pair is assumed to be `far` apart.
+		Generated when pairs which are provably further apart than the clustering cutoff are skipped
+		(see `DistanceCalculator.run_sparse`). Implements the parts of the `CondensedDistanceCache` interface used
+		when clustering and saving the distances.
+	Parameters
+	----------
+	labels: Iterable[str]
+	rows, columns: numpy.ndarray
+		The positions of the left and right label of each known pair, in any order.
+	values: numpy.ndarray
+		The distance of each known pair.
+	far: float
+		The distance assigned to every pair which is not known. Should be larger than every known distance.
+	parameters: Optional[Dict[str, Any]]
+	total_pruned: int
+		The number of pairs which were skipped rather than calculated.
+	"""
+
+	def __init__(self, labels: Iterable[str], rows: numpy.ndarray, columns: numpy.ndarray, values: numpy.ndarray, far: float,
+			parameters: Optional[Dict[str, Any]] = None, total_pruned: int = 0):
+		self.parameters: Dict[str, Any] = parameters if parameters else dict()
+		self.out_of_core = False
+		# Only the known pairs are saved and plotted. The full distance matrix would need memory for every pair.
+		self.is_sparse = True
+		self.labels: List[str] = list(labels)
+		self.index: Dict[str, int] = {label: position for position, label in enumerate(self.labels)}
+		self.far = float(far)
+		self.total_pruned = total_pruned
+		self._set_pairs(rows, columns, values)
+
+	def _set_pairs(self, rows: numpy.ndarray, columns: numpy.ndarray, values: numpy.ndarray):
+		rows = numpy.asarray(rows, dtype = numpy.int64)
+		columns = numpy.asarray(columns, dtype = numpy.int64)
+		values = numpy.asarray(values, dtype = float)
+		self.rows = numpy.minimum(rows, columns)
+		self.columns = numpy.maximum(rows, columns)
+		# Each pair is identified by a single key so it can be found with a binary search. Later values replace earlier values.
+		keys = (self.rows << 32) | self.columns
+		order = numpy.argsort(keys, kind = 'stable')[::-1]
+		keys, first = numpy.unique(keys[order], return_index = True)
+		order = order[first]
+		self.keys = keys
+		self.rows = self.rows[order]
+		self.columns = self.columns[order]
+		self.array = values[order]
+
+	@staticmethod
+	def _get_total_pairs(total_labels: int) -> int:
+		return total_labels * (total_labels - 1) // 2
+
+	def __bool__(self) -> bool:
+		return len(self.labels) > 1
+
+	def __len__(self) -> int:
+		""" The number of unique pairs, including the pairs which are not known."""
+		return self._get_total_pairs(len(self.labels))
+
+	def __getitem__(self, item: Tuple[str, str]) -> float:
+		left, right = item
+		i = self.index[left]
+		j = self.index[right]
+		if i == j:
+			raise KeyError(item)
+		return self.get_by_position(i, j)
+
+	def get(self, left, right, default = None) -> float:
+		try:
+			result = self[left, right]
+		except KeyError:
+			result = default
+		return result
+
+	def get_by_position(self, left: int, right: int) -> float:
+		""" Same as `__getitem__`, but uses the positions of the labels rather than the labels."""
+		if left == right:
+			return 0.0
+		key = (min(left, right) << 32) | max(left, right)
+		position = numpy.searchsorted(self.keys, key)
+		if position < len(self.keys) and self.keys[position] == key:
+			return float(self.array[position])
+		return self.far
+
+	@property
+	def prune_ratio(self) -> float:
+		""" The fraction of pairs which were skipped."""
+		return self.total_pruned / len(self) if len(self) else 0.0
+
+	@property
+	def values(self) -> numpy.ndarray:
+		""" The distances of the known pairs."""
+		return self.array
+
+	def triangle(self) -> numpy.ndarray:
+		""" Returns the full condensed distance vector, with `self.far` for every pair which is not known."""
+		total = len(self.labels)
+		condensed = numpy.full(len(self), self.far)
+		condensed[get_condensed_index(total, self.rows, self.columns)] = self.array
+		return condensed
+
+	def squareform(self) -> pandas.DataFrame:
+		if len(self.labels) < 2:
+			square = numpy.zeros((len(self.labels), len(self.labels)))
+		else:
+			square = distance.squareform(self.triangle(), checks = False)
+		return pandas.DataFrame(square, index = self.labels, columns = self.labels)
+
+	def to_csgraph(self):
+		""" Returns the known distances as the upper triangle of a `scipy.sparse.csr_matrix`. Distances of 0 are stored explicitly."""
+		from scipy import sparse
+		total = len(self.labels)
+		return sparse.csr_matrix((self.array, (self.rows, self.columns)), shape = (total, total))
+
+	def update(self, pair_array: PairwiseArrayType) -> 'SparseDistanceCache':
+		""" Sets the distance of each pair in `pair_array`. Every label should already be in the cache."""
+		pairs = [(self.index[left], self.index[right], value) for (left, right), value in pair_array.items() if left != right]
+		if pairs:
+			rows, columns, values = zip(*pairs)
+			self._set_pairs(
+				numpy.concatenate([self.rows, rows]), numpy.concatenate([self.columns, columns]),
+				numpy.concatenate([self.array, values])
+			)
+		return self
+
+	def reduce(self, labels: Iterable[str]) -> 'SparseDistanceCache':
+		""" Removes all labels that are not present in `labels`"""
+		labels = set(labels)
+		positions = numpy.array([position for position, label in enumerate(self.labels) if label in labels], dtype = numpy.int64)
+		new_positions = numpy.full(len(self.labels), -1, dtype = numpy.int64)
+		new_positions[positions] = numpy.arange(len(positions))
+		rows = new_positions[self.rows]
+		columns = new_positions[self.columns]
+		keep = (rows >= 0) & (columns >= 0)
+		self.labels = [self.labels[position] for position in positions]
+		self.index = {label: position for position, label in enumerate(self.labels)}
+		self._set_pairs(rows[keep], columns[keep], self.array[keep])
+		return self
+
+	def save(self, filename: Path):
+		""" Saves the known pairs in the same format as `CondensedDistanceCache.save`. Every other pair is `self.far` apart."""
+		with Path(filename).open('w') as output:
+			for row, column, value in zip(self.rows.tolist(), self.columns.tolist(), self.array.tolist()):
+				output.write(f"{self.labels[row]}\t{self.labels[column]}\t{value}\n")
@@ -1,52 +1,99 @@
+import itertools
 import math
-import multiprocessing
-from typing import Dict, Generator, List, Optional, Tuple
+from pathlib import Path
+from typing import Any, Dict, Generator, Iterator, List, Optional, Tuple
 
+import numpy
 import pandas
 from loguru import logger
 from tqdm import tqdm
 
 try:
-	from muller.clustering.metrics import distance_methods
+	from muller.clustering.metrics import distance_methods, distance_kernels, distance_memmap, distance_parallel
+	from muller.clustering.metrics.distance_cache import CondensedDistanceCache, SparseDistanceCache, create_binary_distance_file
+	from muller.clustering.metrics.distance_store import DistanceStore, hash_trajectories
+	from muller.clustering.metrics.trajectory_states import PAIR_CATEGORIES, TrajectoryStates
 	from muller import widgets
 except ModuleNotFoundError:
-	from . import distance_methods
+	from . import distance_methods, distance_kernels, distance_memmap, distance_parallel
+	from .distance_cache import CondensedDistanceCache, SparseDistanceCache, create_binary_distance_file
+	from .distance_store import DistanceStore, hash_trajectories
+	from .trajectory_states import PAIR_CATEGORIES, TrajectoryStates
 	from ... import widgets
 
 FilterType = Tuple[Optional[pandas.Series], Optional[pandas.Series]]
 
+ACCEPTED_ENGINES = ['pairwise', 'vectorized']
+# The metrics which have an array-based implementation in `distance_kernels`.
+VECTORIZED_METRICS = distance_kernels.VECTORIZED_METRICS
+
 
 class DistanceCalculator:
-	""" Refactor to clean up code and add multithreading."""
+	""" Refactor to clean up code and add multithreading.
+		Parameters
+		----------
+		detection_limit, fixed_limit: float
+		metric: str
+		threads: Optional[int]
+		engine: {'pairwise', 'vectorized'}; default 'vectorized'
+			'pairwise' calculates the distance for each pair of trajectories separately. 'vectorized' converts the trajectory
+			table into a single array and calculates every pairwise distance at once. Metrics which are not supported by
+			the vectorized engine fall back to the pairwise engine.
+		filename_memmap: Optional[Path]
+			Enables the out-of-core mode. The condensed distance vector is written to a binary distance file at this location
+			(see `CondensedDistanceCache.read_binary`) rather than being held in memory, so datasets with more pairs than can
+			fit in memory can still be processed.
+		distance_store: Optional[DistanceStore]
+			A persistent cache of distances from previous runs. Only the distances which are not already in the cache are
+			calculated, and the new distances are added to the cache.
+		prune_cutoff: Optional[float]
+			Used by `run_sparse`. Pairs which are provably further apart than this distance are not calculated.
+	"""
 
-	def __init__(self, detection_limit: float, fixed_limit: float, metric: str, threads: Optional[int] = None):
+	def __init__(self, detection_limit: float, fixed_limit: float, metric: str, threads: Optional[int] = None,
+			engine: str = 'vectorized', filename_memmap: Optional[Path] = None, distance_store: Optional[DistanceStore] = None,
+			prune_cutoff: Optional[float] = None):
+		if engine not in ACCEPTED_ENGINES:
+			message = f"'{engine}' is not a valid distance engine. Expected one of {ACCEPTED_ENGINES}"
+			raise ValueError(message)
 		self.detection_limit = detection_limit
 		self.fixed_limit = fixed_limit
 		self.metric = metric
 		self.threads = threads
+		self.engine = engine
+		self.filename_memmap = filename_memmap
+		self.distance_store = distance_store
+		self.prune_cutoff = prune_cutoff
 		# Basically used as a cache. Should save memory compared to loading each pair of trajectories directly into `pair_combinations`.
 		self.trajectories: Optional[pandas.DataFrame] = None
+		# The fixed/intermediate/detected timepoints of each trajectory. Generated once in `self.run()` and shared by every pair.
+		self.states: Optional[TrajectoryStates] = None
+		# The hash of each trajectory and the bitmask of the pairs which could not be calculated (see `numpy.packbits`).
+		# Updated by `calculate_condensed_distances`.
+		self.hashes: Optional[numpy.ndarray] = None
+		self.missing: Optional[numpy.ndarray] = None
 
 		self.progress_bar_minimum_points = 10000  # The value to activate the scale bar at.
 
-	def calculate_pairwise_distances_threaded(self, pair_combinations: Generator, total: Optional[int] = None) -> Dict[
-		Tuple[str, str], float]:
-		""" Threaded version of the pairwise distance calculator"""
-		pair_array: Dict[Tuple[str, str], float] = dict()
-		progress_bar = tqdm(total = total)
-		pool = multiprocessing.Pool(processes = self.threads)
-		for i in tqdm(
-				[pool.apply_async(calculate_distance, args = (self, e, self.trajectories)) for e in pair_combinations]):
-			key, value = i.get()  # retrieve the calculated value
-			pair_array[key] = value
-			pair_array[key[::-1]] = value
-			progress_bar.update(1)
-
-		return pair_array
+	def calculate_pairwise_distances_threaded(self, labels: List[str], out: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+		""" Threaded version of the pairwise distance calculator. The trajectories are shared with a pool of `self.threads` processes
+			which each calculate blocks of rows of the condensed distance matrix.
+		"""
+		return distance_parallel.calculate_distances_parallel(
+			self.trajectories.loc[labels],
+			dlimit = self.detection_limit,
+			flimit = self.fixed_limit,
+			metric = self.metric,
+			processes = self.threads,
+			vectorized = self.use_vectorized_engine(),
+			progress_bar_minimum_points = self.progress_bar_minimum_points,
+			out = out
+		)
 
-	def calculate_pairwise_distances_serial(self, pair_combinations: Generator, total: Optional[int] = None):
-		""" Nonthreaded version of the pairwise distance calculator"""
-		pair_array: Dict[Tuple[str, str], float] = dict()
+	def calculate_pairwise_distances_serial(self, pair_combinations: Generator, total: Optional[int] = None,
+			out: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+		""" Nonthreaded version of the pairwise distance calculator. `pair_combinations` should be ordered as `itertools.combinations`."""
+		condensed = numpy.empty(total, dtype = float) if out is None else out
 
 		# The progressbar is not really useful if there aren;t a lot of combinations, since calculating the pairwise
 		# distances is pretty fast. So disable the progressbar when the expected time to calculate all distances
@@ -55,17 +102,53 @@ class DistanceCalculator:
 		if use_progressbar:
 			progress_bar = tqdm(total = total)
 
-		for element in pair_combinations:
+		for index, element in enumerate(pair_combinations):
 			key, value = calculate_distance(self, element, self.trajectories)
-			pair_array[key] = value
-			pair_array[key[1], key[
-				0]] = value  # It's faster to add the reverse key rather than trying trying to get  test forward and reverse keys
+			condensed[index] = value
 			if use_progressbar:
 				progress_bar.update(1)
+		return condensed
+
+	def calculate_pairwise_distances_vectorized(self, labels: List[str], out: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+		""" Calculates every pairwise distance at once using the array-based kernels in `distance_kernels`."""
+		values = self.trajectories.loc[labels].values
+		return distance_kernels.distance_matrix(values, self.detection_limit, self.fixed_limit, self.metric, states = self.states, out = out)
+
+	@property
+	def parameters(self) -> Dict[str, Any]:
+		""" The parameters which affect the calculated distances. Saved alongside the distances."""
+		return {'metric': self.metric, 'dlimit': self.detection_limit, 'flimit': self.fixed_limit}
+
+	def _create_output(self, labels: List[str], dtype = numpy.float64, hashes: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+		""" Allocates the condensed distance vector, either in memory or as a binary distance file when using the out-of-core mode."""
+		if self.filename_memmap:
+			logger.info(f"Writing the pairwise distances to '{self.filename_memmap}'")
+			return create_binary_distance_file(self.filename_memmap, labels, dtype, self.parameters, hashes)
+		return numpy.empty(widgets.calculate_number_of_combinations(len(labels)), dtype = dtype)
+
+	@staticmethod
+	def _to_pair_array(labels: List[str], condensed: numpy.ndarray) -> Dict[Tuple[str, str], float]:
+		""" Converts a condensed distance vector into a dictionary with both the forward and reverse keys of each pair."""
+		pair_array: Dict[Tuple[str, str], float] = dict()
+		for (left, right), value in zip(itertools.combinations(labels, 2), condensed.tolist()):
+			pair_array[left, right] = value
+			pair_array[right, left] = value
 		return pair_array
 
-	def calculate_pairwise_distances(self, labels: List[str]) -> Dict[Tuple[str, str], float]:
-		""" Implements the actual loop over all pairs of trajectories.
+	def get_pair_categories(self) -> pandas.Categorical:
+		""" Returns the category of each pair of trajectories, in the same order as `itertools.combinations(self.trajectories.index, 2)`.
+			See `get_pair_category` for a description of each category.
+		"""
+		return pandas.Categorical.from_codes(self.states.get_pair_categories(), categories = PAIR_CATEGORIES)
+
+	def use_vectorized_engine(self) -> bool:
+		return self.engine == 'vectorized' and self.metric in VECTORIZED_METRICS
+
+	def calculate_condensed_distances(self, labels: List[str], dtype = numpy.float64,
+			previous: Optional[CondensedDistanceCache] = None) -> numpy.ndarray:
+		""" Implements the actual loop over all pairs of trajectories. Returns the condensed distance vector, ordered as
+			`itertools.combinations(labels, 2)`. This is a `numpy.memmap` when `self.filename_memmap` is set.
+			If given, the distances in `previous` are reused for any trajectories which have not changed.
 		"""
 		# May as well move the combination function here so we don't have to pass an additional parameter specifying the total number
 		# of trajectories so tqdm workd properly.
@@ -79,28 +162,195 @@ class DistanceCalculator:
 		if total_combinations > 100_000_000:
 			message = f"The provided dataset has {total_elements} trajectories, which requires {total_combinations} distance calculations." \
 					  "This will require a long time to process (you may need to adjust the number of available threads with the --threads option)" \
-					  "and will consume a large amount of memory (i.e. more than 16GB)."
+					  f"and will consume a large amount of memory (i.e. more than {8 * total_combinations / 1E9:.1f}GB)."
 			logger.warning(message)
-		pair_combinations = widgets.get_pair_combinations(labels)
 
+		hashes = self.hashes = hash_trajectories(self.trajectories.loc[labels].values)
+		if previous is not None and self.filename_memmap and previous.filename is not None \
+				and previous.filename.resolve() == Path(self.filename_memmap).resolve():
+			# The previous distances would be overwritten by the new binary distance file.
+			previous = CondensedDistanceCache(previous.labels, numpy.array(previous.array), previous.array.dtype, previous.parameters,
+				previous.hashes, previous.missing)
+		output = self._create_output(labels, dtype, hashes)
+		if previous is not None:
+			condensed = self.calculate_previous_distances(labels, output, hashes, previous)
+		elif self.distance_store is not None:
+			condensed = self.calculate_stored_distances(labels, output, hashes)
+		else:
+			condensed = self.calculate_all_distances(labels, output)
+
+		# Assume that any pair with NAN values are the maximum possible distance from each other.
+		# Both passes read one chunk at a time so that this also works with the out-of-core mode.
+		maximum_distance = distance_memmap.get_maximum(condensed)
+		if math.isnan(maximum_distance):
+			# Also includes datasets with fewer than two trajectories.
+			message = f"Could not calculate the pairwise distances due to invalid series (usually because all measurements are below the detectionlimit"
+			raise ValueError(message)
+		self.missing = distance_memmap.get_nan_mask(condensed)
+		distance_memmap.replace_nan(condensed, maximum_distance)
+		if isinstance(condensed, numpy.memmap):
+			condensed.flush()
+
+		return condensed
+
+	def calculate_all_distances(self, labels: List[str], out: numpy.ndarray) -> numpy.ndarray:
+		""" Calculates every pairwise distance with the selected engine. The `nan` distances are not replaced."""
 		if self.threads and self.threads > 1:  # One process is slower than using the serial method.
 			logger.debug(f"Using multithreading...")
-			pair_array = self.calculate_pairwise_distances_threaded(pair_combinations, total_combinations)
+			return self.calculate_pairwise_distances_threaded(labels, out)
+		elif self.use_vectorized_engine():
+			logger.debug(f"Using the vectorized distance engine...")
+			return self.calculate_pairwise_distances_vectorized(labels, out)
 		else:
 			logger.debug(f"Using a single thread...")
-			pair_array = self.calculate_pairwise_distances_serial(pair_combinations, total_combinations)
-
-		# Assume that any pair with NAN values are the maximum possible distance from each other.
-		try:
-			maximum_distance = max(filter(lambda s: not math.isnan(s), pair_array.values()))
-		except ValueError:
-			# Usually cause by max() being used on an empty sequence.
+			pair_combinations = widgets.get_pair_combinations(labels)
+			return self.calculate_pairwise_distances_serial(pair_combinations, len(out), out)
+
+	def calculate_missing_distances(self, labels: List[str], out: numpy.ndarray, found: numpy.ndarray) -> numpy.ndarray:
+		""" Only calculates the distances in `out` which were not `found`, one row of the condensed matrix at a time."""
+		values = self.trajectories.loc[labels].values.astype(float)
+		total = len(labels)
+		vectorized = self.use_vectorized_engine()
+		for row in range(total - 1):
+			start = distance_kernels.get_row_offset(total, row)
+			stop = start + total - row - 1
+			missing = ~found[start:stop]
+			if not missing.any():
+				continue
+			columns = numpy.arange(row + 1, total)[missing]
+			if vectorized:
+				row_values = distance_kernels.distance_columns(values, self.states, row, columns, self.metric)
+			else:
+				row_values = [calculate_distance(self, (labels[row], labels[column]), self.trajectories)[1] for column in columns]
+			out[start:stop][missing] = row_values
+		return out
+
+	def calculate_previous_distances(self, labels: List[str], out: numpy.ndarray, hashes: numpy.ndarray,
+			previous: CondensedDistanceCache) -> numpy.ndarray:
+		"""
+			Copies the distances between the trajectories which have not changed since `previous` was calculated, and only
+			calculates the distances involving new or modified trajectories. The pairs which could not be calculated
+			previously are `nan` again, so that they can be assigned the new maximum distance.
+		"""
+		changed = set(previous.get_changed_labels(labels, hashes))
+		# The position of each trajectory in `previous`, or -1 if the distances need to be calculated.
+		previous_positions = numpy.array([-1 if label in changed else previous.index[label] for label in labels], dtype = numpy.int64)
+		total_reused = int((previous_positions >= 0).sum())
+		logger.info(f"Reusing the distances between {total_reused} trajectories. Calculating the distances for {len(changed)} new or modified trajectories.")
+		if total_reused < 2:
+			return self.calculate_all_distances(labels, out)
+
+		previous_missing = previous.get_missing()
+		if previous_missing is None:
+			# Older distance matrices did not record which pairs were missing. Those pairs have the maximum distance.
+			logger.warning(f"The previous distances do not record which pairs could not be calculated. Assuming every pair with the maximum distance could not be calculated.")
+			previous_missing = ~(previous.array < distance_memmap.get_maximum(previous.array))
+
+		total = len(labels)
+		total_previous = len(previous.labels)
+		found = numpy.zeros(len(out), dtype = bool)
+		for row in range(total - 1):
+			if previous_positions[row] < 0:
+				continue
+			start = distance_kernels.get_row_offset(total, row)
+			stop = start + total - row - 1
+			columns = previous_positions[row + 1:]
+			is_known = columns >= 0
+			i = numpy.minimum(previous_positions[row], columns[is_known])
+			j = numpy.maximum(previous_positions[row], columns[is_known])
+			positions = distance_kernels.get_condensed_index(total_previous, i, j)
+			out[start:stop][is_known] = numpy.where(previous_missing[positions], numpy.nan, previous.array[positions])
+			found[start:stop] = is_known
+		return self.calculate_missing_distances(labels, out, found)
+
+	def calculate_stored_distances(self, labels: List[str], out: numpy.ndarray, hashes: numpy.ndarray) -> numpy.ndarray:
+		""" Reads the known distances from `self.distance_store` and only calculates the missing distances."""
+		found = self.distance_store.read(hashes, self.parameters, out)
+		total_found = int(found.sum())
+		logger.info(
+			f"Found {total_found} of {len(found)} pairwise distances in '{self.distance_store.filename}' ({len(found) - total_found} missing).")
+
+		if total_found == 0:
+			out = self.calculate_all_distances(labels, out)
+			self.distance_store.write(hashes, self.parameters, out)
+		elif total_found < len(found):
+			out = self.calculate_missing_distances(labels, out, found)
+			self.distance_store.write(hashes, self.parameters, out, found)
+		logger.debug(f"Distance cache: {self.distance_store.hits} hits, {self.distance_store.misses} misses.")
+		return out
+
+	def get_candidate_pairs(self, labels: List[str], block_elements: int = distance_kernels.DEFAULT_BLOCK_ELEMENTS) -> Iterator[Tuple[int, numpy.ndarray]]:
+		"""
+			Yields each row of the condensed distance matrix along with the columns which may be within `self.prune_cutoff`
+			of that row. Every other pair has a lower bound (see `distance_kernels.binomial_lower_bound_block`) larger than the cutoff.
+		"""
+		total = len(labels)
+		if self.metric != 'binomial' or self.prune_cutoff is None:
+			if self.prune_cutoff is not None:
+				logger.info(f"Cannot skip any pairs with the '{self.metric}' metric. Calculating every pairwise distance...")
+			for row in range(total - 1):
+				yield row, numpy.arange(row + 1, total)
+			return
+		# Allow for rounding errors, since the lower bound is calculated differently than the distance itself.
+		threshold = self.prune_cutoff + 1E-9 * max(1.0, abs(self.prune_cutoff))
+		prefix = distance_kernels.get_prefix_sums(self.trajectories.loc[labels].values)
+		block_size = distance_kernels._get_row_block_size(total, 4, block_elements)
+		for row_start in range(0, total - 1, block_size):
+			row_stop = min(row_start + block_size, total - 1)
+			bounds = distance_kernels.binomial_lower_bound_block(prefix, self.states, slice(row_start, row_stop), slice(row_start + 1, total))
+			for row in range(row_start, row_stop):
+				row_bounds = bounds[row - row_start, row - row_start:]
+				yield row, numpy.arange(row + 1, total)[~(row_bounds > threshold)]
+
+	def calculate_sparse_distances(self, labels: List[str]) -> SparseDistanceCache:
+		""" Only calculates the distances which may be within `self.prune_cutoff`. The other pairs are assigned a distance larger than the cutoff."""
+		total = len(labels)
+		total_combinations = widgets.calculate_number_of_combinations(total)
+		values = self.trajectories.loc[labels].values.astype(float)
+		vectorized = self.use_vectorized_engine()
+		rows, columns, distances = list(), list(), list()
+		total_calculated = 0
+		for row, candidates in self.get_candidate_pairs(labels):
+			if len(candidates) == 0:
+				continue
+			if vectorized:
+				row_values = distance_kernels.distance_columns(values, self.states, row, candidates, self.metric)
+			else:
+				row_values = numpy.array([calculate_distance(self, (labels[row], labels[column]), self.trajectories)[1] for column in candidates], dtype = float)
+			total_calculated += len(candidates)
+			# The pairs which could not be calculated are treated the same as the skipped pairs.
+			is_valid = ~numpy.isnan(row_values)
+			rows.append(numpy.full(is_valid.sum(), row))
+			columns.append(candidates[is_valid])
+			distances.append(row_values[is_valid])
+
+		distances = numpy.concatenate(distances) if distances else numpy.empty(0)
+		if len(distances) == 0:
 			message = f"Could not calculate the pairwise distances due to invalid series (usually because all measurements are below the detectionlimit"
 			raise ValueError(message)
+		total_pruned = total_combinations - total_calculated
+		logger.info(f"Skipped {total_pruned} of {total_combinations} pairwise distances ({total_pruned / total_combinations:.1%}).")
 
-		pair_array = {k: (v if not math.isnan(v) else maximum_distance) for k, v in pair_array.items()}
+		far = float(distances.max())
+		if total_pruned and self.prune_cutoff is not None:
+			far = max(far, float(numpy.nextafter(self.prune_cutoff, math.inf)))
+		return SparseDistanceCache(labels, numpy.concatenate(rows), numpy.concatenate(columns), distances, far,
+			parameters = self.parameters, total_pruned = total_pruned)
 
-		return pair_array
+	def calculate_pairwise_distances(self, labels: List[str]) -> Dict[Tuple[str, str], float]:
+		""" Same as `calculate_condensed_distances`, but returns a dictionary with both the forward and reverse key of each pair."""
+		return self._to_pair_array(labels, self.calculate_condensed_distances(labels))
+
+	def _prepare(self, trajectories: pandas.DataFrame):
+		logger.debug("Calculating the pairwise values...")
+		logger.debug(f"\t detection limit: {self.detection_limit}")
+		logger.debug(f"\t fixed limit: {self.fixed_limit}")
+		logger.debug(f"\t metric: {self.metric}")
+		logger.debug(f"\t threads: {self.threads}")
+		logger.debug(f"\t engine: {self.engine}")
+
+		self.trajectories = trajectories
+		self.states = TrajectoryStates.from_table(trajectories, self.detection_limit, self.fixed_limit)
 
 	def run(self, trajectories: pandas.DataFrame) -> Dict[Tuple[str, str], float]:
 		"""
@@ -115,18 +365,53 @@ class DistanceCalculator:
 		----------
 		trajectories
 		"""
-		logger.debug("Calculating the pairwise values...")
-		logger.debug(f"\t detection limit: {self.detection_limit}")
-		logger.debug(f"\t fixed limit: {self.fixed_limit}")
-		logger.debug(f"\t metric: {self.metric}")
-		logger.debug(f"\t threads: {self.threads}")
-
-		self.trajectories = trajectories
+		self._prepare(trajectories)
 
 		pairwise_distances = self.calculate_pairwise_distances(trajectories.index)
 
 		return pairwise_distances
 
+	def run_condensed(self, trajectories: pandas.DataFrame, dtype = numpy.float64,
+			previous: Optional[CondensedDistanceCache] = None) -> CondensedDistanceCache:
+		"""
+			Same as `run`, but stores the distances in a `CondensedDistanceCache`, which only requires `dtype` bytes per pair.
+			The cache is backed by the memmap file when using the out-of-core mode.
+			When `previous` is given (usually the distances from an earlier run on the same population), only the distances
+			involving new or modified trajectories are calculated.
+		"""
+		self._prepare(trajectories)
+		labels = list(trajectories.index)
+		condensed = self.calculate_condensed_distances(labels, dtype, previous)
+
+		cache = CondensedDistanceCache(labels, condensed, dtype = dtype, parameters = self.parameters,
+			hashes = self.hashes, missing = self.missing)
+		cache.out_of_core = self.filename_memmap is not None
+		return cache
+
+	def calculate_self_distances(self, trajectories: pandas.DataFrame) -> numpy.ndarray:
+		"""
+			Calculates the distance between each trajectory and an identical copy of itself. This is 0 for most trajectories,
+			but the pearson correlation is undefined for trajectories which are constant within their comparison window, so
+			the 'pearson' and 'combined' metrics may give other values.
+		"""
+		self._prepare(trajectories)
+		if self.use_vectorized_engine():
+			values = trajectories.values
+			return numpy.array([
+				distance_kernels.distance_columns(values, self.states, position, [position], self.metric)[0]
+				for position in range(len(values))
+			], dtype = float)
+		return numpy.array([calculate_distance(self, (label, label), trajectories)[1] for label in trajectories.index], dtype = float)
+
+	def run_sparse(self, trajectories: pandas.DataFrame) -> SparseDistanceCache:
+		"""
+			Same as `run_condensed`, but skips the pairs which are provably further apart than `self.prune_cutoff`. Only the
+			binomial metric can be bounded, so every pair is calculated with the other metrics.
+			The fraction of pairs which were skipped is available as `SparseDistanceCache.prune_ratio`.
+		"""
+		self._prepare(trajectories)
+		return self.calculate_sparse_distances(list(trajectories.index))
+
 
 def get_pair_category(left: pandas.Series, right: pandas.Series, dlimit: float, flimit: float) -> str:
 	"""
@@ -278,9 +563,18 @@ def calculate_distance(process: DistanceCalculator, element: Tuple[str, str], tr
 	# For now, lets require that both timepoints are detected and not yet fixed.
 	# There is an issue related to comparing fixed genotypes against non-fixed genotypes.
 
-	left_reduced, right_reduced = filter_timepoints(
-		left_trajectory, right_trajectory, process.detection_limit, process.fixed_limit
-	)
+	if process.states is None:
+		left_reduced, right_reduced = filter_timepoints(
+			left_trajectory, right_trajectory, process.detection_limit, process.fixed_limit
+		)
+	else:
+		# Use the precomputed trajectory states rather than re-categorizing the pair.
+		window = process.states.get_pair_window(left, right)
+		if window is None:
+			left_reduced = right_reduced = None
+		else:
+			left_reduced = left_trajectory.iloc[window]
+			right_reduced = right_trajectory.iloc[window]
 
 	if left_reduced is None or right_reduced is None:
 		# Treat both trajectories as fixed immediately.
@@ -0,0 +1,232 @@
+"""
+	Array-based implementations of the pairwise distance calculations. These operate on the entire trajectory table at once
+	rather than on individual pairs of pandas.Series objects, and produce the condensed distance vector expected by
+	`scipy.spatial.distance.squareform` (i.e. the pairs are ordered as `itertools.combinations(labels, 2)`).
+"""
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy
+
+try:
+	from muller.clustering.metrics.trajectory_states import CATEGORY_ONLY_FIXED, TrajectoryStates
+except ModuleNotFoundError:
+	from .trajectory_states import CATEGORY_ONLY_FIXED, TrajectoryStates
+
+# Used to limit the size of the temporary arrays generated for each block of rows. Roughly 8 bytes per element.
+DEFAULT_BLOCK_ELEMENTS = 2 ** 22
+
+
+def get_condensed_index(n: int, i: int, j: int) -> int:
+	""" Returns the position of the pair (`i`, `j`) in the condensed distance vector of `n` elements. Assumes `i` < `j`."""
+	return n * i - (i * (i + 1)) // 2 + (j - i - 1)
+
+
+def get_row_offset(n: int, row: int) -> int:
+	""" Returns the position in the condensed distance vector where the pairs of `row` begin."""
+	return n * row - (row * (row + 1)) // 2
+
+
+def _get_row_block_size(total_columns: int, total_timepoints: int, block_elements: int) -> int:
+	return max(1, block_elements // max(1, total_columns * total_timepoints))
+
+
+def _get_window(states: TrajectoryStates, rows, columns, timepoints: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+	""" Returns the category of every combination of `rows` and `columns` along with a mask of the timepoints compared for each pair."""
+	categories = states.categorize(rows, columns)
+	window_start, window_stop = states.windows(rows, columns, categories)
+	window = (timepoints >= window_start[..., None]) & (timepoints <= window_stop[..., None])
+	return categories, window
+
+
+def _binomial_distance_block(left: numpy.ndarray, right: numpy.ndarray, window: numpy.ndarray) -> numpy.ndarray:
+	""" Equivalent to `distance_methods.binomial_distance` for every pair of `left` and `right` within `window`."""
+	window_length = window.sum(axis = 2)
+	mean = (left + right) / 2
+	sigma = numpy.where(window, mean * (1 - mean), 0).sum(axis = 2)
+	difference = numpy.where(window, numpy.abs(left - right), 0).sum(axis = 2)
+
+	with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+		sigma_pair = sigma / window_length ** 2
+		difference_mean = difference / window_length
+		return difference_mean / numpy.sqrt(2 * sigma_pair)
+
+
+def _pearson_distance_block(left: numpy.ndarray, right: numpy.ndarray, window: numpy.ndarray) -> numpy.ndarray:
+	"""
+		Equivalent to `distance_methods.pearson_correlation_distance` for every pair of `left` and `right` within `window`.
+		As with `pandas.Series.corr`, timepoints where either trajectory is `nan` are ignored.
+	"""
+	window_length = window.sum(axis = 2)
+	valid = window & ~numpy.isnan(left) & ~numpy.isnan(right)
+	total_valid = valid.sum(axis = 2)
+	with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+		left_mean = numpy.where(valid, left, 0).sum(axis = 2) / total_valid
+		right_mean = numpy.where(valid, right, 0).sum(axis = 2) / total_valid
+		left_centered = numpy.where(valid, left - left_mean[..., None], 0)
+		right_centered = numpy.where(valid, right - right_mean[..., None], 0)
+		covariance = (left_centered * right_centered).sum(axis = 2)
+		variance = (left_centered ** 2).sum(axis = 2) * (right_centered ** 2).sum(axis = 2)
+		pcc = numpy.where(total_valid > 1, covariance / numpy.sqrt(variance), numpy.nan)
+		# Same as `distance_methods.adjust_correlation_coefficient`, which uses the number of timepoints in the window.
+		adjusted_pcc = pcc * (1 + (1 - pcc ** 2) / (2 * window_length))
+	return 1 - adjusted_pcc
+
+
+def _minkowski_distance_block(left: numpy.ndarray, right: numpy.ndarray, window: numpy.ndarray, p: int = 2) -> numpy.ndarray:
+	""" Equivalent to `distance_methods.minkowski_distance` for every pair of `left` and `right` within `window`."""
+	total = numpy.where(window, numpy.abs(left - right) ** p, 0).sum(axis = 2)
+	return total ** (1 / p)
+
+
+def _combined_distance_block(left: numpy.ndarray, right: numpy.ndarray, window: numpy.ndarray) -> numpy.ndarray:
+	""" Equivalent to the 'combined' metric in `distance_methods.calculate_distance`."""
+	return 2 * _pearson_distance_block(left, right, window) + _minkowski_distance_block(left, right, window, 2)
+
+
+# The metrics which have an array-based implementation. Each function takes the left and right trajectories, broadcast
+# against each other, and the mask of the timepoints to compare.
+DISTANCE_BLOCKS: Dict[str, Callable[[numpy.ndarray, numpy.ndarray, numpy.ndarray], numpy.ndarray]] = {
+	'binomial': _binomial_distance_block,
+	'pearson': _pearson_distance_block,
+	'minkowski': _minkowski_distance_block,
+	'combined': _combined_distance_block
+}
+VECTORIZED_METRICS = list(DISTANCE_BLOCKS)
+
+
+def _distance_block(values: numpy.ndarray, states: TrajectoryStates, rows, columns, timepoints: numpy.ndarray,
+		metric: str = 'binomial') -> numpy.ndarray:
+	""" Calculates the distance between every combination of `rows` and `columns`, which may be any valid numpy index."""
+	if metric not in DISTANCE_BLOCKS:
+		message = f"'{metric}' does not have an array-based implementation. Expected one of {VECTORIZED_METRICS}"
+		raise ValueError(message)
+	left = values[rows, None, :]
+	right = values[None, columns, :]
+	categories, window = _get_window(states, rows, columns, timepoints)
+	block = DISTANCE_BLOCKS[metric](left, right, window)
+	return numpy.where(categories == CATEGORY_ONLY_FIXED, states.fixed_overlap(rows, columns), block)
+
+
+def get_prefix_sums(values: numpy.ndarray) -> numpy.ndarray:
+	""" Returns the cumulative sum of each row of `values`, starting with 0, so the sum of any window is the difference of two elements."""
+	values = numpy.asarray(values, dtype = float)
+	return numpy.concatenate([numpy.zeros((len(values), 1)), numpy.cumsum(values, axis = 1)], axis = 1)
+
+
+def binomial_lower_bound_block(prefix: numpy.ndarray, states: TrajectoryStates, rows, columns) -> numpy.ndarray:
+	"""
+		Calculates a lower bound of the binomial distance between every combination of `rows` and `columns` using only
+		the total frequency of each trajectory within the window of timepoints compared for each pair.
+		Within a window of `n` timepoints, where the trajectories sum to `a` and `b` and the mean trajectory sums to `m`,
+			sum(|left - right|) >= |a - b|
+			sum(mean * (1 - mean)) <= m - m**2 / n
+		so the distance is at least |a - b| / sqrt(2 * (m - m**2 / n)). Pairs which can't be bounded this way (such as pairs
+		which were only ever fixed, or with empty windows) are `nan`.
+	Parameters
+	----------
+	prefix: numpy.ndarray
+		The prefix sums of the trajectory table, from `get_prefix_sums`.
+	states: TrajectoryStates
+	rows, columns
+		Any valid numpy index.
+	"""
+	total_timepoints = prefix.shape[1] - 1
+	categories = states.categorize(rows, columns)
+	window_start, window_stop = states.windows(rows, columns, categories)
+	window_length = window_stop - window_start + 1
+	start = numpy.clip(window_start, 0, total_timepoints)
+	stop = numpy.clip(window_stop + 1, 0, total_timepoints)
+
+	left = prefix[rows][:, None, :]
+	right = prefix[columns][None, :, :]
+	left_sum = numpy.take_along_axis(left, stop[..., None], axis = 2)[..., 0] - numpy.take_along_axis(left, start[..., None], axis = 2)[..., 0]
+	right_sum = numpy.take_along_axis(right, stop[..., None], axis = 2)[..., 0] - numpy.take_along_axis(right, start[..., None], axis = 2)[..., 0]
+
+	with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+		mean_sum = (left_sum + right_sum) / 2
+		sigma = 2 * (mean_sum - mean_sum ** 2 / window_length)
+		bound = numpy.abs(left_sum - right_sum) / numpy.sqrt(sigma)
+	is_bounded = (categories != CATEGORY_ONLY_FIXED) & (window_length > 0) & (sigma > 0)
+	return numpy.where(is_bounded, bound, numpy.nan)
+
+
+def distance_columns(values: numpy.ndarray, states: TrajectoryStates, row: int, columns: numpy.ndarray, metric: str = 'binomial') -> numpy.ndarray:
+	""" Calculates the distance between the trajectory at `row` and each trajectory in `columns`."""
+	timepoints = numpy.arange(values.shape[1])
+	return _distance_block(values, states, slice(row, row + 1), numpy.asarray(columns), timepoints, metric)[0]
+
+
+def distance_rows(values: numpy.ndarray, states: TrajectoryStates, row_start: int, row_stop: int,
+		block_elements: int = DEFAULT_BLOCK_ELEMENTS, out: Optional[numpy.ndarray] = None, metric: str = 'binomial') -> numpy.ndarray:
+	"""
+		Calculates the distance between each trajectory in rows [`row_start`, `row_stop`) and every trajectory after it.
+		The result is the corresponding section of the condensed distance vector, which starts at
+		`get_row_offset(len(values), row_start)`. The section is written to `out` if given.
+	"""
+	total_trajectories, total_timepoints = values.shape
+	row_stop = min(row_stop, total_trajectories - 1)
+	total_pairs = get_row_offset(total_trajectories, row_stop) - get_row_offset(total_trajectories, row_start)
+	result = numpy.empty(max(0, total_pairs), dtype = float) if out is None else out
+	timepoints = numpy.arange(total_timepoints)
+
+	block_size = _get_row_block_size(total_trajectories - row_start, total_timepoints, block_elements)
+	position = 0
+	for start in range(row_start, row_stop, block_size):
+		stop = min(start + block_size, row_stop)
+		block = _distance_block(values, states, slice(start, stop), slice(start + 1, total_trajectories), timepoints, metric)
+
+		# Only keep the upper triangle of the block, in condensed order.
+		for offset, row in enumerate(range(start, stop)):
+			row_values = block[offset, row - start:]
+			result[position:position + len(row_values)] = row_values
+			position += len(row_values)
+
+	return result
+
+
+def distance_matrix(values: numpy.ndarray, dlimit: float, flimit: float, metric: str = 'binomial',
+		block_elements: int = DEFAULT_BLOCK_ELEMENTS, states: Optional[TrajectoryStates] = None,
+		out: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+	"""
+		Calculates the distance between every pair of trajectories. Equivalent to running
+		`distance_calculator.calculate_distance` on every pair of rows in `values`.
+	Parameters
+	----------
+	values: numpy.ndarray
+		A 2D array of frequencies, with one row per trajectory and one column per timepoint. The columns should be sorted.
+	dlimit, flimit: float
+		The detection and fixed limits.
+	metric: str
+		One of `VECTORIZED_METRICS`.
+	block_elements: int
+		Approximate number of elements to allocate for each block of rows.
+	states: Optional[TrajectoryStates]
+		The precomputed states of each trajectory in `values`. Generated from `values` if not given.
+	out: Optional[numpy.ndarray]
+		An array (such as a `numpy.memmap`) to write the distances to, one block at a time. Should have one element per pair.
+
+	Returns
+	-------
+	numpy.ndarray
+		The condensed distance vector. Pairs which could not be compared are `nan`.
+	"""
+	values = numpy.asarray(values, dtype = float)
+	if states is None:
+		states = TrajectoryStates(values, dlimit, flimit)
+	return distance_rows(values, states, 0, len(values) - 1, block_elements, out, metric)
+
+
+def binomial_distance_columns(values: numpy.ndarray, states: TrajectoryStates, row: int, columns: numpy.ndarray) -> numpy.ndarray:
+	return distance_columns(values, states, row, columns, 'binomial')
+
+
+def binomial_distance_rows(values: numpy.ndarray, states: TrajectoryStates, row_start: int, row_stop: int,
+		block_elements: int = DEFAULT_BLOCK_ELEMENTS, out: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+	return distance_rows(values, states, row_start, row_stop, block_elements, out, 'binomial')
+
+
+def binomial_distance_matrix(values: numpy.ndarray, dlimit: float, flimit: float,
+		block_elements: int = DEFAULT_BLOCK_ELEMENTS, states: Optional[TrajectoryStates] = None,
+		out: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+	""" Same as `distance_matrix` with the binomial metric."""
+	return distance_matrix(values, dlimit, flimit, 'binomial', block_elements, states, out)
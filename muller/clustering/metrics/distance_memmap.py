@@ -0,0 +1,131 @@
+"""
+	Helpers to store and summarize condensed distance vectors which are too large to fit in memory. The vector is kept in a
+	`numpy.memmap` file and every function here only reads one chunk of it at a time, so the memory used does not depend on
+	the number of pairs. The functions also work on regular numpy arrays.
+"""
+import math
+from pathlib import Path
+from typing import Iterator, Tuple
+
+import numpy
+
+# The number of values read from the vector at once. 2**24 float64 values take 128MB.
+DEFAULT_CHUNK_SIZE = 2 ** 24
+# The number of bins used to narrow down the location of an order statistic on each pass over the vector.
+TOTAL_SELECTION_BINS = 4096
+
+
+def create_distance_memmap(filename: Path, total_pairs: int, dtype = numpy.float64, header: bytes = b'') -> numpy.ndarray:
+	"""
+		Creates (or overwrites) a file large enough to hold `total_pairs` distances and maps it into memory. The distances
+		are placed after `header`, if given.
+	"""
+	filename = Path(filename)
+	filename.parent.mkdir(parents = True, exist_ok = True)
+	with filename.open('wb') as output:
+		output.write(header)
+	if total_pairs == 0:
+		# `numpy.memmap` cannot map an empty region of a file.
+		return numpy.empty(0, dtype = dtype)
+	# `numpy.memmap` extends the file to the required size.
+	return numpy.memmap(filename, dtype = dtype, mode = 'r+', offset = len(header), shape = (total_pairs,))
+
+
+def iterate_chunks(total: int, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[slice]:
+	for start in range(0, total, chunk_size):
+		yield slice(start, min(start + chunk_size, total))
+
+
+def get_maximum(condensed: numpy.ndarray, chunk_size: int = DEFAULT_CHUNK_SIZE) -> float:
+	""" Returns the largest value in `condensed`, ignoring `nan`. Returns `nan` if there are no other values."""
+	maximum = -math.inf
+	for chunk in iterate_chunks(len(condensed), chunk_size):
+		values = condensed[chunk]
+		values = values[~numpy.isnan(values)]
+		if len(values):
+			maximum = max(maximum, float(values.max()))
+	return maximum if maximum != -math.inf else math.nan
+
+
+def replace_nan(condensed: numpy.ndarray, value: float, chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+	""" Replaces every `nan` in `condensed` with `value`, in place. Returns the number of values replaced."""
+	total = 0
+	for chunk in iterate_chunks(len(condensed), chunk_size):
+		values = condensed[chunk]
+		is_nan = numpy.isnan(values)
+		if is_nan.any():
+			values[is_nan] = value
+			total += int(is_nan.sum())
+	return total
+
+
+def get_nan_mask(condensed: numpy.ndarray, chunk_size: int = DEFAULT_CHUNK_SIZE) -> numpy.ndarray:
+	""" Returns a bitmask of the `nan` values in `condensed`, packed with `numpy.packbits`."""
+	# Each chunk has to fill a whole number of bytes.
+	chunk_size = max(8, chunk_size - chunk_size % 8)
+	mask = numpy.empty((len(condensed) + 7) // 8, dtype = numpy.uint8)
+	for chunk in iterate_chunks(len(condensed), chunk_size):
+		mask[chunk.start // 8:(chunk.stop + 7) // 8] = numpy.packbits(numpy.isnan(condensed[chunk]))
+	return mask
+
+
+def count_between(condensed: numpy.ndarray, lower: float, upper: float, chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+	""" Counts the values which are strictly between `lower` and `upper`."""
+	total = 0
+	for chunk in iterate_chunks(len(condensed), chunk_size):
+		values = condensed[chunk]
+		total += int(numpy.count_nonzero((values > lower) & (values < upper)))
+	return total
+
+
+def _scan_range(condensed: numpy.ndarray, start: float, stop: float, edges: numpy.ndarray, limit: int,
+		chunk_size: int) -> Tuple[numpy.ndarray, numpy.ndarray]:
+	"""
+		Counts the values in [`start`, `stop`) within each bin defined by `edges`. The values themselves are also returned
+		if there are no more than `limit` of them. Otherwise, an empty array is returned.
+	"""
+	counts = numpy.zeros(len(edges) - 1, dtype = numpy.int64)
+	candidates = list()
+	total = 0
+	for chunk in iterate_chunks(len(condensed), chunk_size):
+		values = condensed[chunk]
+		values = values[(values >= start) & (values < stop)]
+		if len(values) == 0:
+			continue
+		total += len(values)
+		bins = numpy.clip(numpy.searchsorted(edges, values, side = 'right') - 1, 0, len(counts) - 1)
+		counts += numpy.bincount(bins, minlength = len(counts))
+		if total <= limit:
+			candidates.append(numpy.array(values, dtype = float))
+		else:
+			candidates = list()
+	if total > limit or not candidates:
+		return counts, numpy.empty(0)
+	return counts, numpy.concatenate(candidates)
+
+
+def get_order_statistic(condensed: numpy.ndarray, rank: int, lower: float, upper: float,
+		chunk_size: int = DEFAULT_CHUNK_SIZE) -> float:
+	"""
+		Returns the `rank`th smallest value (starting from 0) out of the values in `condensed` which are strictly between
+		`lower` and `upper`. This is exact, and equivalent to `numpy.sort(values)[rank]`. Each pass over `condensed` narrows
+		the range of values which can contain the result until the remaining values fit in a single chunk.
+	"""
+	start = numpy.nextafter(lower, math.inf)
+	stop = upper
+	while True:
+		if numpy.nextafter(start, math.inf) >= stop:
+			# The only value left in the range is `start`.
+			return float(start)
+		edges = numpy.linspace(start, stop, TOTAL_SELECTION_BINS + 1)
+		counts, candidates = _scan_range(condensed, start, stop, edges, chunk_size, chunk_size)
+		if rank >= counts.sum():
+			message = f"Cannot select value {rank} out of {counts.sum()} values between {lower} and {upper}."
+			raise ValueError(message)
+		if len(candidates):
+			return float(numpy.partition(candidates, rank)[rank])
+		cumulative = numpy.cumsum(counts)
+		index = int(numpy.searchsorted(cumulative, rank, side = 'right'))
+		if index > 0:
+			rank -= int(cumulative[index - 1])
+		start, stop = edges[index], edges[index + 1]
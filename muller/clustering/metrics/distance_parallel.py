@@ -0,0 +1,216 @@
+"""
+	Calculates the condensed distance vector with a pool of processes. The trajectory table is copied into shared memory
+	once, and each worker writes the distances for a block of rows of the condensed matrix directly into a shared
+	output buffer (or a `numpy.memmap` file). This avoids pickling the trajectory table or the individual results for every pair.
+"""
+import math
+import multiprocessing
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy
+import pandas
+from tqdm import tqdm
+
+try:
+	from muller.clustering.metrics import distance_kernels
+	from muller.clustering.metrics.trajectory_states import TrajectoryStates
+except ModuleNotFoundError:
+	from . import distance_kernels
+	from .trajectory_states import TrajectoryStates
+
+# Splitting the work into several blocks per process keeps the processes busy when some blocks take longer than others.
+BLOCKS_PER_PROCESS = 8
+
+SharedArrayType = Tuple[str, Tuple[int, ...], str]  # The name, shape and dtype of an array in shared memory.
+
+# Populated in each worker process by `_initialize_worker`.
+_worker_data: Dict[str, Any] = dict()
+
+
+def get_row_blocks(total_rows: int, total_blocks: int) -> List[Tuple[int, int]]:
+	"""
+		Splits the rows of a condensed distance matrix into contiguous [start, stop) blocks containing a similar number of pairs.
+		Earlier rows contain more pairs than later rows, so the earlier blocks contain fewer rows.
+	"""
+	total_pairs = total_rows * (total_rows - 1) // 2
+	pairs_per_block = max(1, math.ceil(total_pairs / max(1, total_blocks)))
+	blocks = list()
+	block_start = 0
+	block_pairs = 0
+	for row in range(total_rows - 1):
+		block_pairs += total_rows - row - 1
+		if block_pairs >= pairs_per_block:
+			blocks.append((block_start, row + 1))
+			block_start = row + 1
+			block_pairs = 0
+	if block_start < total_rows - 1:
+		blocks.append((block_start, total_rows - 1))
+	return blocks
+
+
+def _create_shared_array(shape: Tuple[int, ...], dtype = float) -> Tuple[Any, numpy.ndarray]:
+	# `multiprocessing.shared_memory` requires python 3.8, so it is only imported when the distances are calculated in parallel.
+	from multiprocessing import shared_memory
+	size = max(1, int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize)
+	memory = shared_memory.SharedMemory(create = True, size = size)
+	array = numpy.ndarray(shape, dtype = dtype, buffer = memory.buf)
+	return memory, array
+
+
+def _attach_shared_array(name: str, shape: Tuple[int, ...], dtype: str) -> Tuple[Any, numpy.ndarray]:
+	from multiprocessing import shared_memory
+	# The worker processes share the resource tracker of the parent process, which unlinks the memory once all blocks are done.
+	memory = shared_memory.SharedMemory(name = name)
+	array = numpy.ndarray(shape, dtype = dtype, buffer = memory.buf)
+	return memory, array
+
+
+def _attach_memmap(filename: str, shape: Tuple[int, ...], dtype: str, offset: int) -> Tuple[None, numpy.ndarray]:
+	return None, numpy.memmap(filename, dtype = dtype, mode = 'r+', offset = offset, shape = shape)
+
+
+def _initialize_worker(values_info: SharedArrayType, output_info: SharedArrayType, labels: Sequence[str], columns: Sequence[Any],
+		dlimit: float, flimit: float, metric: str, vectorized: bool, output_is_memmap: bool = False):
+	values_memory, values = _attach_shared_array(*values_info)
+	if output_is_memmap:
+		output_memory, output = _attach_memmap(*output_info)
+	else:
+		output_memory, output = _attach_shared_array(*output_info)
+	states = TrajectoryStates(values, dlimit, flimit, labels)
+
+	if vectorized:
+		calculator = None
+		trajectories = None
+	else:
+		# Imported here to avoid a circular import.
+		try:
+			from muller.clustering.metrics.distance_calculator import DistanceCalculator
+		except ModuleNotFoundError:
+			from .distance_calculator import DistanceCalculator
+		calculator = DistanceCalculator(dlimit, flimit, metric, engine = 'pairwise')
+		calculator.states = states
+		trajectories = pandas.DataFrame(values, index = labels, columns = columns, copy = False)
+		calculator.trajectories = trajectories
+
+	_worker_data.update(
+		values_memory = values_memory,
+		output_memory = output_memory,
+		values = values,
+		output = output,
+		states = states,
+		labels = labels,
+		metric = metric,
+		calculator = calculator,
+		trajectories = trajectories
+	)
+
+
+def _calculate_block(block: Tuple[int, int]) -> int:
+	""" Calculates the distances for the rows in `block` and writes them to the shared output. Returns the number of pairs calculated."""
+	# Imported here to avoid a circular import.
+	try:
+		from muller.clustering.metrics.distance_calculator import calculate_distance
+	except ModuleNotFoundError:
+		from .distance_calculator import calculate_distance
+	row_start, row_stop = block
+	values = _worker_data['values']
+	output = _worker_data['output']
+	total = len(values)
+	offset = distance_kernels.get_row_offset(total, row_start)
+
+	calculator = _worker_data['calculator']
+	if calculator is None:
+		segment = distance_kernels.distance_rows(values, _worker_data['states'], row_start, row_stop, metric = _worker_data['metric'])
+	else:
+		labels = _worker_data['labels']
+		trajectories = _worker_data['trajectories']
+		segment = [
+			calculate_distance(calculator, (labels[i], labels[j]), trajectories)[1]
+			for i in range(row_start, row_stop) for j in range(i + 1, total)
+		]
+	output[offset:offset + len(segment)] = segment
+	return len(segment)
+
+
+def calculate_distances_parallel(trajectories: pandas.DataFrame, dlimit: float, flimit: float, metric: str, processes: int,
+		vectorized: bool = True, progress_bar_minimum_points: Optional[int] = 10000, out: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+	"""
+		Calculates the distance between every pair of trajectories using `processes` worker processes.
+	Parameters
+	----------
+	trajectories: pandas.DataFrame
+		The trajectory table, with timepoints as columns.
+	dlimit, flimit: float
+	metric: str
+	processes: int
+		The number of worker processes.
+	vectorized: bool
+		Whether the workers should use the array-based kernels (only available for `distance_kernels.VECTORIZED_METRICS`).
+		Otherwise each pair in a block is calculated with `distance_calculator.calculate_distance`.
+	progress_bar_minimum_points: Optional[int]
+		The progress bar is only shown when there are at least this many pairs.
+	out: Optional[numpy.ndarray]
+		The array to write the distances to. If this is a `numpy.memmap`, the workers write to the file directly rather than
+		to shared memory.
+
+	Returns
+	-------
+	numpy.ndarray
+		The condensed distance vector, ordered as `itertools.combinations(trajectories.index, 2)`. This is `out` if given.
+	"""
+	labels = list(trajectories.index)
+	total_trajectories = len(labels)
+	total_pairs = total_trajectories * (total_trajectories - 1) // 2
+	if total_pairs == 0:
+		return numpy.empty(0) if out is None else out
+	values = trajectories.values.astype(float)
+
+	values_memory, shared_values = _create_shared_array(values.shape)
+	if isinstance(out, numpy.memmap):
+		output_memory = None
+		shared_output = out
+		output_info = (str(out.filename), (total_pairs,), out.dtype.str, out.offset)
+	else:
+		output_memory, shared_output = _create_shared_array((total_pairs,))
+		output_info = (output_memory.name, (total_pairs,), 'float64')
+	try:
+		shared_values[:] = values
+		values_info = (values_memory.name, values.shape, 'float64')
+
+		blocks = get_row_blocks(total_trajectories, processes * BLOCKS_PER_PROCESS)
+		use_progressbar = progress_bar_minimum_points is not None and total_pairs >= progress_bar_minimum_points
+		progress_bar = tqdm(total = total_pairs, disable = not use_progressbar)
+		pool = multiprocessing.Pool(
+			processes = processes,
+			initializer = _initialize_worker,
+			initargs = (values_info, output_info, labels, list(trajectories.columns), dlimit, flimit, metric, vectorized,
+				output_memory is None)
+		)
+		try:
+			for completed in pool.imap_unordered(_calculate_block, blocks):
+				progress_bar.update(completed)
+			pool.close()
+		except BaseException:
+			pool.terminate()
+			raise
+		finally:
+			pool.join()
+			progress_bar.close()
+
+		if output_memory is None:
+			result = shared_output
+		elif out is not None:
+			out[:] = shared_output
+			result = out
+		else:
+			result = shared_output.copy()
+	finally:
+		# The arrays need to be released before the shared memory can be closed.
+		del shared_values
+		del shared_output
+		values_memory.close()
+		values_memory.unlink()
+		if output_memory is not None:
+			output_memory.close()
+			output_memory.unlink()
+	return result
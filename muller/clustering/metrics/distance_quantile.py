@@ -0,0 +1,225 @@
+"""
+	Estimates the distance cutoff used to cluster trajectories, which is a quantile of the pairwise distances strictly between
+	0 and the maximum distance. The quantile is calculated as if each pair were included in both directions (as in
+	`DistanceCache.values`), so the cutoff does not depend on how the distances are stored.
+
+	The exact quantile uses `numpy.partition` when the condensed vector is in memory, and repeated passes over one chunk at a
+	time (see `distance_memmap.get_order_statistic`) when it is stored in a `numpy.memmap` file. The approximate quantile
+	reads each chunk once into a `TDigest`, which uses a fixed amount of memory regardless of the number of pairs.
+
+	When each element of the distance matrix stands for several identical trajectories, the distance between two elements
+	is counted once for each pair of trajectories they stand for (see `get_pair_weights`).
+"""
+import math
+from typing import List, Optional, Sequence
+
+import numpy
+
+try:
+	from muller.clustering.metrics import distance_memmap
+except ModuleNotFoundError:
+	from . import distance_memmap
+
+ACCEPTED_METHODS = ['exact', 'approximate']
+# Controls the number of centroids kept by `TDigest`. The digest holds at most about `compression / 2` centroids.
+DEFAULT_COMPRESSION = 1000
+# The number of values merged into the digest at once. Sorting small groups of values is much faster than sorting a whole chunk.
+BUFFER_SIZE = 2 ** 14
+
+
+class TDigest:
+	"""
+		A merging t-digest, which summarizes a stream of values as a small sorted set of weighted centroids. Centroids near
+		either tail hold fewer values than centroids near the median, so small and large quantiles are estimated accurately.
+	Parameters
+	----------
+	compression: int
+		Larger values keep more centroids, which are more accurate but slower to merge.
+	"""
+
+	def __init__(self, compression: int = DEFAULT_COMPRESSION):
+		self.compression = compression
+		self.means = numpy.empty(0)
+		self.weights = numpy.empty(0)
+		self.minimum = math.inf
+		self.maximum = -math.inf
+
+	def __len__(self) -> int:
+		""" The number of values added to the digest."""
+		return int(self.weights.sum())
+
+	def update(self, values: numpy.ndarray, weights: Optional[numpy.ndarray] = None):
+		""" Adds each value in `values`, ignoring `nan`. `weights` is the number of times each value is repeated."""
+		values = numpy.asarray(values, dtype = float)
+		weights = numpy.ones(len(values)) if weights is None else numpy.asarray(weights, dtype = float)
+		is_valid = ~numpy.isnan(values)
+		values = values[is_valid]
+		weights = weights[is_valid]
+		if len(values) == 0:
+			return
+		self.minimum = min(self.minimum, float(values.min()))
+		self.maximum = max(self.maximum, float(values.max()))
+		for start in range(0, len(values), BUFFER_SIZE):
+			means = numpy.concatenate([self.means, values[start:start + BUFFER_SIZE]])
+			buffer_weights = numpy.concatenate([self.weights, weights[start:start + BUFFER_SIZE]])
+			self._compress(means, buffer_weights)
+
+	def _compress(self, means: numpy.ndarray, weights: numpy.ndarray):
+		order = numpy.argsort(means, kind = 'stable')
+		means = means[order]
+		weights = weights[order]
+		total = weights.sum()
+		# Each centroid covers at most one unit of the scale function k(q) = compression / (2 * pi) * asin(2q - 1), which changes
+		# quickly near q = 0 and q = 1. k(q) is monotonic, so the members of each centroid are next to each other.
+		quantiles = (numpy.cumsum(weights) - weights / 2) / total
+		scale = self.compression / (2 * math.pi) * numpy.arcsin(numpy.clip(2 * quantiles - 1, -1, 1))
+		groups = numpy.floor(scale - scale[0]).astype(numpy.int64)
+		starts = numpy.flatnonzero(numpy.diff(groups, prepend = -1))
+		self.weights = numpy.add.reduceat(weights, starts)
+		self.means = numpy.add.reduceat(means * weights, starts) / self.weights
+
+	def quantile(self, quantile: float) -> float:
+		""" Estimates the value at `quantile` by interpolating between the centroids. Returns `nan` if the digest is empty."""
+		total = self.weights.sum()
+		if total == 0:
+			return math.nan
+		centers = numpy.cumsum(self.weights) - self.weights / 2
+		positions = numpy.concatenate([[0], centers, [total]])
+		values = numpy.concatenate([[self.minimum], self.means, [self.maximum]])
+		return float(numpy.interp(quantile * total, positions, values))
+
+
+def _interpolate(values_at, quantiles: numpy.ndarray, total: int) -> numpy.ndarray:
+	"""
+		Same as the linear interpolation used by `pandas.Series.quantile` on the `total` values, where each value is repeated
+		twice. `values_at` should return the value at each of the given ranks (out of the values which are not repeated).
+	"""
+	positions = quantiles * (total - 1)
+	lower = numpy.floor(positions).astype(numpy.int64)
+	upper = numpy.minimum(lower + 1, total - 1)
+	fractions = positions - lower
+	ranks = numpy.unique(numpy.concatenate([lower // 2, upper // 2]))
+	values = dict(zip(ranks.tolist(), values_at(ranks)))
+	lower_values = numpy.array([values[i] for i in (lower // 2).tolist()], dtype = float)
+	upper_values = numpy.array([values[i] for i in (upper // 2).tolist()], dtype = float)
+	return lower_values + (upper_values - lower_values) * fractions
+
+
+def get_pair_weights(weights: numpy.ndarray, start: int, stop: int) -> numpy.ndarray:
+	"""
+		Returns the number of pairs of trajectories at each position [`start`, `stop`) of the condensed distance vector, where
+		`weights` is the number of identical trajectories each element of the distance matrix stands for.
+	"""
+	weights = numpy.asarray(weights, dtype = numpy.int64)
+	total = len(weights)
+	rows = numpy.arange(total, dtype = numpy.int64)
+	row_starts = total * rows - rows * (rows + 1) // 2
+	positions = numpy.arange(start, stop, dtype = numpy.int64)
+	lefts = numpy.searchsorted(row_starts, positions, side = 'right') - 1
+	rights = positions - row_starts[lefts] + lefts + 1
+	return weights[lefts] * weights[rights]
+
+
+def get_filtered_quantiles_weighted(condensed: numpy.ndarray, weights: numpy.ndarray, quantiles: numpy.ndarray,
+		chunk_size: int = distance_memmap.DEFAULT_CHUNK_SIZE) -> numpy.ndarray:
+	"""
+		Same as `get_filtered_quantiles_exact`, where each distance is repeated once for each pair of trajectories it stands
+		for. The filtered distances are held in memory, even if `condensed` is a `numpy.memmap`.
+	"""
+	maximum = distance_memmap.get_maximum(condensed, chunk_size)
+	values = list()
+	counts = list()
+	for chunk in distance_memmap.iterate_chunks(len(condensed), chunk_size):
+		chunk_values = numpy.asarray(condensed[chunk], dtype = float)
+		is_between = (chunk_values > 0) & (chunk_values < maximum)
+		values.append(chunk_values[is_between])
+		counts.append(get_pair_weights(weights, chunk.start, chunk.stop)[is_between])
+	values = numpy.concatenate(values) if values else numpy.empty(0)
+	counts = numpy.concatenate(counts) if counts else numpy.empty(0, dtype = numpy.int64)
+	order = numpy.argsort(values, kind = 'stable')
+	values = values[order]
+	cumulative = numpy.cumsum(counts[order])
+	total = 2 * int(cumulative[-1]) if len(cumulative) else 0
+
+	def values_at(ranks: numpy.ndarray) -> numpy.ndarray:
+		return values[numpy.searchsorted(cumulative, ranks, side = 'right')]
+
+	if total == 0:
+		return numpy.full(len(quantiles), math.nan)
+	return _interpolate(values_at, quantiles, total)
+
+
+def get_filtered_quantiles_exact(condensed: numpy.ndarray, quantiles: numpy.ndarray,
+		chunk_size: int = distance_memmap.DEFAULT_CHUNK_SIZE) -> numpy.ndarray:
+	""" Calculates each quantile of the distances strictly between 0 and the maximum distance."""
+	if isinstance(condensed, numpy.memmap):
+		maximum = distance_memmap.get_maximum(condensed, chunk_size)
+		total = 2 * distance_memmap.count_between(condensed, 0, maximum, chunk_size)
+
+		def values_at(ranks: numpy.ndarray) -> List[float]:
+			return [distance_memmap.get_order_statistic(condensed, rank, 0, maximum, chunk_size) for rank in ranks.tolist()]
+	else:
+		# `nan` is never larger than 0, so missing distances are also removed.
+		values = condensed[condensed > 0]
+		if len(values):
+			values = values[values < values.max()]
+		total = 2 * len(values)
+
+		def values_at(ranks: numpy.ndarray) -> numpy.ndarray:
+			return numpy.partition(values, ranks)[ranks]
+
+	if total == 0:
+		return numpy.full(len(quantiles), math.nan)
+	return _interpolate(values_at, quantiles, total)
+
+
+def get_filtered_quantiles_approximate(condensed: numpy.ndarray, quantiles: numpy.ndarray,
+		chunk_size: int = distance_memmap.DEFAULT_CHUNK_SIZE, compression: int = DEFAULT_COMPRESSION,
+		weights: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+	""" Estimates each quantile of the distances strictly between 0 and the maximum distance with a `TDigest`."""
+	maximum = distance_memmap.get_maximum(condensed, chunk_size)
+	digest = TDigest(compression)
+	for chunk in distance_memmap.iterate_chunks(len(condensed), chunk_size):
+		values = condensed[chunk]
+		is_between = (values > 0) & (values < maximum)
+		if weights is None:
+			digest.update(values[is_between])
+		else:
+			digest.update(values[is_between], get_pair_weights(weights, chunk.start, chunk.stop)[is_between])
+	return numpy.array([digest.quantile(quantile) for quantile in quantiles], dtype = float)
+
+
+def get_filtered_quantiles(condensed: numpy.ndarray, quantiles: Sequence[float], method: str = 'exact',
+		chunk_size: int = distance_memmap.DEFAULT_CHUNK_SIZE, weights: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+	"""
+		Calculates each quantile of the distances in the condensed distance vector which are strictly between 0 and the
+		maximum distance. The distances are only filtered once, regardless of the number of quantiles.
+		The quantiles are `nan` if there are no such distances.
+	Parameters
+	----------
+	condensed: numpy.ndarray
+		The condensed distance vector. May be a `numpy.memmap`.
+	quantiles: Sequence[float]
+	method: {'exact', 'approximate'}
+		'approximate' reads the distances once with a `TDigest`, which is faster for out-of-core distance matrices.
+	chunk_size: int
+		The number of distances read at once.
+	weights: Optional[numpy.ndarray]
+		The number of identical trajectories each element of the distance matrix stands for.
+	"""
+	quantiles = numpy.asarray(quantiles, dtype = float).reshape(-1)
+	if method == 'exact' and weights is not None:
+		return get_filtered_quantiles_weighted(condensed, weights, quantiles, chunk_size)
+	elif method == 'exact':
+		return get_filtered_quantiles_exact(condensed, quantiles, chunk_size)
+	elif method == 'approximate':
+		return get_filtered_quantiles_approximate(condensed, quantiles, chunk_size, weights = weights)
+	else:
+		message = f"'{method}' is not a valid method to calculate the distance cutoff. Expected one of {ACCEPTED_METHODS}"
+		raise ValueError(message)
+
+
+def get_filtered_quantile(condensed: numpy.ndarray, quantile: float, method: str = 'exact',
+		chunk_size: int = distance_memmap.DEFAULT_CHUNK_SIZE, weights: Optional[numpy.ndarray] = None) -> float:
+	""" Same as `get_filtered_quantiles` with a single quantile."""
+	return float(get_filtered_quantiles(condensed, [quantile], method, chunk_size, weights)[0])
@@ -0,0 +1,274 @@
+"""
+	A persistent cache of pairwise distances which is shared between runs. Each trajectory is identified by a hash of its
+	frequencies rather than its label, so the cached distances can be reused whenever the same trajectories are clustered
+	again with the same metric, dlimit and flimit, even if the table or the trajectory labels changed.
+
+	The distances are stored in an sqlite database as blocks. Each block holds the distances between one trajectory and a
+	group of other trajectories, which is much faster to read and write than one database row per pair.
+	The distances are stored before the `nan` distances are replaced with the maximum distance, since the maximum depends
+	on every other trajectory in the dataset.
+"""
+import hashlib
+import sqlite3
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy
+from loguru import logger
+
+try:
+	from muller.clustering.metrics.distance_kernels import get_condensed_index, get_row_offset
+except ModuleNotFoundError:
+	from .distance_kernels import get_condensed_index, get_row_offset
+
+# Each pair takes 16 bytes in the database.
+DEFAULT_MAXIMUM_PAIRS = 50_000_000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS parameters (
+	id INTEGER PRIMARY KEY,
+	metric TEXT NOT NULL,
+	dlimit REAL NOT NULL,
+	flimit REAL NOT NULL,
+	UNIQUE (metric, dlimit, flimit)
+);
+CREATE TABLE IF NOT EXISTS blocks (
+	id INTEGER PRIMARY KEY,
+	parameters INTEGER NOT NULL,
+	left INTEGER NOT NULL,
+	total INTEGER NOT NULL,
+	rights BLOB NOT NULL,
+	distances BLOB NOT NULL,
+	last_used INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS block_left ON blocks (parameters, left);
+CREATE TABLE IF NOT EXISTS generation (
+	value INTEGER NOT NULL
+);
+"""
+
+
+def hash_trajectories(values: numpy.ndarray) -> numpy.ndarray:
+	""" Returns a 64-bit hash of the frequencies of each row in `values`. Identical trajectories have the same hash."""
+	values = numpy.asarray(values, dtype = numpy.float64)
+	# Use the same representation for every `nan` and for `-0.0` and `0.0`.
+	values = numpy.where(numpy.isnan(values), numpy.nan, values) + 0.0
+	hashes = [
+		int.from_bytes(hashlib.blake2b(row.tobytes(), digest_size = 8).digest(), 'little', signed = True)
+		for row in numpy.ascontiguousarray(values)
+	]
+	return numpy.array(hashes, dtype = numpy.int64)
+
+
+class HashIndex:
+	""" Maps each unique hash to the positions of every trajectory with that hash."""
+
+	def __init__(self, hashes: numpy.ndarray):
+		self.unique, inverse = numpy.unique(hashes, return_inverse = True)
+		inverse = inverse.reshape(-1)
+		self.order = numpy.argsort(inverse, kind = 'stable')
+		self.counts = numpy.bincount(inverse, minlength = len(self.unique))
+		self.starts = numpy.cumsum(self.counts) - self.counts
+
+	def find(self, hashes: numpy.ndarray) -> numpy.ndarray:
+		""" Returns the index of each of `hashes` in `self.unique`, or -1 if the hash is not present."""
+		index = numpy.searchsorted(self.unique, hashes)
+		index[index == len(self.unique)] = 0
+		return numpy.where(self.unique[index] == hashes, index, -1)
+
+	def positions(self, unique_indices: numpy.ndarray) -> numpy.ndarray:
+		""" Returns the position of every trajectory with each hash, along with the element of `unique_indices` it came from."""
+		counts = self.counts[unique_indices]
+		source = numpy.repeat(numpy.arange(len(unique_indices)), counts)
+		within = numpy.arange(len(source)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+		return self.order[self.starts[unique_indices][source] + within], source
+
+
+class BlockStore:
+	"""
+		Stores a value for each pair of trajectories in an sqlite database. The values are stored as blocks, where each block
+		holds the values of one trajectory (the key) against a group of other trajectories (the members). Trajectories are
+		identified by their hash (see `hash_trajectories`).
+		Every block read or written during a run is marked with the current generation (one generation per run). Once the
+		database holds more than `maximum_pairs` pairs, the least recently used blocks are removed.
+		Subclasses define the schema and how the values of each block are encoded.
+	Parameters
+	----------
+	filename: Path
+		The sqlite database. Created if it does not exist.
+	maximum_pairs: int
+		The maximum number of pairs to keep.
+	"""
+	schema: str = ""
+	# The name and type of each column of the `parameters` table.
+	parameter_columns: List[Tuple[str, type]] = []
+	# The columns of the `blocks` table which hold the hash of the key, the hashes of the members and the encoded values.
+	key_column: str = ""
+	members_column: str = ""
+	value_columns: List[str] = []
+	# Used in the log messages.
+	description: str = "pairs"
+
+	def __init__(self, filename: Path, maximum_pairs: int):
+		self.filename = Path(filename)
+		self.maximum_pairs = maximum_pairs
+		# The number of pairs found in and missing from the database since this object was created.
+		self.hits = 0
+		self.misses = 0
+
+		self.filename.parent.mkdir(parents = True, exist_ok = True)
+		self.connection = sqlite3.connect(str(self.filename))
+		with self.connection:
+			self.connection.executescript(self.schema)
+			row = self.connection.execute("SELECT value FROM generation").fetchone()
+			if row is None:
+				self.generation = 1
+				self.connection.execute("INSERT INTO generation (value) VALUES (?)", (self.generation,))
+			else:
+				self.generation = row[0] + 1
+				self.connection.execute("UPDATE generation SET value = ?", (self.generation,))
+
+	def close(self):
+		self.connection.close()
+
+	def __len__(self) -> int:
+		""" The number of pairs in the database."""
+		return self.connection.execute("SELECT COALESCE(SUM(total), 0) FROM blocks").fetchone()[0]
+
+	def _get_parameter_id(self, parameters: Dict[str, Any]) -> int:
+		names = [name for name, _ in self.parameter_columns]
+		key = tuple(cast(parameters[name]) for name, cast in self.parameter_columns)
+		placeholders = ', '.join('?' for _ in names)
+		condition = ' AND '.join(f"{name} = ?" for name in names)
+		with self.connection:
+			self.connection.execute(f"INSERT OR IGNORE INTO parameters ({', '.join(names)}) VALUES ({placeholders})", key)
+			row = self.connection.execute(f"SELECT id FROM parameters WHERE {condition}", key).fetchone()
+		return row[0]
+
+	def _read_blocks(self, index: HashIndex, parameter_id: int) -> Iterator[Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray, List[bytes]]]:
+		"""
+			Yields each block where the key and at least one member are in `index`, and marks it as used. Each block is
+			given as the positions of the trajectories with the key's hash, the positions of the trajectories with each known
+			member's hash, which members are known, the known member each position came from (see `HashIndex.positions`),
+			and the encoded values.
+		"""
+		columns = ', '.join([self.key_column, self.members_column] + self.value_columns)
+		with self.connection:
+			self.connection.execute("DROP TABLE IF EXISTS temp.hashes")
+			self.connection.execute("CREATE TEMP TABLE hashes (hash INTEGER PRIMARY KEY)")
+			self.connection.executemany("INSERT INTO temp.hashes (hash) VALUES (?)", ((int(i),) for i in index.unique))
+			blocks = self.connection.execute(
+				f"SELECT id, {columns} FROM blocks WHERE parameters = ? AND {self.key_column} IN (SELECT hash FROM temp.hashes)",
+				(parameter_id,)
+			)
+			used = list()
+			for block_id, key, members, *values in blocks:
+				members = index.find(numpy.frombuffer(members, dtype = numpy.int64))
+				is_known = members >= 0
+				if not is_known.any():
+					continue
+				used.append((self.generation, block_id))
+				member_positions, source = index.positions(members[is_known])
+				key_positions, _ = index.positions(index.find(numpy.array([key], dtype = numpy.int64)))
+				yield key_positions, member_positions, is_known, source, values
+			self.connection.executemany("UPDATE blocks SET last_used = ? WHERE id = ?", used)
+			self.connection.execute("DROP TABLE temp.hashes")
+
+	def _write_block(self, parameter_id: int, key: int, members: numpy.ndarray, *values: bytes):
+		""" Adds a block with the encoded `values` of the trajectory with hash `key` against each hash in `members`."""
+		columns = [self.key_column, 'total', self.members_column] + self.value_columns
+		placeholders = ', '.join('?' for _ in range(len(columns) + 2))
+		self.connection.execute(
+			f"INSERT INTO blocks (parameters, {', '.join(columns)}, last_used) VALUES ({placeholders})",
+			(parameter_id, int(key), len(members), numpy.asarray(members, dtype = numpy.int64).tobytes(), *values, self.generation)
+		)
+
+	def _can_write(self, total_pairs: int) -> bool:
+		if total_pairs > self.maximum_pairs:
+			logger.info(f"Not saving {total_pairs} {self.description} to '{self.filename}' since it is limited to {self.maximum_pairs} pairs.")
+			return False
+		return True
+
+	def evict(self):
+		""" Removes the least recently used blocks until no more than `maximum_pairs` pairs are left."""
+		excess = len(self) - self.maximum_pairs
+		if excess <= 0:
+			return
+		removed = list()
+		for block_id, total in self.connection.execute("SELECT id, total FROM blocks ORDER BY last_used, id"):
+			removed.append((block_id,))
+			excess -= total
+			if excess <= 0:
+				break
+		with self.connection:
+			self.connection.executemany("DELETE FROM blocks WHERE id = ?", removed)
+		logger.debug(f"Removed {len(removed)} blocks of {self.description} from '{self.filename}'")
+
+
+class DistanceStore(BlockStore):
+	"""
+		Stores the distance between pairs of trajectories in an sqlite database. Each block holds the distances between one
+		trajectory and the trajectories after it. See `BlockStore`.
+	Parameters
+	----------
+	filename: Path
+		The sqlite database. Created if it does not exist.
+	maximum_pairs: int
+		The maximum number of distances to keep.
+	"""
+	schema = SCHEMA
+	parameter_columns = [('metric', str), ('dlimit', float), ('flimit', float)]
+	key_column = 'left'
+	members_column = 'rights'
+	value_columns = ['distances']
+	description = 'distances'
+
+	def __init__(self, filename: Path, maximum_pairs: int = DEFAULT_MAXIMUM_PAIRS):
+		super().__init__(filename, maximum_pairs)
+
+	def read(self, hashes: numpy.ndarray, parameters: Dict[str, Any], out: numpy.ndarray) -> numpy.ndarray:
+		"""
+			Copies every known distance between the trajectories in `hashes` into the condensed distance vector `out`.
+			Returns a boolean array indicating which positions of `out` were found in the database.
+		"""
+		total = len(hashes)
+		parameter_id = self._get_parameter_id(parameters)
+		index = HashIndex(hashes)
+		found = numpy.zeros(total * (total - 1) // 2, dtype = bool)
+
+		for left_positions, right_positions, is_known, source, (distances,) in self._read_blocks(index, parameter_id):
+			values = numpy.frombuffer(distances, dtype = numpy.float64)[is_known][source]
+			for left_position in left_positions:
+				is_pair = right_positions != left_position
+				i = numpy.minimum(left_position, right_positions[is_pair])
+				j = numpy.maximum(left_position, right_positions[is_pair])
+				positions = get_condensed_index(total, i, j)
+				out[positions] = values[is_pair]
+				found[positions] = True
+
+		total_found = int(found.sum())
+		self.hits += total_found
+		self.misses += len(found) - total_found
+		return found
+
+	def write(self, hashes: numpy.ndarray, parameters: Dict[str, Any], condensed: numpy.ndarray, found: Optional[numpy.ndarray] = None):
+		""" Saves the distances in `condensed` which were not already `found` in the database, then removes old blocks if needed."""
+		total_pairs = len(condensed) if found is None else int((~found).sum())
+		if not self._can_write(total_pairs):
+			return
+		parameter_id = self._get_parameter_id(parameters)
+		total = len(hashes)
+		with self.connection:
+			for row in range(total - 1):
+				start = get_row_offset(total, row)
+				stop = start + total - row - 1
+				rights = hashes[row + 1:]
+				values = numpy.asarray(condensed[start:stop], dtype = numpy.float64)
+				if found is not None:
+					missing = ~found[start:stop]
+					rights = rights[missing]
+					values = values[missing]
+				if len(rights) == 0:
+					continue
+				self._write_block(parameter_id, hashes[row], rights, values.tobytes())
+		self.evict()
@@ -0,0 +1,155 @@
+"""
+	Precomputes the per-trajectory facts used to categorize pairs of trajectories and select the timepoints to compare.
+	These only depend on a single trajectory, so they are calculated once per trajectory rather than once per pair.
+"""
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy
+import pandas
+
+# Indexed by the codes returned from `TrajectoryStates.get_pair_categories`.
+PAIR_CATEGORIES = ['onlyFixed', 'partiallyFixed', 'bothFixed', 'oneFixed', 'notFixed']
+CATEGORY_ONLY_FIXED, CATEGORY_PARTIALLY_FIXED, CATEGORY_BOTH_FIXED, CATEGORY_ONE_FIXED, CATEGORY_NOT_FIXED = range(len(PAIR_CATEGORIES))
+
+# `widgets.get_valid_points` masks fixed timepoints using this hard-coded value rather than `flimit`.
+MASKED_FIXED_LIMIT = 0.97
+
+
+def get_detected_window(detected: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+	"""
+		Returns the position of the first and last detected timepoint of each row. Rows without any detected timepoints
+		are assigned a first position past the end of the series and a last position of -1 so that they never extend the
+		window of another trajectory.
+	"""
+	total_timepoints = detected.shape[1]
+	any_detected = detected.any(axis = 1)
+	first = numpy.where(any_detected, detected.argmax(axis = 1), total_timepoints)
+	last = numpy.where(any_detected, total_timepoints - 1 - detected[:, ::-1].argmax(axis = 1), -1)
+	return first, last
+
+
+class TrajectoryStates:
+	"""
+		Holds the fixed, intermediate and detected timepoints of each trajectory as bitmasks, along with the summaries
+		needed to categorize a pair of trajectories and find the window of valid timepoints between them.
+
+		The pair category and window are equivalent to `distance_calculator.get_pair_category` and
+		`distance_calculator.filter_timepoints`.
+	Parameters
+	----------
+	values: numpy.ndarray
+		Frequencies with one row per trajectory and one column per timepoint. The columns should be sorted.
+	dlimit, flimit: float
+	labels: Optional[Iterable[str]]
+		The label of each row. Defaults to the row number.
+	"""
+
+	def __init__(self, values: numpy.ndarray, dlimit: float, flimit: float, labels: Optional[Iterable[str]] = None):
+		values = numpy.asarray(values, dtype = float)
+		self.dlimit = dlimit
+		self.flimit = flimit
+		self.total_trajectories, self.total_timepoints = values.shape
+		if labels is None:
+			labels = range(self.total_trajectories)
+		self.labels = list(labels)
+		self.index: Dict[str, int] = {label: position for position, label in enumerate(self.labels)}
+
+		fixed = values >= flimit
+		intermediate = (values >= dlimit) & (values <= flimit)
+		detected = values > dlimit
+		# Fixed timepoints are treated as undetected when selecting the valid timepoints of most pair categories.
+		detected_unfixed = numpy.where(values > MASKED_FIXED_LIMIT, -1, values) > dlimit
+
+		self.fixed = numpy.packbits(fixed, axis = 1)
+		self.intermediate = numpy.packbits(intermediate, axis = 1)
+		self.detected = numpy.packbits(detected, axis = 1)
+
+		self.was_fixed: numpy.ndarray = fixed.any(axis = 1)
+		self.only_fixed: numpy.ndarray = self.was_fixed & ~intermediate.any(axis = 1)
+		# Label each unique fixed pattern so that two patterns can be compared with a single equality test.
+		_, fixed_pattern = numpy.unique(self.fixed, axis = 0, return_inverse = True)
+		self.fixed_pattern: numpy.ndarray = fixed_pattern.reshape(-1)
+
+		self.first_detected, self.last_detected = get_detected_window(detected)
+		self.first_detected_unfixed, self.last_detected_unfixed = get_detected_window(detected_unfixed)
+
+	@classmethod
+	def from_table(cls, trajectories: pandas.DataFrame, dlimit: float, flimit: float) -> 'TrajectoryStates':
+		return cls(trajectories.values, dlimit, flimit, trajectories.index)
+
+	def __len__(self) -> int:
+		return self.total_trajectories
+
+	def categorize(self, rows, columns) -> numpy.ndarray:
+		""" Categorizes every combination of `rows` and `columns`, which may be any valid numpy index. Returns the category codes."""
+		left_fixed = self.was_fixed[rows, None]
+		right_fixed = self.was_fixed[None, columns]
+		left_only_fixed = self.only_fixed[rows, None]
+		right_only_fixed = self.only_fixed[None, columns]
+
+		categories = numpy.full(numpy.broadcast(left_fixed, right_fixed).shape, CATEGORY_NOT_FIXED, dtype = numpy.int8)
+		both_fixed = left_fixed & right_fixed
+		categories[left_fixed != right_fixed] = CATEGORY_ONE_FIXED
+		categories[both_fixed] = CATEGORY_PARTIALLY_FIXED
+		categories[both_fixed & ~left_only_fixed & ~right_only_fixed] = CATEGORY_BOTH_FIXED
+		categories[both_fixed & left_only_fixed & right_only_fixed] = CATEGORY_ONLY_FIXED
+		return categories
+
+	def windows(self, rows, columns, categories: Optional[numpy.ndarray] = None) -> Tuple[numpy.ndarray, numpy.ndarray]:
+		"""
+			Returns the positions of the first and last valid timepoints for every combination of `rows` and `columns`.
+			Windows where the first position is greater than the last position are empty.
+		"""
+		if categories is None:
+			categories = self.categorize(rows, columns)
+		one_fixed = categories == CATEGORY_ONE_FIXED
+		start = numpy.where(
+			one_fixed,
+			numpy.minimum(self.first_detected[rows, None], self.first_detected[None, columns]),
+			numpy.minimum(self.first_detected_unfixed[rows, None], self.first_detected_unfixed[None, columns])
+		)
+		stop = numpy.where(
+			one_fixed,
+			numpy.maximum(self.last_detected[rows, None], self.last_detected[None, columns]),
+			numpy.maximum(self.last_detected_unfixed[rows, None], self.last_detected_unfixed[None, columns])
+		)
+		return start, stop
+
+	def fixed_overlap(self, rows, columns) -> numpy.ndarray:
+		""" Equivalent to `distance_calculator.fixed_overlap` for trajectories which were only ever fixed or undetected."""
+		return numpy.where(self.fixed_pattern[rows, None] == self.fixed_pattern[None, columns], 0, numpy.nan)
+
+	def get_pair_category(self, left: str, right: str) -> str:
+		code = self.categorize([self.index[left]], [self.index[right]])[0, 0]
+		return PAIR_CATEGORIES[code]
+
+	def get_pair_window(self, left: str, right: str) -> Optional[slice]:
+		"""
+			Returns the positions of the timepoints which should be compared between `left` and `right`, or None if
+			both trajectories were only ever fixed or undetected.
+		"""
+		i = [self.index[left]]
+		j = [self.index[right]]
+		category = self.categorize(i, j)
+		if category[0, 0] == CATEGORY_ONLY_FIXED:
+			return None
+		start, stop = self.windows(i, j, category)
+		start = int(start[0, 0])
+		stop = int(stop[0, 0])
+		if start > stop:
+			# Nothing was detected. Use an empty window.
+			start = stop = 0
+		else:
+			stop += 1
+		return slice(start, stop)
+
+	def get_pair_categories(self) -> numpy.ndarray:
+		""" Returns the category code of every pair of trajectories as a condensed vector. See `PAIR_CATEGORIES`."""
+		total = self.total_trajectories
+		result = numpy.empty(total * (total - 1) // 2, dtype = numpy.int8)
+		position = 0
+		for row in range(total - 1):
+			categories = self.categorize(slice(row, row + 1), slice(row + 1, total))[0]
+			result[position:position + len(categories)] = categories
+			position += len(categories)
+		return result
@@ -0,0 +1,72 @@
+"""
+	Collapses identical (or nearly identical) trajectories before the pairwise distances are calculated. Trajectory tables
+	often contain many trajectories with the same frequencies, such as linked mutations or mutations which fixed between
+	two timepoints, and each of them adds a full row of pairwise distances. Each group of duplicates is replaced by a single
+	representative trajectory, and the number of trajectories it stands for is used as its weight when clustering (see
+	`hierarchy.weighted_linkage`). The genotypes are expanded back to the original trajectories afterwards.
+
+	Collapsing a group is only exact when its members are 0 apart. This is not always the case with the 'pearson' and
+	'combined' metrics, where identical trajectories which are constant within their comparison window have an undefined
+	correlation and are given the maximum distance instead. Groups like these are split back into single trajectories
+	(see `split_groups`) so the genotypes are the same as without collapsing.
+"""
+from typing import Dict, Iterable, List
+
+import numpy
+import pandas
+
+try:
+	from muller.clustering.metrics import hash_trajectories
+except ModuleNotFoundError:
+	from .metrics import hash_trajectories
+
+
+def get_duplicate_groups(trajectories: pandas.DataFrame, tolerance: float = 0) -> Dict[str, List[str]]:
+	"""
+		Groups the trajectories with the same frequencies after rounding each frequency to the nearest multiple of `tolerance`.
+		Returns a dictionary mapping the first trajectory in each group to every trajectory in the group, in the order of
+		`trajectories`. Trajectories without any duplicates are in a group by themselves.
+	"""
+	values = trajectories.values.astype(float)
+	if tolerance:
+		values = numpy.round(values / tolerance)
+	groups: Dict[int, List[str]] = dict()
+	for label, key in zip(trajectories.index, hash_trajectories(values).tolist()):
+		groups.setdefault(key, list()).append(label)
+	return {members[0]: members for members in groups.values()}
+
+
+def split_groups(groups: Dict[str, List[str]], labels: Iterable[str]) -> Dict[str, List[str]]:
+	""" Replaces the group of each representative in `labels` with a separate group for each of its members."""
+	labels = set(labels)
+	result: Dict[str, List[str]] = dict()
+	for label, members in groups.items():
+		if label in labels:
+			result.update({member: [member] for member in members})
+		else:
+			result[label] = members
+	return result
+
+
+def collapse_trajectories(trajectories: pandas.DataFrame, groups: Dict[str, List[str]]) -> pandas.DataFrame:
+	""" Replaces each group of trajectories with the mean of its members, labeled by the first member of the group."""
+	representative_of = pandas.Series({member: label for label, members in groups.items() for member in members})
+	table = trajectories.groupby(representative_of.reindex(trajectories.index).values).mean()
+	table = table.loc[list(groups.keys())]
+	table.index.name = trajectories.index.name
+	return table
+
+
+def get_weights(groups: Dict[str, List[str]]) -> pandas.Series:
+	""" The number of trajectories each representative stands for."""
+	return pandas.Series({label: len(members) for label, members in groups.items()})
+
+
+def expand_clusters(clusters: List[List[str]], groups: Dict[str, List[str]], order: List[str]) -> List[List[str]]:
+	"""
+		Replaces each representative in `clusters` with every trajectory it stands for. The members of each cluster are
+		sorted by their position in `order`, and the clusters are sorted by the position of their first member.
+	"""
+	positions = {label: position for position, label in enumerate(order)}
+	expanded = [sorted((member for label in cluster for member in groups.get(label, [label])), key = positions.get) for cluster in clusters]
+	return sorted(expanded, key = lambda s: positions[s[0]])
@@ -2,7 +2,9 @@ import argparse
 import itertools
 import math
 from pathlib import Path
-from typing import List, Optional, Union
+from typing import List, Optional, Tuple, Union
+
+import numpy
 
 try:
 	from muller import dataio
@@ -34,7 +36,7 @@ class ProgramOptions(argparse.Namespace):
 	annotate_all: bool = False
 	save_pvalue: bool = True
 	use_strict_filter: bool = False
-	method: str = 'matlab'
+	method: str = 'hierarchy'
 	metric: str = "similarity"
 	known_genotypes: Optional[Path] = None
 
@@ -92,6 +94,48 @@ def _parse_frequency_option(frequency: Union[str, List[float]]) -> List[float]:
 	return frequencies
 
 
+def _parse_quantile_option(value: str) -> List[float]:
+	""" Parses either a comma-separated list of quantiles or a range formatted as `start:stop:count` (including `stop`)."""
+	if ':' in value:
+		start, stop, count = value.split(':')
+		quantiles = numpy.linspace(float(start), float(stop), int(count))
+		quantiles = [round(float(i), 6) for i in quantiles]
+	else:
+		quantiles = [float(i) for i in value.split(',') if i]
+	for quantile in quantiles:
+		if not 0 <= quantile <= 1:
+			message = f"{quantile} is not a valid similarity cutoff. Expected a value between 0 and 1."
+			raise argparse.ArgumentTypeError(message)
+	return quantiles
+
+
+def _parse_weights_option(value: str) -> List[Tuple[int, int, int, int]]:
+	""" Parses a semicolon-separated list of lineage score weights, each formatted as four comma-separated integers."""
+	weights = list()
+	for item in value.split(';'):
+		if not item:
+			continue
+		try:
+			values = tuple(int(i) for i in item.split(','))
+		except ValueError:
+			values = tuple()
+		if len(values) != 4:
+			message = f"'{item}' is not a valid set of score weights. Expected four comma-separated integers."
+			raise argparse.ArgumentTypeError(message)
+		weights.append(values)
+	return weights
+
+
+def _parse_pvalue_option(value: str) -> List[float]:
+	""" Parses a comma-separated list of pvalues."""
+	pvalues = [float(i) for i in value.split(',') if i]
+	for pvalue in pvalues:
+		if not 0 < pvalue <= 1:
+			message = f"{pvalue} is not a valid pvalue. Expected a value greater than 0 and at most 1."
+			raise argparse.ArgumentTypeError(message)
+	return pvalues
+
+
 #####################################################################################
 ################################ Custom Parsers ####################################
 #####################################################################################
@@ -176,14 +220,34 @@ def _create_parser_lineage_group_data(parser: argparse.ArgumentParser):
 	group_data.add_argument(
 		"--filename-pairwise",
 		help = "Path to a table with pairwise distance calculations from a previous run using identical input parameters. Should be located " \
-			   "in `tables/.distances.tsv in the output folder generated from the previous run. This table will be used rather than re-calculating " \
-			   "all the pairwise distances again which may take a long time for very large datasets.",
+			   "in `tables/.distance.bin` (or the slower `tables/.distance.tsv`) in the output folder generated from the previous run. This table will be used " \
+			   "rather than re-calculating all the pairwise distances again which may take a long time for very large datasets. " \
+			   "If trajectories were added or modified since the previous run, only the distances for those trajectories are calculated.",
 		action = "store",
 		dest = "filename_pairwise",
 		type = Path,
 		default = None
 	)
 
+	group_data.add_argument(
+		"--distance-cache",
+		help = "Path to a database of pairwise distances which is shared between runs. Trajectories are matched by their frequencies, "
+			   "so only the distances between new or modified trajectories are calculated when the workflow is run again on the same dataset. "
+			   "Created if it does not exist.",
+		action = "store",
+		dest = "filename_distance_cache",
+		type = Path,
+		default = None
+	)
+	group_data.add_argument(
+		"--distance-cache-size",
+		help = "The maximum number of pairwise distances to keep in the distance cache. The least recently used distances are removed first.",
+		action = "store",
+		dest = "distance_cache_size",
+		type = int,
+		default = None
+	)
+
 	group_data.add_argument(
 		"--gene-alias",
 		help = "An optional two-column file with more accurate gene names. This is usefull when using a reference annotated via prokka.",
@@ -207,6 +271,24 @@ def _create_parser_lineage_group_data(parser: argparse.ArgumentParser):
 		default = None,
 		type = Path
 	)
+	group_data.add_argument(
+		"--lineage-cache",
+		help = "Path to a database of lineage scores which is shared between runs. Genotypes are matched by their frequencies, "
+			   "so only the pairs which include new or modified genotypes are scored when the workflow is run again on the same dataset. "
+			   "Created if it does not exist.",
+		action = "store",
+		dest = "filename_lineage_cache",
+		type = Path,
+		default = None
+	)
+	group_data.add_argument(
+		"--lineage-cache-size",
+		help = "The maximum number of pairs of genotypes to keep in the lineage cache. The least recently used scores are removed first.",
+		action = "store",
+		dest = "lineage_cache_size",
+		type = int,
+		default = None
+	)
 
 
 def _create_parser_lineage_group_genotype_generation(parser: argparse.ArgumentParser):
@@ -216,13 +298,98 @@ def _create_parser_lineage_group_genotype_generation(parser: argparse.ArgumentPa
 	analysis_group = parser.add_argument_group(title = "Genotype and Lineage Parameters")
 	analysis_group.add_argument(
 		"--threads",
-		help = "The number of processes to use. Adding more threads than available cpu cores provides no speedup.",
+		help = "The number of processes to use. Adding more threads than available cpu cores provides no speedup. Used to "
+			   "calculate the pairwise distances and the lineage scores.",
 		action = "store",
 		dest = "threads",
 		type = int,
 		default = 1
 	)
 
+	analysis_group.add_argument(
+		"--engine",
+		help = "How to calculate the pairwise distances. 'vectorized' calculates all distances at once and is much faster for large datasets. "
+			   "Metrics without a vectorized implementation use the 'pairwise' engine.",
+		action = "store",
+		dest = "engine",
+		choices = ["pairwise", "vectorized"],
+		default = "vectorized"
+	)
+
+	analysis_group.add_argument(
+		"--out-of-core",
+		help = "Writes the pairwise distance matrix to a memory-mapped file (tables/.distance.bin) rather than keeping it in memory. "
+			   "Use for datasets with tens of thousands of trajectories, which would otherwise run out of memory.",
+		action = "store_true",
+		dest = "out_of_core"
+	)
+
+	analysis_group.add_argument(
+		"--prune-distance",
+		help = "Skips the pairwise distances which are provably larger than this distance, which is much faster for large datasets. "
+			   "Trajectories are then clustered with single linkage at this distance rather than with `--similarity-cutoff`. "
+			   "Only the binomial metric can skip pairs.",
+		action = "store",
+		dest = "prune_cutoff",
+		type = float,
+		default = None
+	)
+
+	analysis_group.add_argument(
+		"--collapse-duplicates",
+		help = "Replaces each group of identical trajectories with a single trajectory before calculating the pairwise distances. "
+			   "Identical trajectories which are not 0 apart with the selected metric are kept separate, so the genotypes are the "
+			   "same as without this option. If a value is given, trajectories which are identical after rounding each frequency "
+			   "to the nearest multiple of this value are also collapsed, which may change the genotypes. The number of collapsed "
+			   "trajectories is saved to supplementary-files/.clusterdata.json. Not used with `--binned-clustering`.",
+		action = "store",
+		dest = "collapse_tolerance",
+		type = float,
+		nargs = '?',
+		const = 0.0,
+		default = None
+	)
+	analysis_group.add_argument(
+		"--binned-clustering",
+		help = "Groups the trajectories into bins of trajectories which were first detected, first fixed and peaked at the same "
+			   "timepoints, clusters each bin, then merges the clusters from every bin. Only the distances within each bin are "
+			   "calculated, so this works for datasets which are too large to calculate every pairwise distance. This is an "
+			   "approximation, so some genotypes may be merged or split differently than without this option. "
+			   "`--prune-distance`, `--out-of-core` and `--filename-pairwise` are ignored in this mode.",
+		action = "store_true",
+		dest = "binned_clustering"
+	)
+	analysis_group.add_argument(
+		"--maximum-bin-size",
+		help = "The maximum number of trajectories in each bin when using `--binned-clustering`. Also the maximum number of "
+			   "clusters merged at once: when there are more clusters than this, they are sorted by when they were first "
+			   "detected, first fixed and peaked and merged in windows of this size, so only neighbouring clusters can be merged.",
+		action = "store",
+		dest = "maximum_bin_size",
+		type = int,
+		default = None
+	)
+
+	analysis_group.add_argument(
+		"-m", "--method",
+		help = "The clustering method. 'hierarchy' uses hierarchical clustering. 'matlab' uses the iterative method from the "
+			   "original matlab scripts, which clusters the trajectories which fix separately from those which do not and "
+			   "repeatedly merges the two closest genotypes. 'twostep' also unlinks genotypes with members further apart than "
+			   "`--difference-cutoff`.",
+		action = "store",
+		dest = "method",
+		choices = ACCEPTED_METHODS,
+		default = "hierarchy"
+	)
+	analysis_group.add_argument(
+		"--difference-cutoff",
+		help = "Only used when `--method` is 'twostep'. The quantile of the pairwise distances used as the maximum distance "
+			   "between two trajectories in the same genotype.",
+		action = "store",
+		dest = "difference_cutoff",
+		type = float,
+		default = 0.10
+	)
 	analysis_group.add_argument(
 		"--metric",
 		help = "The distance metric to use when clustering mutaitons into genotypes.",
@@ -239,6 +406,43 @@ def _create_parser_lineage_group_genotype_generation(parser: argparse.ArgumentPa
 		type = float,
 		default = None
 	)
+	analysis_group.add_argument(
+		"--leaf-ordering",
+		help = "How the trajectories are ordered in the dendrogram. 'optimal' places similar trajectories next to each other, but is "
+			   "much slower than the clustering itself for thousands of trajectories. 'approximate' is a fast greedy version of "
+			   "'optimal'. The genotypes do not depend on this option.",
+		action = "store",
+		dest = "leaf_ordering",
+		choices = ["optimal", "approximate", "none"],
+		default = "optimal"
+	)
+	analysis_group.add_argument(
+		"--similarity-sweep",
+		help = "Also groups the trajectories at each of these similarity cutoffs, reusing the distances and linkage. Either a "
+			   "comma-separated list or a range formatted as `start:stop:count`. Writes a table with the number of genotypes, their "
+			   "sizes and how well they are separated at each cutoff (tables/.cutoffsweep.tsv).",
+		action = "store",
+		dest = "similarity_sweep",
+		type = _parse_quantile_option,
+		default = None
+	)
+	analysis_group.add_argument(
+		"--sweep-genotypes",
+		help = "A comma-separated list of similarity cutoffs to save the genotype table of when sweeping the similarity cutoff.",
+		action = "store",
+		dest = "sweep_genotypes",
+		type = _parse_quantile_option,
+		default = None
+	)
+	analysis_group.add_argument(
+		"--cutoff-estimation",
+		help = "How the distance cutoff is calculated from `--similarity-cutoff`. 'approximate' estimates the quantile of the pairwise "
+			   "distances in a single pass with a t-digest, which is much faster when used with `--out-of-core`.",
+		action = "store",
+		dest = "quantile_method",
+		choices = ["exact", "approximate"],
+		default = "exact"
+	)
 	analysis_group.add_argument(
 		"-p", "--pvalue",
 		help = "The p-value to use for the statistics tests",
@@ -286,6 +490,44 @@ def _create_parser_lineage_group_genotype_generation(parser: argparse.ArgumentPa
 		action = "store_false",
 		dest = "conservative"
 	)
+	analysis_group.add_argument(
+		"--bootstrap",
+		help = "The number of bootstrap replicates used to estimate the support of each edge in the lineage. Each replicate resamples "
+			   "the genotype frequencies with binomial measurement error and infers the lineage again. The support is added to the edges table "
+			   "and the lineage plot. The replicates are split between `--threads` processes.",
+		action = "store",
+		dest = "bootstrap",
+		type = int,
+		default = 0
+	)
+	analysis_group.add_argument(
+		"--bootstrap-depth",
+		help = "The number of reads used to resample each frequency in the bootstrap replicates.",
+		action = "store",
+		dest = "bootstrap_depth",
+		type = int,
+		default = None
+	)
+	analysis_group.add_argument(
+		"--lineage-sweep-weights",
+		help = "Also infers the lineage with each of these sets of score weights, formatted as a semicolon-separated list of four "
+			   "comma-separated integers (ex. `1,1,2,2;1,2,1,2`). Each set of weights is combined with each of `--lineage-sweep-pvalues`. "
+			   "The parent of each genotype for each combination is saved to tables/.lineagesweep.parents.tsv, and the most common "
+			   "parent of each genotype to tables/.lineagesweep.tsv.",
+		action = "store",
+		dest = "lineage_sweep_weights",
+		type = _parse_weights_option,
+		default = None
+	)
+	analysis_group.add_argument(
+		"--lineage-sweep-pvalues",
+		help = "A comma-separated list of pvalues to infer the lineage with. Defaults to `--pvalue` when only `--lineage-sweep-weights` "
+			   "is given. See `--lineage-sweep-weights`.",
+		action = "store",
+		dest = "lineage_sweep_pvalues",
+		type = _parse_pvalue_option,
+		default = None
+	)
 
 	return analysis_group
 
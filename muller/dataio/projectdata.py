@@ -1,5 +1,5 @@
 import json
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Any, Dict, List, Optional
 
@@ -43,6 +43,8 @@ class DataGenotypeInference:
 	matrix_distance: Optional[Any]
 	# Generated from the hierarchal clustering step. Links trajectories based on the pairwise distance.
 	clusterdata: Optional["DataHierarchalCluster"]
+	# Only generated when the similarity cutoff is swept over several values.
+	clustersweep: Optional["DataClusterSweep"] = None
 
 	def save(self, folder:Path, prefix:str):
 		"""
@@ -69,9 +71,11 @@ class DataGenotypeInference:
 		# Save the data
 		self.table_trajectories.to_csv(filename_table_trajectory, sep = delimiter)
 		self.table_genotypes.to_csv(filename_table_genotypes, sep = delimiter)
-		if self.clusterdata is not None:
-			self.clusterdata.table_linkage.to_csv(filename_table_linkage_matrix, sep = delimiter)
-		if self.matrix_distance is not None:
+		if self.clusterdata is not None and self.clusterdata.table_linkage is not None:
+			self.clusterdata.get_saved_linkage().to_csv(filename_table_linkage_matrix, sep = delimiter)
+		# The out-of-core and sparse distance matrices are too large to save as a square table.
+		is_square = not (getattr(self.matrix_distance, 'out_of_core', False) or getattr(self.matrix_distance, 'is_sparse', False))
+		if self.matrix_distance is not None and is_square:
 			self.matrix_distance.squareform().to_csv(filename_table_distance_matrix, sep = delimiter)
 
 		# Need to remove the `members` column from the genotype table so that the graphics workflow uses a purely numeric table
@@ -84,15 +88,41 @@ class DataHierarchalCluster:
 	table_linkage: Optional[pandas.DataFrame]
 	distance_cutoff: float
 	distance_quantile: float
+	# The linkage table with reordered leaves, for each leaf ordering method. Only generated for the dendrogram.
+	tables_linkage_ordered: Dict[str, pandas.DataFrame] = field(default_factory = dict)
+	# The number of seconds taken by each stage of the clustering workflow.
+	timings: Dict[str, float] = field(default_factory = dict)
+	# Maps each trajectory which stood for a group of duplicate trajectories to every trajectory in the group.
+	duplicates: Dict[str, List[str]] = field(default_factory = dict)
 	def to_dict(self)->Dict[str,Any]:
 		data = {
 			'clusters': self.clusters,
 			'distanceCutoff': self.distance_cutoff,
-			'distanceQuantile': self.distance_quantile
+			'distanceQuantile': self.distance_quantile,
+			'timings': self.timings,
+			'collapsedTrajectories': sum(len(i) - 1 for i in self.duplicates.values()),
+			'duplicates': self.duplicates
 		}
 
 		return data
 
+	def get_saved_linkage(self) -> Optional[pandas.DataFrame]:
+		""" The linkage table with the same leaf order as the dendrogram, or the plain linkage if no dendrogram was drawn."""
+		if self.tables_linkage_ordered:
+			return list(self.tables_linkage_ordered.values())[-1]
+		return self.table_linkage
+
+
+@dataclass
+class DataClusterSweep:
+	""" The genotypes generated by cutting the same linkage at several similarity cutoffs. """
+	# The number of genotypes, their sizes and the separation of the genotypes at each similarity cutoff.
+	table_sweep: pandas.DataFrame
+	# The trajectories in each genotype at each similarity cutoff (quantile).
+	clusters: Dict[float, List[List[str]]]
+	# The sorted genotype table for each of the selected similarity cutoffs. Includes a `members` column.
+	table_genotypes: Dict[float, pandas.DataFrame] = field(default_factory = dict)
+
 
 @dataclass
 class DataGGmuller:
@@ -100,6 +130,8 @@ class DataGGmuller:
 	table_populations: pandas.DataFrame
 	series_edges: pandas.Series
 	table_muller: pandas.DataFrame
+	# The bootstrap support of each edge, if available.
+	series_support: Optional[pandas.Series] = None
 
 	def save(self, folder:Path, prefix: str):
 		"""
@@ -125,6 +157,10 @@ class DataGenotypeLineage:
 	# The resulting scores of each unnested genotype to cancidate nested genotypes.
 	table_scores: pandas.DataFrame
 	clusters: Any # muller.inheritance.genotype_ancestry.Ancestry
+	# The fraction of bootstrap replicates which selected the same parent for each genotype. Only available when bootstrapping.
+	series_support: Optional[pandas.Series] = None
+	# The parent of each genotype for each combination of score weights and pvalue. Only available when sweeping the lineage.
+	lineage_sweep: Any = None  # muller.inheritance.lineage_sweep.LineageSweep
 
 	def save(self, folder:Path, prefix:str):
 		delimiter = "\t"
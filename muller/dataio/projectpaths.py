@@ -45,8 +45,15 @@ class OutputFilenames:
 		self.filename_table_edges: Path = self.folder_tables / (name + f'.edges.{suffix}')
 		self.filename_table_muller: Path = self.folder_tables / (name + f".muller.{suffix}")
 		self.filename_table_lineage_scores: Path = self.folder_tables / (name + '.lineagescores.tsv')
+		self.filename_table_lineage_sweep: Path = self.folder_tables / (name + f".lineagesweep.{suffix}")
+		self.filename_table_lineage_sweep_parents: Path = self.folder_tables / (name + f".lineagesweep.parents.{suffix}")
 		self.filename_table_linkage = self.folder_tables / (name + f".linkagematrix.tsv")
 		self.filename_table_distance: Path = self.folder_tables / (name + f".distance.{suffix}")
+		# The condensed distance matrix in the binary format read by `CondensedDistanceCache.read_binary`.
+		self.filename_table_distance_binary: Path = self.folder_tables / (name + ".distance.bin")
+		# The known pairs of a sparse distance matrix, in the format written by `SparseDistanceCache.save`.
+		self.filename_table_distance_sparse: Path = self.folder_tables / (name + f".distance.sparse.{suffix}")
+		self.filename_table_cutoff_sweep: Path = self.folder_tables / (name + f".cutoffsweep.{suffix}")
 
 		# graphics
 		# The extensions fo reach figure will be generated based on which file formats the
@@ -146,19 +153,34 @@ class OutputFilenames:
 
 		data.table_genotypes['members'] = [members[i] for i in data.table_genotypes.index]
 		data.table_genotypes.to_csv(self.filename_table_genotypes, sep = self.delimiter)
-		if data.matrix_distance is not None:
-			data.matrix_distance.squareform().to_csv(self.filename_table_distance, sep = self.delimiter)
-		if data.clusterdata is not None:
-			data.clusterdata.table_linkage.to_csv(self.filename_table_linkage, sep = self.delimiter)
+		if data.matrix_distance is not None and getattr(data.matrix_distance, 'is_sparse', False):
+			# Only the pairs which were calculated are saved, rather than every pair.
+			data.matrix_distance.save(self.filename_table_distance_sparse)
+		elif data.matrix_distance is not None:
+			if hasattr(data.matrix_distance, 'save_binary'):
+				data.matrix_distance.save_binary(self.filename_table_distance_binary)
+			# The out-of-core distance matrix is too large to save as a square table.
+			if not getattr(data.matrix_distance, 'out_of_core', False):
+				data.matrix_distance.squareform().to_csv(self.filename_table_distance, sep = self.delimiter)
+		if data.clustersweep is not None:
+			data.clustersweep.table_sweep.to_csv(self.filename_table_cutoff_sweep, sep = self.delimiter, index = False)
+			for quantile, table_genotypes in data.clustersweep.table_genotypes.items():
+				filename = self.filename_table_cutoff_sweep.with_suffix(f".{quantile:g}.genotypes.{self.suffix}")
+				table_genotypes.to_csv(filename, sep = self.delimiter)
 
 		self.filename_data_genotype_members.write_text(json.dumps(data.genotype_members, indent = 4, sort_keys = True))
 
 	def save_workflow_hierarchy(self, data):
 		if data is not None:
 			self.filename_clusterdata.write_text(json.dumps(data.to_dict(), indent = 4, sort_keys = True))
+		if data is not None and data.table_linkage is not None:
+			data.get_saved_linkage().to_csv(self.filename_table_linkage, sep = self.delimiter)
 
 	def save_workflow_lineage(self, data):
 		data.table_scores.to_csv(self.filename_table_lineage_scores, sep = self.delimiter, index = False)
+		if data.lineage_sweep is not None:
+			data.lineage_sweep.summary.to_csv(self.filename_table_lineage_sweep, sep = self.delimiter)
+			data.lineage_sweep.parents.to_csv(self.filename_table_lineage_sweep_parents, sep = self.delimiter)
 
 	def save_workflow_ggmuller(self, data):
 		if not self.filename_table_population.exists():
@@ -167,6 +189,8 @@ class OutputFilenames:
 			table_edges = data.series_edges.to_frame().reset_index()
 			# GGmuller expected the columns to be ordered as ['Parent', 'Identity']
 			table_edges = table_edges[['Parent', 'Identity']]
+			if data.series_support is not None:
+				table_edges['Support'] = table_edges['Identity'].map(data.series_support)
 			table_edges.to_csv(self.filename_table_edges, sep = self.delimiter, index = False)
 
 		data.table_muller.to_csv(self.filename_table_muller, sep = self.delimiter, index = False)
@@ -70,7 +70,7 @@ class OutputGeneratorGraphics:
 	@staticmethod
 	def generate_dendrogram(linkage_matrix, distance_matrix, filename: Path) -> Path:
 		# Only need the distance matrix fpr the labels
-		labels = distance_matrix.squareform().index
+		labels = distance_matrix.labels
 		graphics.plot_dendrogram(linkage_matrix, labels, filename)
 		return filename
 	@staticmethod
@@ -1,3 +1,4 @@
+import math
 from pathlib import Path
 from typing import Dict, List, Optional
 
@@ -31,7 +32,8 @@ def flowchart(edges: pandas.DataFrame, palette: Dict[str, str], annotations: Dic
 	Parameters
 	----------
 	edges: pandas.DataFrame
-		Should have three columns: 'parent', 'identity', 'score'
+		Should have three columns: 'parent', 'identity', 'score'. The optional 'Support' column (the bootstrap support of each edge)
+		is shown as the label of each edge.
 	palette
 	annotations
 	filename: Optional[Path]
@@ -73,6 +75,10 @@ def flowchart(edges: pandas.DataFrame, palette: Dict[str, str], annotations: Dic
 		if add_score:
 			score = row.get('score', 0)
 			arguments['headlabel'] = f"{score:.1f}"
+		support = row.get('Support', math.nan)
+		if not pandas.isnull(support):
+			# Graphviz ignores edge labels when the edges are drawn with 'ortho' splines.
+			arguments['xlabel'] = f"{support:.0%}"
 		graph.add_edge(parent, identity, **arguments)
 
 	if filename:
@@ -1 +1,2 @@
 from .genotype_lineage import LineageWorkflow
+from .score_store import LineageScoreStore
@@ -1,14 +1,16 @@
 import math
 from typing import *
 
+import numpy
 import pandas
 from loguru import logger
-from shapely import geometry
-from shapely.errors import TopologicalError
 
 Number = Union[float, int]
 
-from . import polygon
+try:
+	from muller.inheritance import piecewise_area
+except ModuleNotFoundError:
+	from . import piecewise_area
 
 
 DEBUG = False
@@ -36,53 +38,17 @@ def area_of_series(series: pandas.Series) -> float:
 		can be considered a sequence of polygons where vertices correspond to the
 		x-values and y-values in the series.
 	"""
-	points = polygon.get_vertices(series)
-	collection_of_polygons:List[List[Tuple[float,float]]] = polygon.isolate_polygons(points)
-	area = 0
-	for poly in collection_of_polygons:
-		element_area = geometry.Polygon(poly).area
-		area += element_area
-	return area
+	return float(piecewise_area.area(piecewise_area.as_curve(series)))
 
 
 def calculate_common_area(left: pandas.Series, right: pandas.Series) -> float:
 	""" Calculates |X \cap Y|"""
-	# Use the pandas method for now. It is probably slower, but shouldn't add too much time, and should be more readable.
+	return float(piecewise_area.common_area(piecewise_area.as_curve(left), piecewise_area.as_curve(right)))
 
-	left_points = polygon.get_vertices(left) if isinstance(left, pandas.Series) else left  # Only decompose if the input was not a list of points.
-	right_points = polygon.get_vertices(right) if isinstance(right, pandas.Series) else right
 
-	# Test if one of the series has regions where it is undetected between other areas where it is detected.
-	# Basically whether the series needs to be represented by two separate points
-	# Since polygon.separate() can handle the case where the series does not need to be modified, may as well run it on all
-	# series instead of testing for disjoint polygons first.
-	left_collection = polygon.isolate_polygons(left_points)
-	right_collection = polygon.isolate_polygons(right_points)
-
-	left_collection_polygon = [geometry.Polygon(i) for i in left_collection if len(i) > 2]
-	right_collection_polygon = [geometry.Polygon(i) for i in right_collection if len(i) > 2]
-
-	left_collection_polygon = geometry.MultiPolygon(left_collection_polygon)
-	right_collection_polygon = geometry.MultiPolygon(right_collection_polygon)
-	try:
-		intersection = left_collection_polygon.intersection(right_collection_polygon)
-	except TopologicalError as exception:
-		logger.error(f"Cannot calculate the intersection:")
-		logger.error(f"\t{left_collection_polygon}")
-		logger.error(f"\t{right_collection_polygon}")
-		raise exception
-
-	total_intersection_area = intersection.area
-
-	return total_intersection_area
-
-
-def X_and_Y_polygon(left: geometry.MultiPolygon, right: geometry.MultiPolygon) -> float:
-	try:
-		return left.intersection(right).area
-	except TopologicalError:
-		logger.error(f"Polygonal error")
-		return 0
+def X_and_Y_curve(left: numpy.ndarray, right: numpy.ndarray) -> float:
+	""" Same as `calculate_common_area` for series which were already converted with `piecewise_area.as_curve`."""
+	return float(piecewise_area.common_area(left, right))
 
 
 def X_or_Y_numeric(left: float, right: float, x_and_y: float) -> float:
@@ -105,32 +71,16 @@ def X_or_Y(left: pandas.Series, right: pandas.Series) -> float:
 		left, right: pandas.Series
 			The two series to calculate the exclusive area on.
 	"""
-
-	left_polygons = polygon.as_polygon(left)
-	right_polygons = polygon.as_polygon(right)
-
-	multipolygon = geometry.MultiPolygon([left_polygons, right_polygons])
-	area = multipolygon.area - left_polygons.intersection(right_polygons).area
-
-	return area
+	return float(piecewise_area.union_area(piecewise_area.as_curve(left), piecewise_area.as_curve(right)))
 
 
 def X_xor_Y(left: pandas.Series, right: pandas.Series) -> float:
-	left_polygons = polygon.as_polygon(left)
-	right_polygons = polygon.as_polygon(right)
+	return float(piecewise_area.symmetric_difference_area(piecewise_area.as_curve(left), piecewise_area.as_curve(right)))
 
-	xor_polygons = left_polygons.symmetric_difference(right_polygons)
-	return xor_polygons.area
 
-
-def difference_polygon(left: geometry.MultiPolygon, right: geometry.MultiPolygon) -> float:
-	""" Returns the area of `left` not in `right`"""
-	try:
-		area = left.difference(right).area
-	except TopologicalError:
-		logger.error(f"Polygonal error")
-		area = 0
-	return area
+def difference_curve(left: numpy.ndarray, right: numpy.ndarray) -> float:
+	""" Returns the area of `left` not in `right`. Both should already be converted with `piecewise_area.as_curve`."""
+	return float(piecewise_area.difference_area(left, right))
 
 
 def jaccard_distance_numeric(x_or_y: float, x_and_y: float) -> float:
@@ -181,47 +131,46 @@ def jaccard_subset(left: pandas.Series, right: pandas.Series) -> float:
 
 
 def is_subset(left: pandas.Series, right: pandas.Series) -> bool:
-	""" A rewrite that uses the shapely library instead."""
-	left_poly = polygon.as_polygon(left)
-	right_poly = polygon.as_polygon(right)
-
-	try:
-		area_intersection = left_poly.intersection(right_poly).area
-	except TopologicalError:
-		logger.error(f"{left.values}, {left.index}")
-		logger.error(f"{right.values}, {right.index}")
-		logger.error(f"Left polygon: {left_poly}")
-		logger.error(f"Right polygon: {right_poly}")
-		logger.error(f"TopologyError")
-		return False
-
-	area_right = right_poly.area
+	""" Tests whether `right` is a subset of `left`."""
+	area_intersection = calculate_common_area(left, right)
+	area_right = area_of_series(right)
 
 	result = math.isclose(area_intersection, area_right, abs_tol = 0.03 ** 2)  # Tolerance is square of the detection limit.
 	return result
 
 
-def is_subset_polygon(left: geometry.MultiPolygon, right: geometry.MultiPolygon) -> bool:
-	area_union = left.union(right).area
-	area_intersection = left.intersection(right).area
-	area_left = left.area
-	area_right = right.area
-
-	result = math.isclose(area_intersection, area_right, abs_tol = 0.03 ** 2)
+def is_subset_numeric(left: float, right: float, left_not_right: float) -> bool:
+	"""
+		Tests whether `right` is a subset of `left` using pre-computed areas.
+	Parameters
+	----------
+	left, right: float
+		The area of each series.
+	left_not_right: float
+		The area of `left` which is not in `right`.
+	"""
+	area_union = right + left_not_right
+	area_intersection = left - left_not_right
 
-	jaccard_expected = (area_left - area_right) / area_left
+	jaccard_expected = (left - right) / left
 	jaccard_actual = (area_union - area_intersection) / area_union
 
 	if DEBUG:
-		logger.debug(f"left, right -> {area_left}, {area_right}")
-		logger.debug(f"Je = ({area_left:.2f} - {area_right:.2f}) / {area_left:.2f} = {jaccard_expected:.2f}")
+		logger.debug(f"left, right -> {left}, {right}")
+		logger.debug(f"Je = ({left:.2f} - {right:.2f}) / {left:.2f} = {jaccard_expected:.2f}")
 		logger.debug(f"Ja = ({area_union:.2f} - {area_intersection:.2f}) / {area_union:.2f} = {jaccard_actual:.2f}")
 
-		logger.debug(f"{jaccard_expected} == {jaccard_actual} -> {result}")
 	result = math.isclose(jaccard_expected, jaccard_actual, abs_tol = 0.1)
+	if DEBUG:
+		logger.debug(f"{jaccard_expected} == {jaccard_actual} -> {result}")
 	return result
 
 
+def is_subset_curve(left: numpy.ndarray, right: numpy.ndarray) -> bool:
+	""" Tests whether `right` is a subset of `left`. Both should already be converted with `piecewise_area.as_curve`."""
+	return is_subset_numeric(float(piecewise_area.area(left)), float(piecewise_area.area(right)), difference_curve(left, right))
+
+
 X_and_Y = calculate_common_area
 
 
@@ -1,11 +1,19 @@
 import math
-from typing import Dict, List, Mapping, Optional, Tuple, Union
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple, Union
 
+import numpy
 import pandas
 
+# The insertion order of pairs which are not candidates. Larger than the order of any candidate.
+NOT_A_CANDIDATE = numpy.iinfo(numpy.int64).max
+
 
 class Ancestry:
 	""" Holds the possible ancestry candidates as well as the confidance score for each.
+		The candidates are stored as a square array of priorities (`nan` if the nested genotype is not a candidate for the
+		unnested genotype) along with the order each candidate was added in, so the newest ancestor of every genotype can be
+		selected at once. A candidate can be added more than once (such as a manually-assigned parent which is also scored),
+		so any repeated candidates are kept in a separate list for the genotype, which is checked one candidate at a time.
 		Parameters
 		----------
 		initial_background: pandas.Series
@@ -32,32 +40,105 @@ class Ancestry:
 		# Make a copy to prevent unintended modifications to source table.
 		self.score_window = 2
 		self.timepoints = timepoints.copy()
-
-		# Keep track of the parent and confidence for each new genotype.
-		self.confidence: Dict[str, List[Tuple[str, float]]] = dict()
 		self.ancestral_genotype = 'genotype-0'
 
-		self.nests: Dict[str, List[str]] = dict()
+		# The position of each genotype in the candidate arrays.
+		self.labels: List[str] = list()
+		self.positions: Dict[str, int] = dict()
+		# The priority of each [unnested genotype, nested genotype] pair and the order each pair was added in.
+		self.priorities = numpy.full((0, 0), math.nan)
+		self.order = numpy.full((0, 0), NOT_A_CANDIDATE, dtype = numpy.int64)
+		# The order each unnested genotype was first given a candidate in.
+		self.unnested_order = numpy.full(0, NOT_A_CANDIDATE, dtype = numpy.int64)
+		# The (order, nested position, priority) of each candidate which was added again, for each unnested position.
+		self.repeated: Dict[int, List[Tuple[int, int, float]]] = dict()
+		self.total_added = 0
+		# The parent of each genotype is only selected once, until another candidate is added.
+		self._ancestry_table: Optional[pandas.Series] = None
+
+		self._get_positions([self.ancestral_genotype, initial_background.name] + list(timepoints.index))
 		self.add_genotype_to_background(initial_background.name, self.ancestral_genotype, 1)
 
+	def _get_positions(self, labels: Iterable[str]) -> numpy.ndarray:
+		""" Returns the position of each label in the candidate arrays, adding any new labels."""
+		positions = list()
+		for label in labels:
+			if label not in self.positions:
+				self.positions[label] = len(self.labels)
+				self.labels.append(label)
+			positions.append(self.positions[label])
+
+		capacity = len(self.priorities)
+		if len(self.labels) > capacity:
+			# Grow the arrays geometrically so that adding one label at a time is not quadratic.
+			size = max(len(self.labels), 2 * capacity)
+			priorities = numpy.full((size, size), math.nan)
+			priorities[:capacity, :capacity] = self.priorities
+			order = numpy.full((size, size), NOT_A_CANDIDATE, dtype = numpy.int64)
+			order[:capacity, :capacity] = self.order
+			unnested_order = numpy.full(size, NOT_A_CANDIDATE, dtype = numpy.int64)
+			unnested_order[:capacity] = self.unnested_order
+			self.priorities, self.order, self.unnested_order = priorities, order, unnested_order
+		return numpy.array(positions, dtype = numpy.int64)
+
 	def add_genotype_to_background(self, unnested_label: str, nested_label: str, priority: Union[int, float]) -> None:
-		if unnested_label not in self.nests:
-			self.nests[unnested_label] = list()
+		self.add_candidates(unnested_label, [(nested_label, priority)])
+
+	def add_candidates(self, unnested_label: str, candidates: List[Tuple[str, Union[int, float]]]) -> None:
+		""" Same as calling `add_genotype_to_background` with each (nested label, priority) pair in `candidates`."""
+		if not candidates:
+			return
+		row = self._get_positions([unnested_label])[0]
+		columns = self._get_positions([nested_label for nested_label, _ in candidates])
+		priorities = numpy.array([priority for _, priority in candidates], dtype = float)
+		order = self.total_added + numpy.arange(len(candidates))
+
+		# Only the first time each candidate is added is stored in the arrays.
+		_, first = numpy.unique(columns, return_index = True)
+		is_new = numpy.zeros(len(columns), dtype = bool)
+		is_new[first] = self.order[row, columns[first]] == NOT_A_CANDIDATE
+		self.priorities[row, columns[is_new]] = priorities[is_new]
+		self.order[row, columns[is_new]] = order[is_new]
+		if not is_new.all():
+			repeated = zip(order[~is_new].tolist(), columns[~is_new].tolist(), priorities[~is_new].tolist())
+			self.repeated.setdefault(row, list()).extend(repeated)
+		self.unnested_order[row] = min(self.unnested_order[row], order[0])
+		self.total_added += len(candidates)
+		self._ancestry_table = None
+
+	def _get_candidates(self, row: int) -> List[Tuple[int, float]]:
+		""" Returns the position and priority of each candidate of the genotype at `row`, in the order they were added."""
+		order = self.order[row, :len(self.labels)]
+		columns = numpy.flatnonzero(order != NOT_A_CANDIDATE)
+		candidates = list(zip(order[columns].tolist(), columns.tolist(), self.priorities[row, columns].tolist()))
+		candidates = sorted(candidates + self.repeated.get(row, []))
+		return [(column, priority) for _, column, priority in candidates]
 
-		self.nests[unnested_label].append(nested_label)
+	def _get_unnested_rows(self) -> numpy.ndarray:
+		""" Returns the position of each genotype with at least one candidate, in the order they were first added."""
+		order = self.unnested_order[:len(self.labels)]
+		rows = numpy.flatnonzero(order != NOT_A_CANDIDATE)
+		return rows[numpy.argsort(order[rows], kind = 'stable')]
 
-		if unnested_label not in self.confidence:
-			self.confidence[unnested_label] = []
-		self.confidence[unnested_label].append((nested_label, priority))
+	@property
+	def nests(self) -> Dict[str, List[str]]:
+		return {self.labels[row]: [self.labels[column] for column, _ in self._get_candidates(row)] for row in self._get_unnested_rows()}
+
+	@property
+	def confidence(self) -> Dict[str, List[Tuple[str, float]]]:
+		return {
+			self.labels[row]: [(self.labels[column], priority) for column, priority in self._get_candidates(row)]
+			for row in self._get_unnested_rows()
+		}
 
 	def get(self, label: str) -> List[str]:
-		return self.nests[label]
+		return [self.labels[column] for column, _ in self._get_candidates(self.positions[label])]
 
 	def is_a_member(self, label: str) -> bool:
-		return label in self.nests.keys()
+		return label in self.positions and self.unnested_order[self.positions[label]] != NOT_A_CANDIDATE
 
 	def get_sum_of_backgrounds(self) -> pandas.Series:
-		background_labels = [k for k in self.nests.keys() if self.is_a_background(k)]
+		background_labels = [self.labels[row] for row in self._get_unnested_rows() if self.is_a_background(self.labels[row])]
 		background_frequencies = self.timepoints.loc[background_labels]
 		total = background_frequencies.sum()
 		return total
@@ -84,64 +165,99 @@ class Ancestry:
 
 		return candidate, score
 
+	def _select_candidates(self, rows: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+		"""
+			Selects the newest ancestor of the genotypes at each of `rows`: the first candidate which was added with a score above
+			`minimum_score` and within `score_window` of the maximum score.
+			Returns the position and score of each selected candidate, and whether a candidate was selected.
+		"""
+		total = len(self.labels)
+		priorities = self.priorities[rows, :total]
+		with numpy.errstate(invalid = 'ignore'):
+			maximum = numpy.fmax.reduce(priorities, axis = 1)
+			# `nan` priorities (the pairs which are not candidates) are never selected.
+			is_selectable = (priorities > self.minimum_score) & (numpy.abs(maximum[:, None] - priorities) <= self.score_window)
+		order = numpy.where(is_selectable, self.order[rows, :total], NOT_A_CANDIDATE)
+		selected = order.argmin(axis = 1)
+		is_selected = is_selectable.any(axis = 1)
+		scores = numpy.where(is_selected, priorities[numpy.arange(len(rows)), selected], math.nan)
+
+		# The genotypes with repeated candidates are checked one candidate at a time, in the order they were added.
+		for index in numpy.flatnonzero(numpy.isin(rows, list(self.repeated))):
+			candidates = self._get_candidates(rows[index])
+			maximum_score = max(priority for _, priority in candidates)
+			is_selected[index] = False
+			scores[index] = math.nan
+			for column, priority in candidates:
+				if priority > self.minimum_score and abs(maximum_score - priority) <= self.score_window:
+					selected[index], scores[index], is_selected[index] = column, priority, True
+					break
+		return selected, scores, is_selected
+
 	def get_highest_priority(self, label: str) -> Tuple[Optional[str], float]:
 		""" Returns the genotype label representing the newest ancestor for the genotype indicated by `label`."""
-		candidates = self.confidence.get(label, [])
-		maximum_genotype, maximum_score = max(candidates, key = lambda s: s[1])
-
-		for candidate, score in candidates:
-			# Make sure the score is within 2 or so of the maximum.
-			# Will output the genotype with the maximum score if no other genotype exists with 2 points of the maximum.
-			if score > self.minimum_score and abs(maximum_score - score) <= self.score_window:
-				return candidate, score
+		selected, scores, is_selected = self._select_candidates(numpy.array([self.positions[label]]))
+		# Will output the genotype with the maximum score if no other genotype exists with 2 points of the maximum.
+		if is_selected[0]:
+			return self.labels[selected[0]], float(scores[0])
 		else:
 			return None, math.nan
 
-
 	def as_ancestry_table(self) -> pandas.Series:
-		table = list()
-		for identity, background in self.nests.items():
-			# parent = self.get_highest_priority(identity)
-			# if parent is None:
-			parent, score = self.get_highest_priority(identity)
-			if parent == identity or parent is None:
-				parent = self.ancestral_genotype
-			row = {
-				'Parent':   parent,
-				'Identity': identity
-			}
-			table.append(row)
-		table = pandas.DataFrame(table)[['Parent', 'Identity']]  # Reorder columns
-
-		return table.set_index('Identity')['Parent']
+		if self._ancestry_table is None:
+			rows = self._get_unnested_rows()
+			selected, _, is_selected = self._select_candidates(rows)
+			labels = numpy.array(self.labels, dtype = object)
+			parents = numpy.where(is_selected & (selected != rows), labels[selected], self.ancestral_genotype)
+			table = pandas.Series(parents, index = pandas.Index(labels[rows], name = 'Identity'), name = 'Parent', dtype = object)
+			self._ancestry_table = table
+		return self._ancestry_table.copy()
+
+	def get_parent(self, identity: str) -> str:
+		""" Returns the parent of `identity` as shown in the ancestry table."""
+		if self._ancestry_table is None:
+			self.as_ancestry_table()
+		return self._ancestry_table[identity]
+
+	def creates_cycle(self, identity: str, parent: str) -> bool:
+		""" Tests whether `identity` is already an ancestor of `parent`, based on the current parent of each genotype."""
+		if identity == parent:
+			return True
+		if self._ancestry_table is None:
+			self.as_ancestry_table()
+		ancestor = parent
+		# Every genotype has a single parent, so any path without a cycle visits each genotype at most once.
+		for _ in range(len(self._ancestry_table)):
+			if ancestor not in self._ancestry_table.index or ancestor == self.ancestral_genotype:
+				return False
+			ancestor = self._ancestry_table[ancestor]
+			if ancestor == identity:
+				return True
+		return False
 
 	def as_dict(self) -> Mapping[str, str]:
 		return self.as_ancestry_table().to_dict()
 
 	def priority_table(self) -> pandas.DataFrame:
-		data = list()
-		for identity, background in self.nests.items():
-			# parent = self.get_highest_priority(identity)
-			# if parent is None:
-			parent, score = self.get_highest_priority(identity)
-			if parent == identity or parent is None:
-				parent = self.ancestral_genotype
-			row = {
-				'parent':   parent,
-				'identity': identity,
-				'score':    score
-			}
-			data.append(row)
-		return pandas.DataFrame(data)
+		rows = self._get_unnested_rows()
+		selected, scores, is_selected = self._select_candidates(rows)
+		labels = numpy.array(self.labels, dtype = object)
+		return pandas.DataFrame({
+			'parent':   numpy.where(is_selected & (selected != rows), labels[selected], self.ancestral_genotype),
+			'identity': labels[rows],
+			'score':    scores
+		})
 
 	def to_table(self) -> pandas.DataFrame:
-		data = list()
-		for identity, candidates in self.confidence.items():
-			for candidate, score in candidates:
-				row = {
-					'identity':  identity,
-					'candidate': candidate,
-					'score':     score
-				}
-				data.append(row)
-		return pandas.DataFrame(data)
+		rows = list()
+		candidates = list()
+		for row in self._get_unnested_rows():
+			row_candidates = self._get_candidates(row)
+			rows += [row] * len(row_candidates)
+			candidates += row_candidates
+		labels = numpy.array(self.labels, dtype = object)
+		return pandas.DataFrame({
+			'identity':  labels[rows],
+			'candidate': labels[[column for column, _ in candidates]],
+			'score':     [priority for _, priority in candidates]
+		})
@@ -0,0 +1,67 @@
+"""
+	Indexes the window in which each genotype was detected so that the pairs of genotypes which were never detected at the same
+	time can be found without comparing each series. These pairs cannot overlap (`widgets.overlap` is 0), so most of the
+	scores calculated by `scoring.Score.score_pair` are already known (see `scoring.Score.score_pruned_pair`).
+"""
+from typing import Dict, List
+
+import numpy
+import pandas
+
+try:
+	from muller.inheritance import score_matrix
+except ModuleNotFoundError:
+	from . import score_matrix
+
+
+class GenotypeIntervals:
+	"""
+		An interval index over the first and last timepoint each genotype was detected at.
+	Parameters
+	----------
+	genotypes: pandas.DataFrame
+		The genotype table. The timepoints should be sorted (see `score_matrix.has_sorted_timepoints`).
+	dlimit: float
+		The detection limit.
+	"""
+
+	def __init__(self, genotypes: pandas.DataFrame, dlimit: float):
+		detected = genotypes.values > dlimit
+		is_detected = detected.any(axis = 1)
+		total_timepoints = detected.shape[1]
+		first = numpy.where(is_detected, detected.argmax(axis = 1), numpy.nan)
+		last = numpy.where(is_detected, total_timepoints - 1 - detected[:, ::-1].argmax(axis = 1), numpy.nan)
+
+		self.labels: List[str] = list(genotypes.index)
+		self.positions: Dict[str, int] = {label: index for index, label in enumerate(self.labels)}
+		# Genotypes which were never detected have a missing interval, which never overlaps another interval.
+		self.detected = pandas.IntervalIndex.from_arrays(first, last, closed = 'both')
+		self.first = first
+		self.last = last
+
+	def __len__(self) -> int:
+		return len(self.labels)
+
+	def get_candidates(self, label: str) -> numpy.ndarray:
+		"""
+			Returns whether each genotype could overlap the genotype `label`, and so must be scored completely.
+			The other genotypes were never detected at the same time as `label`. Pairs which were only detected within less than
+			3 timepoints are always candidates, since the summation score used for these pairs does not depend on the overlap.
+		"""
+		index = self.positions[label]
+		if numpy.isnan(self.first[index]):
+			overlaps = numpy.zeros(len(self), dtype = bool)
+		else:
+			overlaps = self.detected.overlaps(pandas.Interval(self.first[index], self.last[index], closed = 'both'))
+		# The number of timepoints between the first and last timepoint either genotype was detected at.
+		span = numpy.fmax(self.last, self.last[index]) - numpy.fmin(self.first, self.first[index]) + 1
+		return overlaps | ~(span >= 3)
+
+	def count_pruned_pairs(self) -> int:
+		""" The number of pairs of genotypes compared by `LineageWorkflow` which are not candidates."""
+		return sum(int((~self.get_candidates(label)[:index]).sum()) for index, label in enumerate(self.labels))
+
+
+def can_be_pruned(genotypes: pandas.DataFrame) -> bool:
+	""" The detected windows are positions, so the pairs can only be pruned if the timepoints are selected by position."""
+	return genotypes.index.is_unique and score_matrix.has_sorted_timepoints(genotypes)
@@ -1,17 +1,22 @@
 from typing import Dict, List, Optional, Tuple
 
+import numpy
 import pandas
 from loguru import logger
 
 try:
-	from muller.inheritance import scoring
+	from muller.inheritance import genotype_intervals, lineage_bootstrap, lineage_parallel, scoring, score_matrix
 	from muller.inheritance.genotype_ancestry import Ancestry
+	from muller.inheritance.score_store import LineageScoreStore, get_parameters
 	from muller import widgets, dataio
 except ModuleNotFoundError:
-	from . import scoring
+	from . import genotype_intervals, lineage_bootstrap, lineage_parallel, scoring, score_matrix
 	from .genotype_ancestry import Ancestry
+	from .score_store import LineageScoreStore, get_parameters
 	from .. import widgets, dataio
 
+ACCEPTED_ENGINES = ['pairwise', 'vectorized']
+
 
 class LineageWorkflow:
 	"""
@@ -24,23 +29,58 @@ class LineageWorkflow:
 		The cutoff value to consider a genotype "fixed"
 	pvalue: float
 		The pvalue to use for statistical tests.
+	engine: {'pairwise', 'vectorized'}; default 'vectorized'
+		Whether to score each pair of genotypes separately or to score every pair at once with `score_matrix`. Tables which
+		cannot be scored as arrays (see `score_matrix.is_supported`) always use the 'pairwise' engine.
+	threads: Optional[int]
+		The number of processes used to score the genotypes. With the 'pairwise' engine each process scores a group of
+		unnested genotypes, and with the 'vectorized' engine each process scores a block of nested genotypes. When only
+		some of the genotypes are missing from `score_store`, they are rescored with a single process.
+	prune: bool; default True
+		Whether the 'pairwise' engine should skip most of the scores for pairs of genotypes which were never detected at the same
+		time. These pairs are found with an interval index over the detected window of each genotype. The scores are unchanged.
+	score_store: Optional[LineageScoreStore]
+		A database of the scores calculated in previous runs. Only the pairs which include a genotype whose frequencies are not
+		in the database are scored, with the selected engine. The new scores are saved to the database.
+	bootstrap: int; default 0
+		The number of bootstrap replicates used to estimate the support of each edge (see `lineage_bootstrap`). The replicates
+		are split between `threads` processes.
+	bootstrap_depth: int
+		The number of reads used to resample each frequency in the bootstrap replicates.
 	"""
 
-	def __init__(self, dlimit: float, flimit: float, pvalue: float, weights = (1, 1, 2, 2), conservative:bool = False,debug: bool = False):
+	def __init__(self, dlimit: float, flimit: float, pvalue: float, weights = (1, 1, 2, 2), conservative:bool = False,debug: bool = False,
+			engine: str = 'vectorized', threads: Optional[int] = None, prune: bool = True, score_store: Optional[LineageScoreStore] = None,
+			bootstrap: int = 0, bootstrap_depth: int = lineage_bootstrap.DEFAULT_DEPTH):
+		if engine not in ACCEPTED_ENGINES:
+			message = f"'{engine}' is not a valid scoring engine. Expected one of {ACCEPTED_ENGINES}"
+			raise ValueError(message)
+		self.engine = engine
+		self.threads = threads
+		self.prune = prune
+		self.score_store = score_store
+		self.bootstrap = bootstrap
+		self.bootstrap_depth = bootstrap_depth
 		self.dlimit = dlimit
 		self.flimit = flimit
 		self.pvalue = pvalue
 		self.debug = debug
 		self.genotype_nests: Optional[Ancestry] = None
 		self.conservative = conservative
-		self.scorer = scoring.Score(self.dlimit, self.flimit, self.pvalue, weights)
+		# Each genotype is part of many pairs, so its area is only calculated once.
+		self.area_cache = scoring.AreaCache()
+		self.scorer = scoring.Score(self.dlimit, self.flimit, self.pvalue, weights, area_cache = self.area_cache)
 
 	def __repr__(self)->str:
 		return f"LineageWorkflow(dlimit = {self.dlimit}, flimit = {self.flimit}, pvalue = {self.pvalue})"
 
 	def add_known_lineages(self, known_ancestry: Dict[str, str]):
 		for identity, parent in known_ancestry.items():
-			# TODO need to add a way to prevent circular ancestry links when a user manually assigns ancestry. Current workaround forces the manual parent to be in the root background.
+			# The manual parent is placed in the root background unless it was already assigned a parent. Links which would
+			# make a genotype its own ancestor are skipped.
+			if self.genotype_nests.creates_cycle(identity, parent):
+				logger.warning(f"Ignoring the known ancestry of {identity} since {identity} is already an ancestor of {parent}.")
+				continue
 			logger.debug(f"Adding {parent} as a potential background for {identity}")
 			self.genotype_nests.add_genotype_to_background(parent, 'genotype-0', priority = 100)
 			# Use a dummy priority so that it is selected before other backgrounds.
@@ -64,30 +104,168 @@ class LineageWorkflow:
 			circular links from forming.
 		"""
 
-		initial_background = sorted_genotypes.iloc[0]
-		self.genotype_nests = Ancestry(initial_background, timepoints = sorted_genotypes, cautious = self.conservative)
-		self.add_known_lineages(known_ancestry if known_ancestry else dict())
-
-		score_records: List[Dict[str, float]] = list()  # Keeps track of the individual score values for each pair
+		self.initialize_ancestry(sorted_genotypes, known_ancestry)
 
-		for unnested_label, unnested_trajectory in sorted_genotypes[1:].iterrows():
-			# Iterate over the rest of the table in reverse order. Basically, we start with the newest nest and iterate until we find a nest that satisfies the filters.
-			test_table = sorted_genotypes[:unnested_label].iloc[::-1]
-			for nested_label, nested_genotype in test_table.iterrows():
-				if nested_label == unnested_label: continue
-				score_data = self.scorer.score_pair(nested_genotype, unnested_trajectory)
-				score_records.append(score_data)
-				self.genotype_nests.add_genotype_to_background(unnested_label, nested_label, score_data['totalScore'])
+		if self.score_store is not None and sorted_genotypes.index.is_unique:
+			table_scores = self.score_cached(sorted_genotypes)
+		elif self.engine == 'vectorized' and score_matrix.is_supported(sorted_genotypes):
+			table_scores = self.score_vectorized(sorted_genotypes)
+		else:
+			table_scores = self.score_pairwise(sorted_genotypes)
 
 		self.show_ancestry(sorted_genotypes)
 
+		if self.bootstrap:
+			series_support = self.bootstrap_lineage(sorted_genotypes, known_ancestry).support
+		else:
+			series_support = None
+
 		output_data = dataio.projectdata.DataGenotypeLineage(
-			table_scores = pandas.DataFrame(score_records),
+			table_scores = table_scores,
 			clusters = self.genotype_nests, # Used to extract the `edges` table.
+			series_support = series_support
 		)
 
 		return output_data
 
+	def bootstrap_lineage(self, sorted_genotypes: pandas.DataFrame, known_ancestry: Dict[str, str] = None) -> lineage_bootstrap.LineageBootstrap:
+		""" Compares the current lineage against the lineage of `self.bootstrap` perturbed copies of `sorted_genotypes`."""
+		logger.info(f"Calculating the support of each edge with {self.bootstrap} bootstrap replicates...")
+		weights = (self.scorer.weight_greater, self.scorer.weight_above_fixed, self.scorer.weight_derivative, self.scorer.weight_jaccard)
+		# Each replicate is inferred by a single process.
+		workflow = LineageWorkflow(self.dlimit, self.flimit, self.pvalue, weights, conservative = self.conservative, engine = self.engine,
+			prune = self.prune)
+		return lineage_bootstrap.run_bootstrap(
+			workflow,
+			sorted_genotypes,
+			parents = self.genotype_nests.as_ancestry_table(),
+			replicates = self.bootstrap,
+			depth = self.bootstrap_depth,
+			processes = self.threads,
+			known_ancestry = known_ancestry
+		)
+
+	def infer_ancestry(self, sorted_genotypes: pandas.DataFrame, known_ancestry: Dict[str, str] = None) -> Ancestry:
+		""" Same as `run`, but only returns the candidate backgrounds. Used when the score of each pair is not needed."""
+		self.initialize_ancestry(sorted_genotypes, known_ancestry)
+		if self.engine == 'vectorized' and score_matrix.is_supported(sorted_genotypes):
+			self.add_score_matrix(self.calculate_score_matrix(sorted_genotypes))
+		else:
+			self.score_pairwise(sorted_genotypes)
+		return self.genotype_nests
+
+	def initialize_ancestry(self, sorted_genotypes: pandas.DataFrame, known_ancestry: Dict[str, str] = None):
+		""" Starts a new set of candidate backgrounds, with the first genotype as the initial background."""
+		self.area_cache.clear()
+		initial_background = sorted_genotypes.iloc[0]
+		self.genotype_nests = Ancestry(initial_background, timepoints = sorted_genotypes, cautious = self.conservative)
+		self.add_known_lineages(known_ancestry if known_ancestry else dict())
+
+	def add_score_matrix(self, scores: score_matrix.ScoreMatrix):
+		""" Adds the score of each pair to the candidate backgrounds in the same order as `score_pairwise`."""
+		for unnested_label, candidates in scores.get_candidates():
+			self.genotype_nests.add_candidates(unnested_label, candidates)
+
+	def get_score_records(self, sorted_genotypes: pandas.DataFrame) -> List[Dict[str, float]]:
+		""" Scores each pair of genotypes with `Score.score_pair`, in the order the pairs are added to the candidate backgrounds."""
+		prune = self.prune and genotype_intervals.can_be_pruned(sorted_genotypes)
+		intervals = genotype_intervals.GenotypeIntervals(sorted_genotypes, self.dlimit) if prune else None
+		if intervals is not None:
+			total_pairs = len(sorted_genotypes) * (len(sorted_genotypes) - 1) // 2
+			pruned_pairs = intervals.count_pruned_pairs()
+			logger.info(f"Skipped {pruned_pairs} of {total_pairs} pairs of genotypes which were never detected at the same time.")
+
+		if self.threads and self.threads > 1 and len(sorted_genotypes) > 2:
+			logger.debug(f"Scoring the genotype pairs with {self.threads} processes...")
+			score_records = lineage_parallel.score_pairs_parallel(self.scorer, sorted_genotypes, self.threads, prune)
+		else:
+			score_records = lineage_parallel.score_unnested_genotypes(self.scorer, sorted_genotypes, 1, len(sorted_genotypes), intervals)
+			logger.debug(f"Area cache: {len(self.area_cache)} genotypes, {self.area_cache.hits} hits, {self.area_cache.misses} misses.")
+		return score_records
+
+	def score_pairwise(self, sorted_genotypes: pandas.DataFrame) -> pandas.DataFrame:
+		""" Scores each pair of genotypes with `Score.score_pair` and adds each score to the candidate backgrounds."""
+		score_records = self.get_score_records(sorted_genotypes)
+		for score_data in score_records:
+			self.genotype_nests.add_genotype_to_background(score_data['unnestedGenotype'], score_data['nestedGenotype'], score_data['totalScore'])
+		return pandas.DataFrame(score_records)
+
+	def calculate_score_matrix(self, sorted_genotypes: pandas.DataFrame) -> score_matrix.ScoreMatrix:
+		""" Scores every pair of genotypes with `score_matrix`, splitting the pairs between `self.threads` processes."""
+		if self.threads and self.threads > 1 and len(sorted_genotypes) > 2:
+			logger.debug(f"Scoring the genotype pairs with {self.threads} processes...")
+			components = lineage_parallel.calculate_component_scores_parallel(self.scorer, sorted_genotypes, self.threads)
+			weights = (self.scorer.weight_greater, self.scorer.weight_above_fixed, self.scorer.weight_derivative, self.scorer.weight_jaccard)
+			return components.score(weights, self.scorer.pvalue)
+		return score_matrix.calculate_score_matrix(self.scorer, sorted_genotypes)
+
+	def score_vectorized(self, sorted_genotypes: pandas.DataFrame) -> pandas.DataFrame:
+		""" Scores every pair of genotypes at once and adds each score to the candidate backgrounds in the same order as `score_pairwise`."""
+		scores = self.calculate_score_matrix(sorted_genotypes)
+		self.add_score_matrix(scores)
+		return scores.to_table()
+
+	def score_cached(self, sorted_genotypes: pandas.DataFrame) -> pandas.DataFrame:
+		"""
+			Reads the known scores from `self.score_store` and only scores the missing pairs, then adds each score to the
+			candidate backgrounds in the same order as `score_pairwise`.
+		"""
+		parameters = get_parameters(self.scorer, sorted_genotypes)
+		scores = score_matrix.create_score_matrix(list(sorted_genotypes.index), isinstance(self.scorer.weight_jaccard, float))
+		found = self.score_store.read(sorted_genotypes, parameters, scores)
+		# Each genotype is only compared against the genotypes before it.
+		missing = numpy.triu(~found, k = 1)
+		total_pairs = len(scores) * (len(scores) - 1) // 2
+		total_missing = int(missing.sum())
+		logger.info(f"Found {total_pairs - total_missing} of {total_pairs} lineage scores in '{self.score_store.filename}' ({total_missing} missing).")
+
+		if total_missing and self.engine == 'vectorized' and score_matrix.is_supported(sorted_genotypes):
+			changed = get_changed_genotypes(missing)
+			if len(changed) > len(scores) // 2:
+				scores = self.calculate_score_matrix(sorted_genotypes)
+			else:
+				score_matrix.update_score_matrix(scores, self.scorer, sorted_genotypes, changed)
+		elif total_missing == total_pairs:
+			scores.set_records(self.get_score_records(sorted_genotypes))
+		elif total_missing:
+			scores.set_records(self.score_missing_pairs(sorted_genotypes, missing))
+
+		if total_missing:
+			self.score_store.write(sorted_genotypes, parameters, scores, found)
+		logger.debug(f"Lineage score cache: {self.score_store.hits} hits, {self.score_store.misses} misses.")
+		self.add_score_matrix(scores)
+		return scores.to_table()
+
+	def score_missing_pairs(self, sorted_genotypes: pandas.DataFrame, missing: numpy.ndarray) -> List[Dict[str, float]]:
+		""" Scores the pairs of genotypes where `missing[nested, unnested]` is `True` with `Score.score_pair`."""
+		prune = self.prune and genotype_intervals.can_be_pruned(sorted_genotypes)
+		intervals = genotype_intervals.GenotypeIntervals(sorted_genotypes, self.dlimit) if prune else None
+		score_records = list()
+		for unnested in numpy.flatnonzero(missing.any(axis = 0)):
+			unnested_trajectory = sorted_genotypes.iloc[unnested]
+			candidates = intervals.get_candidates(unnested_trajectory.name) if intervals is not None else None
+			for nested in numpy.flatnonzero(missing[:, unnested])[::-1]:
+				nested_genotype = sorted_genotypes.iloc[nested]
+				if candidates is None or candidates[nested]:
+					score_records.append(self.scorer.score_pair(nested_genotype, unnested_trajectory))
+				else:
+					score_records.append(self.scorer.score_pruned_pair(nested_genotype, unnested_trajectory))
+		return score_records
+
+
+
+def get_changed_genotypes(missing: numpy.ndarray) -> numpy.ndarray:
+	"""
+		Returns the position of each genotype which should be rescored so that every pair in `missing` ([nested, unnested]) is
+		rescored. New or modified genotypes are missing most of their pairs, while the other genotypes are only missing their
+		pairs with these genotypes.
+	"""
+	total_missing = missing.sum(axis = 0) + missing.sum(axis = 1)
+	is_changed = total_missing * 2 > len(missing) - 1
+	# Any other missing pair (such as a pair removed from a full database) is rescored with its unnested genotype.
+	uncovered = missing & ~is_changed[:, None] & ~is_changed[None, :]
+	is_changed |= uncovered.any(axis = 0)
+	return numpy.flatnonzero(is_changed)
 
 
 def get_maximum_genotype_delta(genotype_deltas: List[Tuple[str, float]]) -> Tuple[str, float]:
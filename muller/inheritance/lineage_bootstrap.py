@@ -0,0 +1,142 @@
+"""
+	Estimates how well each edge of the inferred lineage is supported by the genotype frequencies. Each bootstrap replicate
+	resamples every frequency as the fraction of `depth` reads which carry the genotype, which is the same binomial
+	measurement error assumed by the binomial distance metric, then infers the lineage of the perturbed table. The support of
+	an edge is the fraction of replicates which selected the same parent for the genotype.
+
+	The genotypes keep the order of the original table in every replicate, and each worker process creates a single
+	`LineageWorkflow` which is reused for every replicate it is given.
+"""
+import multiprocessing
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy
+import pandas
+from loguru import logger
+
+# The number of reads used to resample each frequency.
+DEFAULT_DEPTH = 100
+# Splitting the replicates into several groups per process keeps the processes busy when some groups take longer than others.
+GROUPS_PER_PROCESS = 8
+
+# Populated in each worker process by `_initialize_worker`.
+_worker_data: Dict[str, Any] = dict()
+
+
+@dataclass
+class LineageBootstrap:
+	"""
+		parents: pandas.DataFrame
+			The parent of each genotype (rows) selected by each bootstrap replicate (columns).
+		support: pandas.Series
+			The fraction of replicates which selected the same parent as the original lineage for each genotype.
+	"""
+	parents: pandas.DataFrame
+	support: pandas.Series
+
+
+def perturb_frequencies(values: numpy.ndarray, depth: int, generator: numpy.random.Generator) -> numpy.ndarray:
+	""" Resamples each frequency in `values` as the fraction of `depth` reads drawn from a binomial distribution."""
+	probabilities = numpy.clip(numpy.nan_to_num(values), 0, 1)
+	return generator.binomial(depth, probabilities) / depth
+
+
+def get_replicate_groups(total_replicates: int, total_groups: int) -> List[Tuple[int, int]]:
+	""" Splits the replicates into contiguous [start, stop) groups of a similar size."""
+	size = max(1, -(-total_replicates // max(1, total_groups)))
+	return [(start, min(start + size, total_replicates)) for start in range(0, total_replicates, size)]
+
+
+def infer_replicate_parents(workflow: Any, genotypes: pandas.DataFrame, known_ancestry: Optional[Dict[str, str]], depth: int,
+		seed: int, start: int, stop: int) -> List[List[str]]:
+	"""
+		Infers the parent of each genotype for the bootstrap replicates [`start`, `stop`).
+	Parameters
+	----------
+	workflow: LineageWorkflow
+		Infers the lineage of each replicate. Should not be configured to bootstrap the replicates itself.
+	genotypes: pandas.DataFrame
+		The sorted genotype table.
+	known_ancestry: Optional[Dict[str, str]]
+	depth: int
+		The number of reads used to resample each frequency.
+	seed: int
+		Each replicate uses its own random generator seeded with (`seed`, replicate), so the replicates do not depend on how
+		they are split between processes.
+	start, stop: int
+	"""
+	values = genotypes.values.astype(float)
+	replicate_parents = list()
+	for replicate in range(start, stop):
+		generator = numpy.random.default_rng((seed, replicate))
+		table = pandas.DataFrame(perturb_frequencies(values, depth, generator), index = genotypes.index, columns = genotypes.columns)
+		ancestry = workflow.infer_ancestry(table, known_ancestry)
+		replicate_parents.append([ancestry.get_parent(label) for label in genotypes.index])
+	return replicate_parents
+
+
+def _initialize_worker(workflow: Any, genotypes: pandas.DataFrame, known_ancestry: Optional[Dict[str, str]], depth: int, seed: int):
+	_worker_data.update(workflow = workflow, genotypes = genotypes, known_ancestry = known_ancestry, depth = depth, seed = seed)
+
+
+def _infer_group(group: Tuple[int, int]) -> List[List[str]]:
+	start, stop = group
+	return infer_replicate_parents(
+		_worker_data['workflow'], _worker_data['genotypes'], _worker_data['known_ancestry'], _worker_data['depth'], _worker_data['seed'],
+		start, stop
+	)
+
+
+def run_bootstrap(workflow: Any, sorted_genotypes: pandas.DataFrame, parents: pandas.Series, replicates: int,
+		depth: int = DEFAULT_DEPTH, processes: Optional[int] = None, known_ancestry: Optional[Dict[str, str]] = None,
+		seed: int = 0) -> LineageBootstrap:
+	"""
+		Calculates the bootstrap support of each edge in the lineage inferred from `sorted_genotypes`.
+	Parameters
+	----------
+	workflow: LineageWorkflow
+		Infers the lineage of each replicate. Should not be configured to bootstrap the replicates itself.
+	sorted_genotypes: pandas.DataFrame
+		The sorted genotype table, as given to `LineageWorkflow.run`.
+	parents: pandas.Series
+		The parent of each genotype in the original lineage (see `Ancestry.as_ancestry_table`).
+	replicates: int
+		The number of bootstrap replicates.
+	depth: int
+		The number of reads used to resample each frequency.
+	processes: Optional[int]
+		The number of worker processes. The replicates are inferred in this process if not given.
+	known_ancestry: Optional[Dict[str, str]]
+		Manually-assigned ancestry values, which are used for every replicate.
+	seed: int
+	"""
+	if processes and processes > 1 and replicates > 1:
+		logger.debug(f"Inferring {replicates} bootstrap replicates with {processes} processes...")
+		groups = get_replicate_groups(replicates, processes * GROUPS_PER_PROCESS)
+		pool = multiprocessing.Pool(
+			processes = processes,
+			initializer = _initialize_worker,
+			initargs = (workflow, sorted_genotypes, known_ancestry, depth, seed)
+		)
+		replicate_parents = list()
+		try:
+			# `imap` returns the groups in order, so the replicates are in the same order as with a single process.
+			for group_parents in pool.imap(_infer_group, groups):
+				replicate_parents += group_parents
+			pool.close()
+		except BaseException:
+			pool.terminate()
+			raise
+		finally:
+			pool.join()
+	else:
+		replicate_parents = infer_replicate_parents(workflow, sorted_genotypes, known_ancestry, depth, seed, 0, replicates)
+
+	table = pandas.DataFrame(replicate_parents, columns = sorted_genotypes.index).transpose()
+	table.index.name = 'Identity'
+	expected = parents.reindex(table.index)
+	support = table.eq(expected, axis = 0).mean(axis = 1)
+	support.name = 'Support'
+	return LineageBootstrap(parents = table, support = support)
+
@@ -0,0 +1,197 @@
+"""
+	Scores the pairs of genotypes used to infer the lineage with a pool of processes. The genotype table is copied into shared
+	memory once, and each worker scores a contiguous group of unnested genotypes against every genotype before them with
+	`scoring.Score.score_pair`. The groups are returned in order, so the score records are identical to (and in the same
+	order as) the records generated by `LineageWorkflow` with a single process.
+
+	The 'vectorized' engine is split the same way: each worker calculates the unweighted scores (see
+	`score_matrix.calculate_component_scores`) for a contiguous block of nested genotypes against every genotype.
+"""
+import multiprocessing
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy
+import pandas
+
+try:
+	from muller.inheritance import score_matrix, scoring
+	from muller.inheritance.genotype_intervals import GenotypeIntervals
+except ModuleNotFoundError:
+	from . import score_matrix, scoring
+	from .genotype_intervals import GenotypeIntervals
+
+# Splitting the work into several groups per process keeps the processes busy when some groups take longer than others.
+GROUPS_PER_PROCESS = 8
+
+# Populated in each worker process by `_initialize_worker`.
+_worker_data: Dict[str, Any] = dict()
+
+
+def get_unnested_groups(total_genotypes: int, total_groups: int) -> List[Tuple[int, int]]:
+	"""
+		Splits the unnested genotypes (every genotype other than the first) into contiguous [start, stop) groups containing a
+		similar number of pairs. Each genotype is compared against every genotype before it, so later groups contain fewer genotypes.
+	"""
+	total_pairs = total_genotypes * (total_genotypes - 1) // 2
+	pairs_per_group = max(1, -(-total_pairs // max(1, total_groups)))
+	groups = list()
+	group_start = 1
+	group_pairs = 0
+	for index in range(1, total_genotypes):
+		group_pairs += index
+		if group_pairs >= pairs_per_group:
+			groups.append((group_start, index + 1))
+			group_start = index + 1
+			group_pairs = 0
+	if group_start < total_genotypes:
+		groups.append((group_start, total_genotypes))
+	return groups
+
+
+def score_unnested_genotypes(scorer: scoring.Score, genotypes: pandas.DataFrame, start: int, stop: int,
+		intervals: Optional[GenotypeIntervals] = None) -> List[Dict[str, float]]:
+	"""
+		Scores the unnested genotypes at positions [`start`, `stop`) against every genotype before them, starting with the closest.
+		If `intervals` is given, the genotypes which were never detected at the same time as the unnested genotype are scored
+		with `Score.score_pruned_pair`.
+	"""
+	score_records = list()
+	for unnested_label, unnested_trajectory in genotypes.iloc[start:stop].iterrows():
+		candidates = intervals.get_candidates(unnested_label) if intervals is not None else None
+		# Iterate over the rest of the table in reverse order. Basically, we start with the newest nest and iterate until we find a nest that satisfies the filters.
+		test_table = genotypes[:unnested_label].iloc[::-1]
+		for nested_label, nested_genotype in test_table.iterrows():
+			if nested_label == unnested_label: continue
+			if candidates is None or candidates[intervals.positions[nested_label]]:
+				score_data = scorer.score_pair(nested_genotype, unnested_trajectory)
+			else:
+				score_data = scorer.score_pruned_pair(nested_genotype, unnested_trajectory)
+			score_records.append(score_data)
+	return score_records
+
+
+def _attach_genotypes(name: str, shape: Tuple[int, ...]) -> numpy.ndarray:
+	from multiprocessing import shared_memory
+	# The worker processes share the resource tracker of the parent process, which unlinks the memory once all groups are done.
+	memory = shared_memory.SharedMemory(name = name)
+	_worker_data.update(memory = memory)
+	return numpy.ndarray(shape, dtype = float, buffer = memory.buf)
+
+
+def _initialize_worker(name: str, shape: Tuple[int, ...], labels: Sequence[str], columns: Sequence[Any], dlimit: float,
+		flimit: float, pvalue: float, weights: Tuple[int, int, int, int], prune: bool = False):
+	values = _attach_genotypes(name, shape)
+	genotypes = pandas.DataFrame(values, index = labels, columns = columns, copy = False)
+	scorer = scoring.Score(dlimit, flimit, pvalue, weights, area_cache = scoring.AreaCache())
+	intervals = GenotypeIntervals(genotypes, dlimit) if prune else None
+	_worker_data.update(genotypes = genotypes, scorer = scorer, intervals = intervals)
+
+
+def _initialize_block_worker(name: str, shape: Tuple[int, ...], dlimit: float, flimit: float, slimit: float):
+	values = _attach_genotypes(name, shape)
+	_worker_data.update(block = score_matrix._ScoreBlock(values, dlimit, flimit, slimit))
+
+
+def _score_group(group: Tuple[int, int]) -> List[Dict[str, float]]:
+	start, stop = group
+	return score_unnested_genotypes(_worker_data['scorer'], _worker_data['genotypes'], start, stop, _worker_data['intervals'])
+
+
+def _score_block(group: Tuple[int, int]) -> Dict[str, numpy.ndarray]:
+	start, stop = group
+	return _worker_data['block'].score(numpy.arange(start, stop))
+
+
+def _map_shared(values: numpy.ndarray, processes: int, initializer: Callable, initargs: Tuple, function: Callable,
+		groups: Iterable[Tuple[int, int]]) -> List[Any]:
+	"""
+		Copies `values` into shared memory and applies `function` to each group with a pool of `processes` processes. Each
+		process is started with `initializer(name, shape, *initargs)`. The results are returned in the same order as `groups`.
+	"""
+	# `multiprocessing.shared_memory` requires python 3.8, so it is only imported when the pairs are scored in parallel.
+	from multiprocessing import shared_memory
+	memory = shared_memory.SharedMemory(create = True, size = max(1, values.nbytes))
+	shared_values = numpy.ndarray(values.shape, dtype = float, buffer = memory.buf)
+	try:
+		shared_values[:] = values
+		pool = multiprocessing.Pool(processes = processes, initializer = initializer, initargs = (memory.name, values.shape) + initargs)
+		results = list()
+		try:
+			# `imap` returns the groups in order, so the results are merged in the same order as the single-process loop.
+			for result in pool.imap(function, groups):
+				results.append(result)
+			pool.close()
+		except BaseException:
+			pool.terminate()
+			raise
+		finally:
+			pool.join()
+	finally:
+		# The array needs to be released before the shared memory can be closed.
+		del shared_values
+		memory.close()
+		memory.unlink()
+	return results
+
+
+def score_pairs_parallel(scorer: scoring.Score, genotypes: pandas.DataFrame, processes: int, prune: bool = False) -> List[Dict[str, float]]:
+	"""
+		Scores every pair of genotypes compared by `LineageWorkflow` using `processes` worker processes.
+	Parameters
+	----------
+	scorer: scoring.Score
+		Provides the detection limit, fixed limit, pvalue and weights. Each worker uses a copy of this scorer.
+	genotypes: pandas.DataFrame
+		The sorted genotype table.
+	processes: int
+		The number of worker processes.
+	prune: bool
+		Whether each worker should skip the pairs which were never detected at the same time (see `score_unnested_genotypes`).
+
+	Returns
+	-------
+	List[Dict[str, float]]
+		The score record of each pair, in the same order as `score_unnested_genotypes(scorer, genotypes, 1, len(genotypes))`.
+	"""
+	groups = get_unnested_groups(len(genotypes), processes * GROUPS_PER_PROCESS)
+	if not groups:
+		return list()
+	weights = (scorer.weight_greater, scorer.weight_above_fixed, scorer.weight_derivative, scorer.weight_jaccard)
+	initargs = (list(genotypes.index), list(genotypes.columns), scorer.dlimit, scorer.flimit, scorer.pvalue, weights, prune)
+	results = _map_shared(genotypes.values.astype(float), processes, _initialize_worker, initargs, _score_group, groups)
+	return [score_data for group_records in results for score_data in group_records]
+
+
+def calculate_component_scores_parallel(scorer: scoring.Score, genotypes: pandas.DataFrame, processes: int,
+		block_elements: int = score_matrix.DEFAULT_BLOCK_ELEMENTS) -> score_matrix.ComponentScores:
+	"""
+		Same as `score_matrix.calculate_component_scores`, but the blocks of nested genotypes are split between `processes`
+		worker processes. The scores are identical to the single-process scores.
+	Parameters
+	----------
+	scorer: scoring.Score
+		Provides the detection limit and fixed limit.
+	genotypes: pandas.DataFrame
+		The genotype table. The table should be supported by `score_matrix.is_supported`.
+	processes: int
+		The number of worker processes.
+	block_elements: int
+		The maximum number of values each process keeps in memory when calculating a block of pairs.
+	"""
+	values = genotypes.values.astype(float)
+	total, timepoints = values.shape
+	if total == 0:
+		return score_matrix.calculate_component_scores(scorer, genotypes, block_elements)
+	# Every nested genotype is compared against every genotype, so blocks with the same number of genotypes take as long.
+	block_size = max(1, min(block_elements // max(1, total * timepoints), -(-total // (processes * GROUPS_PER_PROCESS))))
+	groups = [(start, min(start + block_size, total)) for start in range(0, total, block_size)]
+	initargs = (scorer.dlimit, scorer.flimit, scorer.slimit)
+	results = _map_shared(values, processes, _initialize_block_worker, initargs, _score_block, groups)
+
+	components: Dict[str, numpy.ndarray] = dict()
+	for (start, stop), scores in zip(groups, results):
+		for key, score in scores.items():
+			if key not in components:
+				components[key] = numpy.zeros((total, total), dtype = score.dtype)
+			components[key][start:stop] = score
+	return score_matrix.ComponentScores(labels = list(genotypes.index), **components)
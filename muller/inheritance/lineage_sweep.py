@@ -0,0 +1,103 @@
+"""
+	Infers the lineage for several combinations of score weights and pvalues. The unweighted component scores of every pair of
+	genotypes only depend on the detection and fixed limits, so they are calculated once (see `score_matrix.ComponentScores`)
+	and each combination of weights and pvalue only has to re-threshold and combine them.
+"""
+import itertools
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, Optional, Sequence, Tuple
+
+import pandas
+from loguru import logger
+
+try:
+	from muller.inheritance import score_matrix
+	from muller.inheritance.genotype_lineage import LineageWorkflow
+except ModuleNotFoundError:
+	from . import score_matrix
+	from .genotype_lineage import LineageWorkflow
+
+WeightsType = Tuple[int, int, int, int]
+# The weights used by `LineageWorkflow` when none are given.
+DEFAULT_WEIGHTS: WeightsType = (1, 1, 2, 2)
+
+
+@dataclass
+class LineageSweep:
+	"""
+		parents: pandas.DataFrame
+			The parent of each genotype (rows) for each combination of weights and pvalue (columns).
+		summary: pandas.DataFrame
+			The most common parent of each genotype, the fraction of combinations which selected it, and every other parent
+			selected for the genotype.
+	"""
+	parents: pandas.DataFrame
+	summary: pandas.DataFrame
+
+	def get_changed_edges(self) -> pandas.DataFrame:
+		""" Returns the summary of the genotypes which were not assigned the same parent by every combination."""
+		return self.summary[self.summary['changed']]
+
+
+def get_setting_label(weights: WeightsType, pvalue: float) -> str:
+	return f"weights={','.join(str(i) for i in weights)} pvalue={pvalue}"
+
+
+def summarize_parents(parents: pandas.DataFrame) -> pandas.DataFrame:
+	""" Summarizes which parent was selected for each genotype (the rows of `parents`) across each combination (the columns)."""
+	rows = list()
+	for identity, candidates in parents.iterrows():
+		counts = Counter(candidates.tolist())
+		parent, total = counts.most_common(1)[0]
+		rows.append({
+			'Identity':     identity,
+			'parent':       parent,
+			'support':      total / len(candidates),
+			'alternatives': ','.join(str(i) for i in counts if i != parent),
+			'changed':      len(counts) > 1
+		})
+	return pandas.DataFrame(rows, columns = ['Identity', 'parent', 'support', 'alternatives', 'changed']).set_index('Identity')
+
+
+def run_lineage_sweep(sorted_genotypes: pandas.DataFrame, dlimit: float, flimit: float, weights: Sequence[WeightsType],
+		pvalues: Sequence[float], known_ancestry: Optional[Dict[str, str]] = None, conservative: bool = False) -> LineageSweep:
+	"""
+		Infers the lineage of `sorted_genotypes` for every combination of `weights` and `pvalues`.
+	Parameters
+	----------
+	sorted_genotypes: pandas.DataFrame
+		The sorted genotype table, as given to `LineageWorkflow.run`.
+	dlimit, flimit: float
+	weights: Sequence[Tuple[int, int, int, int]]
+		Each set of weights to test, as given to `LineageWorkflow`.
+	pvalues: Sequence[float]
+		Each pvalue to test.
+	known_ancestry: Optional[Dict[str, str]]
+		Manually-assigned ancestry values, which are used for every combination.
+	conservative: bool
+	"""
+	settings = list(itertools.product(weights, pvalues))
+	workflow = LineageWorkflow(dlimit, flimit, pvalues[0], weights[0], conservative = conservative)
+	if score_matrix.is_supported(sorted_genotypes):
+		components = score_matrix.calculate_component_scores(workflow.scorer, sorted_genotypes)
+	else:
+		logger.warning(f"The genotype table cannot be scored as arrays, so the lineage will be inferred separately for each combination.")
+		components = None
+
+	parents = dict()
+	for setting_weights, pvalue in settings:
+		workflow = LineageWorkflow(dlimit, flimit, pvalue, setting_weights, conservative = conservative)
+		if components is None:
+			ancestry = workflow.run(sorted_genotypes, known_ancestry).clusters
+		else:
+			workflow.initialize_ancestry(sorted_genotypes, known_ancestry)
+			workflow.add_score_matrix(components.score(setting_weights, pvalue))
+			ancestry = workflow.genotype_nests
+		parents[get_setting_label(setting_weights, pvalue)] = ancestry.as_ancestry_table()
+
+	parents = pandas.DataFrame(parents)
+	parents.index.name = 'Identity'
+	summary = summarize_parents(parents)
+	logger.info(f"{summary['changed'].sum()} of {len(summary)} genotypes were assigned a different parent by at least one of {len(settings)} combinations.")
+	return LineageSweep(parents = parents, summary = summary)
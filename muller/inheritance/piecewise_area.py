@@ -0,0 +1,82 @@
+"""
+	Calculates the areas used to score genotypes directly from the frequencies of each series. Every series is a
+	piecewise-linear function over the same timepoints, so the area of the intersection, union and difference of two
+	series can be calculated exactly by integrating each segment between neighboring timepoints, splitting the segment
+	where the two series cross. This gives the same areas as the shapely polygons generated by `polygon.get_vertices`
+	without any of the topology errors.
+
+	Every function accepts either a single series or a 2D array with one series per row, in which case one area is
+	returned per row.
+"""
+from typing import Optional, Union
+
+import numpy
+import pandas
+
+try:
+	from muller.inheritance.polygon import MINIMUM
+except ModuleNotFoundError:
+	from .polygon import MINIMUM
+
+CurveType = Union[pandas.Series, pandas.DataFrame, numpy.ndarray]
+
+
+def as_curve(series: CurveType, minimum: float = MINIMUM) -> numpy.ndarray:
+	"""
+		Converts the frequencies of a series to the heights of the curve used to calculate its area. As in `polygon.get_vertices`,
+		values below `minimum` (other than the first and last values) are raised to `minimum`.
+	"""
+	values = numpy.array(series, dtype = float)
+	if values.shape[-1] > 2:
+		inner = values[..., 1:-1]
+		inner[inner < minimum] = minimum
+	return values
+
+
+def _integrate(segments: numpy.ndarray, x: Optional[numpy.ndarray] = None) -> Union[float, numpy.ndarray]:
+	""" Sums the mean height of each segment, multiplied by the width of each segment if the timepoints `x` are not evenly spaced."""
+	if x is not None:
+		segments = segments * numpy.diff(numpy.asarray(x, dtype = float))
+	return segments.sum(axis = -1)
+
+
+def area(curve: numpy.ndarray, x: Optional[numpy.ndarray] = None) -> Union[float, numpy.ndarray]:
+	""" The area under `curve`. Equivalent to `geometry.Polygon(polygon.get_vertices(series)).area`."""
+	curve = numpy.asarray(curve, dtype = float)
+	return _integrate((curve[..., :-1] + curve[..., 1:]) / 2, x)
+
+
+def positive_area(curve: numpy.ndarray, x: Optional[numpy.ndarray] = None) -> Union[float, numpy.ndarray]:
+	""" The area under the parts of `curve` which are above 0. Segments which cross 0 are split at the crossing point."""
+	curve = numpy.asarray(curve, dtype = float)
+	start = curve[..., :-1]
+	stop = curve[..., 1:]
+	# Segments which are entirely above (or below) 0 are just trapezoids with a positive (or negative) area.
+	segments = numpy.maximum((start + stop) / 2, 0)
+	crossing = start * stop < 0
+	if crossing.any():
+		# Only the triangle between the crossing point and the positive end of the segment is above 0.
+		upper = numpy.maximum(start[crossing], stop[crossing])
+		lower = numpy.minimum(start[crossing], stop[crossing])
+		segments[crossing] = upper ** 2 / (upper - lower) / 2
+	return _integrate(segments, x)
+
+
+def difference_area(left: numpy.ndarray, right: numpy.ndarray, x: Optional[numpy.ndarray] = None) -> Union[float, numpy.ndarray]:
+	""" The area of `left` which is not in `right`, |X - Y|."""
+	return positive_area(numpy.asarray(left, dtype = float) - numpy.asarray(right, dtype = float), x)
+
+
+def common_area(left: numpy.ndarray, right: numpy.ndarray, x: Optional[numpy.ndarray] = None) -> Union[float, numpy.ndarray]:
+	""" The area under both `left` and `right`, |X ∩ Y|. This is the area under the minimum of both curves."""
+	return area(left, x) - difference_area(left, right, x)
+
+
+def union_area(left: numpy.ndarray, right: numpy.ndarray, x: Optional[numpy.ndarray] = None) -> Union[float, numpy.ndarray]:
+	""" The area under either `left` or `right`, |X ∪ Y|. This is the area under the maximum of both curves."""
+	return area(right, x) + difference_area(left, right, x)
+
+
+def symmetric_difference_area(left: numpy.ndarray, right: numpy.ndarray, x: Optional[numpy.ndarray] = None) -> Union[float, numpy.ndarray]:
+	""" The area under only one of `left` or `right`, |X ⊕ Y|."""
+	return difference_area(left, right, x) + difference_area(right, left, x)
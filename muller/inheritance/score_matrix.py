@@ -0,0 +1,482 @@
+"""
+	Calculates the lineage scores for every pair of genotypes at once. Each score in `scoring.Score.score_pair` only depends on
+	which timepoints of the two genotypes were detected, so every score can be calculated for all pairs as a
+	(nested genotype, unnested genotype) array from the genotype table, rather than building several `pandas.Series` for each pair.
+	The scores match `scoring.Score.score_pair` for every pair.
+"""
+import math
+from dataclasses import dataclass
+from typing import Dict, List, Tuple, Union
+
+import numpy
+import pandas
+import scipy.stats as stats
+
+try:
+	from muller.inheritance import piecewise_area
+	from muller.inheritance.scoring import Score
+except ModuleNotFoundError:
+	from . import piecewise_area
+	from .scoring import Score
+
+# The maximum number of (nested, unnested, timepoint) values in each block of pairs.
+DEFAULT_BLOCK_ELEMENTS = 2 ** 22
+# `widgets.get_valid_points` always uses this value to mask fixed timepoints, regardless of `flimit`.
+FIXED_MASK = 0.97
+SCORE_COLUMNS = ['scoreGreater', 'scoreFixed', 'scoreArea', 'scoreDerivative', 'totalScore']
+
+
+@dataclass
+class ScoreMatrix:
+	""" Each score array is indexed as [nested genotype, unnested genotype], using the order of `labels`."""
+	labels: List[str]
+	greater: numpy.ndarray
+	fixed: numpy.ndarray
+	area: numpy.ndarray
+	derivative: numpy.ndarray
+	total: numpy.ndarray
+	# Whether each score would be a `float` rather than an `int` in `Score.score_pair`.
+	greater_is_float: numpy.ndarray
+	derivative_is_float: numpy.ndarray
+	area_is_float: bool
+
+	def __len__(self) -> int:
+		return len(self.labels)
+
+	def set_records(self, score_records: List[Dict[str, float]]):
+		""" Copies the score of each pair generated by `Score.score_pair` into the score arrays."""
+		positions = {label: index for index, label in enumerate(self.labels)}
+		for score_data in score_records:
+			index = positions[score_data['nestedGenotype']], positions[score_data['unnestedGenotype']]
+			self.greater[index] = score_data['scoreGreater']
+			self.fixed[index] = score_data['scoreFixed']
+			self.area[index] = score_data['scoreArea']
+			self.derivative[index] = score_data['scoreDerivative']
+			self.total[index] = score_data['totalScore']
+			self.greater_is_float[index] = isinstance(score_data['scoreGreater'], float)
+			self.derivative_is_float[index] = isinstance(score_data['scoreDerivative'], float)
+
+	def get_pairs(self) -> Tuple[numpy.ndarray, numpy.ndarray]:
+		"""
+			Returns the index of the nested and unnested genotype of each pair in the order `LineageWorkflow` compares them:
+			every genotype is compared against each of the genotypes before it, starting with the closest.
+		"""
+		total = len(self)
+		unnested = numpy.repeat(numpy.arange(total), numpy.arange(total))
+		# The number of pairs before the first pair with each unnested genotype.
+		offsets = numpy.repeat(numpy.cumsum(numpy.arange(total)) - numpy.arange(total), numpy.arange(total))
+		nested = unnested - 1 - (numpy.arange(len(unnested)) - offsets)
+		return nested, unnested
+
+	def get_float_columns(self, nested: numpy.ndarray, unnested: numpy.ndarray) -> Dict[str, bool]:
+		""" Whether each score of the given pairs would be a `float` rather than an `int` in `Score.score_pair`."""
+		greater_is_float = bool(self.greater_is_float[nested, unnested].any())
+		derivative_is_float = bool(self.derivative_is_float[nested, unnested].any())
+		return {
+			'scoreGreater':    greater_is_float,
+			'scoreFixed':      False,
+			'scoreArea':       self.area_is_float,
+			'scoreDerivative': derivative_is_float,
+			'totalScore':      greater_is_float or derivative_is_float or self.area_is_float
+		}
+
+	def get_candidates(self) -> List[Tuple[str, List[Tuple[str, float]]]]:
+		"""
+			Returns each unnested genotype along with the label and total score of each nested genotype it was compared against,
+			in the order given by `get_pairs`.
+		"""
+		nested, unnested = self.get_pairs()
+		total = self.total[nested, unnested]
+		if not self.get_float_columns(nested, unnested)['totalScore']:
+			total = total.astype(int)
+		candidates = list(zip(numpy.array(self.labels, dtype = object)[nested].tolist(), total.tolist()))
+		# The pairs of each unnested genotype are contiguous, and the genotype at position `index` has `index` pairs.
+		offsets = [index * (index - 1) // 2 for index in range(len(self) + 1)]
+		return [(self.labels[index], candidates[offsets[index]:offsets[index + 1]]) for index in range(1, len(self))]
+
+	def to_table(self) -> pandas.DataFrame:
+		""" Converts the scores of each pair into the `table_scores` table generated from `Score.score_pair`."""
+		nested, unnested = self.get_pairs()
+		if len(nested) == 0:
+			return pandas.DataFrame([])
+		labels = numpy.array(self.labels, dtype = object)
+		is_float = self.get_float_columns(nested, unnested)
+		table = pandas.DataFrame({
+			'nestedGenotype':   labels[nested],
+			'unnestedGenotype': labels[unnested],
+			'scoreGreater':     self.greater[nested, unnested],
+			'scoreFixed':       self.fixed[nested, unnested],
+			'scoreArea':        self.area[nested, unnested],
+			'scoreDerivative':  self.derivative[nested, unnested],
+			'totalScore':       self.total[nested, unnested]
+		})
+		# `Score.score_pair` returns `int` scores unless a weight or the `scoreGreater` score is a `float`.
+		for column in SCORE_COLUMNS:
+			if not is_float[column]:
+				table[column] = table[column].astype(int)
+		return table
+
+
+# The arrays of `ScoreMatrix` which hold a value for each pair.
+PAIR_ARRAYS = ['greater', 'fixed', 'area', 'derivative', 'total', 'greater_is_float', 'derivative_is_float']
+
+
+def create_score_matrix(labels: List[str], area_is_float: bool) -> ScoreMatrix:
+	""" Creates a `ScoreMatrix` for the genotypes in `labels` where every score is 0."""
+	total = len(labels)
+	scores = {key: numpy.zeros((total, total)) for key in ['greater', 'fixed', 'area', 'derivative', 'total']}
+	is_float = {key: numpy.zeros((total, total), dtype = bool) for key in ['greater_is_float', 'derivative_is_float']}
+	return ScoreMatrix(labels = list(labels), area_is_float = area_is_float, **scores, **is_float)
+
+
+def has_sorted_timepoints(genotypes: pandas.DataFrame) -> bool:
+	"""
+		Tests whether the timepoints of `genotypes` are sorted and can be sliced by position, which is how `widgets.get_valid_points`
+		selects the detected timepoints of each pair.
+	"""
+	if pandas.api.types.is_float_dtype(genotypes.columns):
+		# Slicing a float index selects the timepoints by label rather than by position.
+		return False
+	try:
+		timepoints = numpy.array([float(i) for i in genotypes.columns])
+	except (TypeError, ValueError):
+		return False
+	return bool((numpy.diff(timepoints) > 0).all())
+
+
+def is_supported(genotypes: pandas.DataFrame) -> bool:
+	"""
+		Tests whether the scores of `genotypes` can be calculated as arrays. `Score.score_pair` selects the detected timepoints
+		by position, so the timepoints have to be sorted and the table cannot contain any missing values.
+	"""
+	if len(genotypes.columns) < 3 or not genotypes.index.is_unique or genotypes.index.dtype != object:
+		return False
+	if not has_sorted_timepoints(genotypes):
+		return False
+	try:
+		values = genotypes.values.astype(float)
+	except (TypeError, ValueError):
+		return False
+	return bool(numpy.isfinite(values).all())
+
+
+def _get_window(mask: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+	"""
+		Returns the position of the first and (one past) the last `True` value along the last axis of `mask`,
+		as in `widgets.get_valid_points`. Both are 0 if there are no `True` values.
+	"""
+	found = mask.any(axis = -1)
+	start = numpy.where(found, mask.argmax(axis = -1), 0)
+	stop = numpy.where(found, mask.shape[-1] - mask[..., ::-1].argmax(axis = -1), 0)
+	return start, stop
+
+
+def _in_window(start: numpy.ndarray, stop: numpy.ndarray, total: int) -> numpy.ndarray:
+	positions = numpy.arange(total)
+	return (positions >= start[..., None]) & (positions < stop[..., None])
+
+
+def _is_close(left: numpy.ndarray, right: numpy.ndarray, abs_tol: float) -> numpy.ndarray:
+	""" Same as `math.isclose` with the default `rel_tol`."""
+	tolerance = numpy.maximum(1e-09 * numpy.maximum(numpy.abs(left), numpy.abs(right)), abs_tol)
+	return (left == right) | (numpy.abs(left - right) <= tolerance)
+
+
+def _is_subset(left: numpy.ndarray, right: numpy.ndarray, left_not_right: numpy.ndarray) -> numpy.ndarray:
+	""" Same as `areascore.is_subset_numeric`."""
+	area_union = right + left_not_right
+	area_intersection = left - left_not_right
+	jaccard_expected = (left - right) / left
+	jaccard_actual = (area_union - area_intersection) / area_union
+	return _is_close(jaccard_expected, jaccard_actual, abs_tol = 0.1)
+
+
+class _ScoreBlock:
+	""" Calculates the unweighted scores for a block of nested genotypes against every unnested genotype."""
+
+	def __init__(self, values: numpy.ndarray, dlimit: float, flimit: float, slimit: float):
+		self.dlimit = dlimit
+		self.flimit = flimit
+		self.slimit = slimit
+		self.values = values
+		self.masked = numpy.where(values > FIXED_MASK, -1, values)
+		self.detected = values > dlimit
+		self.detected_unfixed = self.masked > dlimit
+		self.slopes = numpy.diff(values, axis = 1)
+
+		complement = flimit - values
+		complement[complement < 0] = 0.0001  # Since the flimit is not exactly 1.
+		self.curves = piecewise_area.as_curve(values)
+		self.areas = piecewise_area.area(self.curves)
+		self.complement_curves = piecewise_area.as_curve(complement)
+		self.complement_areas = piecewise_area.area(self.complement_curves)
+		# The area of the complement of each genotype which is not in the genotype itself.
+		self.complement_not_self = piecewise_area.difference_area(self.complement_curves, self.curves)
+
+	def score_greater(self, difference: numpy.ndarray, window: numpy.ndarray) -> numpy.ndarray:
+		""" Same as `Score.calculate_score_greater_basic`, including the `nan` scores."""
+		dlimit = self.dlimit
+		cutoff = window.sum(axis = -1) * 0.5
+		nested_is_above = window & (difference > dlimit)
+		unnested_is_above = window & (difference < -dlimit)
+		nested_timepoints = nested_is_above.sum(axis = -1)
+		unnested_timepoints = unnested_is_above.sum(axis = -1)
+		nested_total = numpy.where(nested_is_above, difference, 0).sum(axis = -1)
+		unnested_total = numpy.where(unnested_is_above, difference, 0).sum(axis = -1)
+		with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+			nested_mean = numpy.abs(nested_total / nested_timepoints)
+			unnested_mean = numpy.abs(unnested_total / unnested_timepoints)
+
+		left = (numpy.abs(nested_total) > self.slimit) | ((nested_timepoints > cutoff) & (nested_mean > dlimit))
+		right = (numpy.abs(unnested_total) > self.slimit) | ((unnested_timepoints > cutoff) & (unnested_mean > dlimit))
+		return numpy.where(left & right, math.nan, numpy.where(left, 1.0, numpy.where(right, -1.0, math.nan)))
+
+	def score_fixed(self, combined: numpy.ndarray, window: numpy.ndarray, overlap_start: numpy.ndarray,
+			overlap_stop: numpy.ndarray) -> Tuple[numpy.ndarray, ...]:
+		"""
+			Calculates the values `LegacyScore.calculate_summation_score` and `Score.calculate_score_above_fixed` compare
+			against the pvalue: the mean summation of pairs detected at fewer than 3 timepoints and the t-test of every other pair.
+			Pairs with a single overlapping timepoint (other than the first) are compared against the fixed limit instead.
+		"""
+		length = window.sum(axis = -1)
+		with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+			summation = numpy.where(window, combined - self.flimit, 0).sum(axis = -1) / length
+		is_short = length < 3
+		summation[~is_short] = math.nan
+
+		# The first timepoint where both genotypes were detected is skipped.
+		total = overlap_stop - overlap_start - 1
+		is_single = ~is_short & (total == 1)
+		single = numpy.take_along_axis(combined, numpy.minimum(overlap_start + 1, combined.shape[-1] - 1)[..., None], axis = -1)[..., 0]
+		is_single_fixed = is_single & (single > self.flimit)
+
+		is_multiple = ~is_short & (total > 1)
+		statistic = numpy.full(length.shape, math.nan)
+		pvalue = numpy.full(length.shape, math.nan)
+		if is_multiple.any():
+			in_window = _in_window(overlap_start + 1, overlap_stop, combined.shape[-1])
+			mean = numpy.where(in_window, combined, 0).sum(axis = -1)[is_multiple] / total[is_multiple]
+			statistic[is_multiple], pvalue[is_multiple] = stats.ttest_ind_from_stats(
+				mean1 = mean,
+				std1 = self.dlimit ** 2,
+				nobs1 = total[is_multiple],
+				mean2 = 1 + self.dlimit,
+				std2 = self.dlimit ** 2,
+				nobs2 = total[is_multiple]
+			)
+		return summation, is_single, is_single_fixed, statistic, pvalue
+
+	def score_area(self, nested: numpy.ndarray, unnested: Union[numpy.ndarray, slice] = slice(None)) -> numpy.ndarray:
+		""" Same as `Score.calculate_score_area`, without the weight."""
+		nested_area = self.areas[nested][:, None]
+		unnested_area = self.areas[unnested][None, :]
+		nested_not_unnested = piecewise_area.difference_area(self.curves[nested][:, None], self.curves[unnested][None, :])
+
+		# Use the complement of whichever genotype is larger.
+		is_larger = (self.values[nested][:, None] - self.values[unnested][None, :]).sum(axis = -1) > 0
+		other_area = numpy.where(is_larger, self.complement_areas[nested][:, None], self.complement_areas[unnested][None, :])
+		other_not_unnested = numpy.where(
+			is_larger,
+			piecewise_area.difference_area(self.complement_curves[nested][:, None], self.curves[unnested][None, :]),
+			self.complement_not_self[unnested][None, :]
+		)
+		unnested_not_nested = nested_not_unnested - nested_area + unnested_area
+		unnested_not_other = other_not_unnested - other_area + unnested_area
+
+		is_subset_nested = _is_subset(nested_area, unnested_area, nested_not_unnested)
+		is_subset_other = _is_subset(other_area, unnested_area, other_not_unnested)
+		is_subset_nested_reversed = _is_subset(unnested_area, nested_area, unnested_not_nested)
+
+		common_area_nested = unnested_area - unnested_not_nested
+		common_area_other = unnested_area - unnested_not_other
+		score = numpy.select(
+			[is_subset_nested & is_subset_other, is_subset_nested, is_subset_nested_reversed & ~is_subset_other],
+			[(common_area_nested > 2 * common_area_other).astype(float), 1.0, -1.0],
+			0.0
+		)
+		return numpy.where(
+			((score == 0) & (unnested_not_nested > common_area_nested * 2)) | (unnested_area > 2 * nested_area),
+			-1.0,
+			score
+		)
+
+	def score_derivative(self, nested: numpy.ndarray, unnested: Union[numpy.ndarray, slice] = slice(None)) -> numpy.ndarray:
+		""" Same as `Score.calculate_score_derivative`, without the weight."""
+		start, stop = _get_window(self.detected_unfixed[nested][:, None] & self.detected_unfixed[unnested][None, :])
+		# Only the slopes between the timepoints in the window are used.
+		in_window = _in_window(start, stop - 1, self.slopes.shape[-1])
+		dotproduct = numpy.where(in_window, self.slopes[nested][:, None] * self.slopes[unnested][None, :], 0).sum(axis = -1)
+		return numpy.select([dotproduct > 0.01, dotproduct < -0.01], [1.0, -1.0], 0.0)
+
+	def score(self, nested: numpy.ndarray, unnested: Union[numpy.ndarray, slice] = slice(None)) -> Dict[str, numpy.ndarray]:
+		""" Calculates each component score for the genotypes in `nested` against every genotype in `unnested` (by default, every genotype)."""
+		detected = self.detected[nested][:, None]
+		either_start, either_stop = _get_window(detected | self.detected[unnested][None, :])
+		both = detected & self.detected[unnested][None, :]
+		both_start, both_stop = _get_window(both)
+		window = _in_window(either_start, either_stop, self.values.shape[-1])
+
+		values = self.values[nested][:, None]
+		summation, is_single, is_single_fixed, statistic, pvalue = self.score_fixed(values + self.values[unnested][None, :], window, both_start, both_stop)
+		return dict(
+			greater = self.score_greater(values - self.values[unnested][None, :], window),
+			not_overlapping = ~both.any(axis = -1),
+			summation = summation,
+			is_single = is_single,
+			is_single_fixed = is_single_fixed,
+			statistic = statistic,
+			pvalue = pvalue,
+			area = self.score_area(nested, unnested),
+			derivative = self.score_derivative(nested, unnested)
+		)
+
+
+@dataclass
+class ComponentScores:
+	"""
+		The unweighted scores for every pair of genotypes, which can be combined into the final scores for any set of weights
+		and pvalue (see `Score.score_pair`). Each array is indexed as [nested genotype, unnested genotype].
+	"""
+	labels: List[str]
+	# The `calculate_score_greater_basic` score. `nan` if the score is ambiguous.
+	greater: numpy.ndarray
+	# Whether the genotypes were never detected at the same timepoint, which is penalized by the `greater` weight.
+	not_overlapping: numpy.ndarray
+	# The mean summation of the pairs detected at fewer than 3 timepoints (`nan` for every other pair).
+	summation: numpy.ndarray
+	# The pairs which only have a single overlapping timepoint to test, and whether that timepoint is above the fixed limit.
+	is_single: numpy.ndarray
+	is_single_fixed: numpy.ndarray
+	# The t-test statistic and pvalue behind `calculate_score_above_fixed` (`nan` if the test was not used).
+	statistic: numpy.ndarray
+	pvalue: numpy.ndarray
+	area: numpy.ndarray
+	derivative: numpy.ndarray
+
+	def score_fixed(self, pvalue: float) -> numpy.ndarray:
+		""" Thresholds the summations and t-tests with `pvalue`."""
+		with numpy.errstate(invalid = 'ignore'):
+			# Since we're using a two-sided test we need to convert it to a one-sided test.
+			passed_ttest = (self.pvalue / 2 < pvalue) & (self.statistic > 0)
+			passed_summation = self.summation > pvalue
+		return (passed_summation | self.is_single_fixed | passed_ttest).astype(float)
+
+	def score(self, weights: Tuple[int, int, int, int], pvalue: float) -> ScoreMatrix:
+		"""
+			Combines the component scores into the score of each pair, as `Score.score_pair` would with the same weights and pvalue.
+		Parameters
+		----------
+		weights: Tuple[int, int, int, int]
+			The weights for the greater, above fixed, derivative and area scores, as in `Score`.
+		pvalue: float
+		"""
+		weight_greater, _, weight_derivative, weight_area = weights
+		missing_score = weight_greater * -1  # Used when the genotypes were never detected at the same time.
+		greater = numpy.where(self.not_overlapping, missing_score, numpy.nan_to_num(self.greater, nan = 0))
+		fixed = self.score_fixed(pvalue)
+		area = self.area * weight_area
+		total = fixed + greater + area
+		# The derivative score is only used when the other scores are positive.
+		uses_derivative = total > 0
+		derivative = numpy.where(uses_derivative, self.derivative * weight_derivative, 0)
+		return ScoreMatrix(
+			labels = self.labels,
+			greater = greater,
+			fixed = fixed,
+			area = area,
+			derivative = derivative,
+			total = total + derivative,
+			greater_is_float = numpy.where(self.not_overlapping, isinstance(missing_score, float), ~numpy.isnan(self.greater)),
+			derivative_is_float = uses_derivative & isinstance(weight_derivative, float),
+			area_is_float = isinstance(weight_area, float)
+		)
+
+
+def calculate_component_scores(scorer: Score, genotypes: pandas.DataFrame,
+		block_elements: int = DEFAULT_BLOCK_ELEMENTS) -> ComponentScores:
+	"""
+		Calculates the unweighted scores for every pair of genotypes in `genotypes`. The table should be supported by `is_supported`.
+	Parameters
+	----------
+	scorer: Score
+		Provides the detection limit and fixed limit. The weights and pvalue are applied later by `ComponentScores.score`.
+	genotypes: pandas.DataFrame
+		The genotype table.
+	block_elements: int
+		The maximum number of values to keep in memory when calculating a block of pairs.
+	"""
+	values = genotypes.values.astype(float)
+	total, timepoints = values.shape
+	block = _ScoreBlock(values, scorer.dlimit, scorer.flimit, scorer.slimit)
+	components: Dict[str, numpy.ndarray] = dict()
+	block_size = max(1, block_elements // max(1, total * timepoints))
+	for start in range(0, total, block_size):
+		nested = numpy.arange(start, min(start + block_size, total))
+		for key, score in block.score(nested).items():
+			if key not in components:
+				components[key] = numpy.zeros((total, total), dtype = score.dtype)
+			components[key][nested] = score
+	if not components:
+		empty = numpy.zeros((0, 0))
+		components = {key: empty for key in ComponentScores.__dataclass_fields__ if key != 'labels'}
+	return ComponentScores(labels = list(genotypes.index), **components)
+
+
+def calculate_score_matrix(scorer: Score, genotypes: pandas.DataFrame,
+		block_elements: int = DEFAULT_BLOCK_ELEMENTS) -> ScoreMatrix:
+	"""
+		Calculates the score for every pair of genotypes in `genotypes`. The table should be supported by `is_supported`.
+	Parameters
+	----------
+	scorer: Score
+		Provides the detection limit, fixed limit, pvalue and weights used to calculate each score.
+	genotypes: pandas.DataFrame
+		The genotype table.
+	block_elements: int
+		The maximum number of values to keep in memory when calculating a block of pairs.
+	"""
+	components = calculate_component_scores(scorer, genotypes, block_elements)
+	weights = (scorer.weight_greater, scorer.weight_above_fixed, scorer.weight_derivative, scorer.weight_jaccard)
+	return components.score(weights, scorer.pvalue)
+
+
+def update_score_matrix(scores: ScoreMatrix, scorer: Score, genotypes: pandas.DataFrame, changed: numpy.ndarray,
+		block_elements: int = DEFAULT_BLOCK_ELEMENTS):
+	"""
+		Recalculates the score of every pair in `scores` which includes one of the `changed` genotypes. The other pairs are not
+		modified. The table should be supported by `is_supported`.
+	Parameters
+	----------
+	scores: ScoreMatrix
+		The scores of every pair of genotypes in `genotypes`, in the same order.
+	scorer: Score
+		Provides the detection limit, fixed limit, pvalue and weights used to calculate each score.
+	genotypes: pandas.DataFrame
+		The genotype table.
+	changed: numpy.ndarray
+		The position of each genotype to rescore.
+	block_elements: int
+		The maximum number of values to keep in memory when calculating a block of pairs.
+	"""
+	if len(changed) == 0:
+		return
+	values = genotypes.values.astype(float)
+	total, timepoints = values.shape
+	block = _ScoreBlock(values, scorer.dlimit, scorer.flimit, scorer.slimit)
+	weights = (scorer.weight_greater, scorer.weight_above_fixed, scorer.weight_derivative, scorer.weight_jaccard)
+
+	# The changed genotypes as the nested genotype of each pair.
+	block_size = max(1, block_elements // max(1, total * timepoints))
+	for start in range(0, len(changed), block_size):
+		nested = changed[start:start + block_size]
+		partial = ComponentScores(labels = scores.labels, **block.score(nested)).score(weights, scorer.pvalue)
+		for key in PAIR_ARRAYS:
+			getattr(scores, key)[nested] = getattr(partial, key)
+
+	# The changed genotypes as the unnested genotype of each pair.
+	block_size = max(1, block_elements // max(1, len(changed) * timepoints))
+	for start in range(0, total, block_size):
+		nested = numpy.arange(start, min(start + block_size, total))
+		partial = ComponentScores(labels = scores.labels, **block.score(nested, changed)).score(weights, scorer.pvalue)
+		for key in PAIR_ARRAYS:
+			getattr(scores, key)[nested[:, None], changed[None, :]] = getattr(partial, key)
@@ -0,0 +1,142 @@
+"""
+	A persistent cache of the lineage scores of each pair of genotypes which is shared between runs. Each genotype is
+	identified by a hash of its frequencies rather than its label, so the scores can be reused whenever the same genotypes are
+	scored again with the same dlimit, flimit, pvalue, weights and timepoints, even if some of the other genotypes changed or
+	were relabeled. Only the pairs which include a new or modified genotype have to be scored again.
+
+	The scores are stored in an sqlite database as blocks, the same way `DistanceStore` stores pairwise distances. Each block
+	holds the scores of one unnested genotype against a group of nested genotypes. The order of each pair matters, since the
+	scores of (nested, unnested) and (unnested, nested) are not the same.
+"""
+from pathlib import Path
+from typing import Any, Dict
+
+import numpy
+import pandas
+
+try:
+	from muller.clustering.metrics.distance_store import BlockStore, HashIndex, hash_trajectories
+	from muller.inheritance.score_matrix import ScoreMatrix
+	from muller.inheritance.scoring import Score
+except ModuleNotFoundError:
+	from ..clustering.metrics.distance_store import BlockStore, HashIndex, hash_trajectories
+	from .score_matrix import ScoreMatrix
+	from .scoring import Score
+
+# Each pair takes 49 bytes in the database.
+DEFAULT_MAXIMUM_PAIRS = 20_000_000
+# The order of the scores of each pair in a block.
+SCORE_ARRAYS = ['greater', 'fixed', 'area', 'derivative', 'total']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS parameters (
+	id INTEGER PRIMARY KEY,
+	dlimit REAL NOT NULL,
+	flimit REAL NOT NULL,
+	pvalue REAL NOT NULL,
+	weights TEXT NOT NULL,
+	timepoints TEXT NOT NULL,
+	UNIQUE (dlimit, flimit, pvalue, weights, timepoints)
+);
+CREATE TABLE IF NOT EXISTS blocks (
+	id INTEGER PRIMARY KEY,
+	parameters INTEGER NOT NULL,
+	unnested INTEGER NOT NULL,
+	total INTEGER NOT NULL,
+	nested BLOB NOT NULL,
+	scores BLOB NOT NULL,
+	floats BLOB NOT NULL,
+	last_used INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS block_unnested ON blocks (parameters, unnested);
+CREATE TABLE IF NOT EXISTS generation (
+	value INTEGER NOT NULL
+);
+"""
+
+
+def get_parameters(scorer: Score, genotypes: pandas.DataFrame) -> Dict[str, Any]:
+	"""
+		Returns the values which the scores of each pair depend on, other than the frequencies of the two genotypes.
+		The weights are saved with their type, since `Score.score_pair` returns a `float` score when a weight is a `float`.
+	"""
+	weights = (scorer.weight_greater, scorer.weight_above_fixed, scorer.weight_derivative, scorer.weight_jaccard)
+	return {
+		'dlimit':     scorer.dlimit,
+		'flimit':     scorer.flimit,
+		'pvalue':     scorer.pvalue,
+		'weights':    ','.join(repr(i) for i in weights),
+		'timepoints': ','.join(str(i) for i in genotypes.columns)
+	}
+
+
+class LineageScoreStore(BlockStore):
+	"""
+		Stores the lineage scores of pairs of genotypes in an sqlite database. Each block holds the scores of one unnested
+		genotype against the nested genotypes before it. See `BlockStore`.
+	Parameters
+	----------
+	filename: Path
+		The sqlite database. Created if it does not exist.
+	maximum_pairs: int
+		The maximum number of pairs to keep.
+	"""
+	schema = SCHEMA
+	parameter_columns = [('dlimit', float), ('flimit', float), ('pvalue', float), ('weights', str), ('timepoints', str)]
+	key_column = 'unnested'
+	members_column = 'nested'
+	value_columns = ['scores', 'floats']
+	description = 'lineage scores'
+
+	def __init__(self, filename: Path, maximum_pairs: int = DEFAULT_MAXIMUM_PAIRS):
+		super().__init__(filename, maximum_pairs)
+
+	def read(self, genotypes: pandas.DataFrame, parameters: Dict[str, Any], scores: ScoreMatrix) -> numpy.ndarray:
+		"""
+			Copies the score of every known pair of genotypes compared by `LineageWorkflow` into `scores`.
+			Returns a boolean array indicating which pairs in `scores` ([nested, unnested]) were found in the database.
+		"""
+		total = len(genotypes)
+		hashes = hash_trajectories(genotypes.values)
+		parameter_id = self._get_parameter_id(parameters)
+		index = HashIndex(hashes)
+		found = numpy.zeros((total, total), dtype = bool)
+
+		for unnested_positions, nested_positions, is_known, source, (values, floats) in self._read_blocks(index, parameter_id):
+			values = numpy.frombuffer(values, dtype = numpy.float64).reshape(-1, len(SCORE_ARRAYS))[is_known][source]
+			floats = numpy.frombuffer(floats, dtype = numpy.uint8)[is_known][source]
+			for unnested_position in unnested_positions:
+				# Each genotype is only compared against the genotypes before it.
+				is_pair = nested_positions < unnested_position
+				pair = nested_positions[is_pair], unnested_position
+				for column, key in enumerate(SCORE_ARRAYS):
+					getattr(scores, key)[pair] = values[is_pair, column]
+				scores.greater_is_float[pair] = (floats[is_pair] & 1) > 0
+				scores.derivative_is_float[pair] = (floats[is_pair] & 2) > 0
+				found[pair] = True
+
+		total_found = int(numpy.triu(found, k = 1).sum())
+		self.hits += total_found
+		self.misses += total * (total - 1) // 2 - total_found
+		return found
+
+	def write(self, genotypes: pandas.DataFrame, parameters: Dict[str, Any], scores: ScoreMatrix, found: numpy.ndarray):
+		""" Saves the scores in `scores` which were not already `found` in the database, then removes old blocks if needed."""
+		total = len(genotypes)
+		total_pairs = total * (total - 1) // 2 - int(numpy.triu(found, k = 1).sum())
+		if not self._can_write(total_pairs):
+			return
+		hashes = hash_trajectories(genotypes.values)
+		parameter_id = self._get_parameter_id(parameters)
+		with self.connection:
+			for unnested in range(1, total):
+				nested = numpy.flatnonzero(~found[:unnested, unnested])
+				if len(nested) == 0:
+					continue
+				values = numpy.stack([getattr(scores, key)[nested, unnested] for key in SCORE_ARRAYS], axis = 1).astype(numpy.float64)
+				floats = scores.greater_is_float[nested, unnested] + 2 * scores.derivative_is_float[nested, unnested]
+				self._write_block(
+					parameter_id, hashes[unnested], hashes[nested],
+					numpy.ascontiguousarray(values).tobytes(), floats.astype(numpy.uint8).tobytes()
+				)
+		self.evict()
@@ -1,7 +1,9 @@
 import math
 import statistics
-from typing import Dict, List, Tuple
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
 
+import numpy
 import pandas
 import scipy.stats as stats
 from loguru import logger
@@ -9,10 +11,61 @@ from loguru import logger
 try:
 	from muller import widgets
 	from muller.inheritance import areascore
-	from muller.inheritance import polygon
+	from muller.inheritance import piecewise_area
 except ModuleNotFoundError:
 	from . import areascore
-	from . import polygon
+	from . import piecewise_area
+
+
+@dataclass
+class GenotypeArea:
+	""" The curve and area of a genotype, along with the curve and area of every other genotype (`flimit` - genotype)."""
+	values: numpy.ndarray
+	curve: numpy.ndarray
+	area: float
+	complement_curve: numpy.ndarray
+	complement_area: float
+
+
+class AreaCache:
+	"""
+		Keeps the curve and area of each genotype so that they are only calculated once, rather than once for every pair
+		of genotypes the genotype is part of. Genotypes are identified by their label and the `flimit` used for the complement.
+	"""
+
+	def __init__(self):
+		self.cache: Dict[Tuple[str, float], GenotypeArea] = dict()
+		# The number of times a genotype was found in and missing from the cache.
+		self.hits = 0
+		self.misses = 0
+
+	def __len__(self) -> int:
+		return len(self.cache)
+
+	def clear(self):
+		self.cache.clear()
+		self.hits = 0
+		self.misses = 0
+
+	@staticmethod
+	def calculate(values: numpy.ndarray, flimit: float) -> GenotypeArea:
+		complement = flimit - values
+		complement[complement < 0] = 0.0001  # Since the flimit is not exactly 1.
+		curves = piecewise_area.as_curve([values, complement])
+		curve_area, complement_area = piecewise_area.area(curves).tolist()
+		return GenotypeArea(values, curves[0], curve_area, curves[1], complement_area)
+
+	def get(self, genotype: pandas.Series, flimit: float) -> GenotypeArea:
+		""" Returns the curve and area of `genotype`, calculating them if the genotype is not in the cache or has changed."""
+		values = genotype.values.astype(float)
+		key = (genotype.name, flimit)
+		result = self.cache.get(key)
+		if result is not None and numpy.array_equal(result.values, values, equal_nan = True):
+			self.hits += 1
+		else:
+			self.misses += 1
+			result = self.cache[key] = self.calculate(values, flimit)
+		return result
 
 
 class LegacyScore:
@@ -118,7 +171,8 @@ class LegacyScore:
 class Score:
 	""" Refactored as a class so that all the dlimit,flimit,pvalue,etc variables don't have to be passed around"""
 
-	def __init__(self, dlimit: float, flimit: float, pvalue: float, weights:Tuple[int,int,int,int] = (1, 2, 1, 2)):
+	def __init__(self, dlimit: float, flimit: float, pvalue: float, weights:Tuple[int,int,int,int] = (1, 2, 1, 2),
+			area_cache: Optional[AreaCache] = None):
 		self.pvalue = pvalue
 		self.dlimit = dlimit
 		self.flimit = flimit
@@ -131,6 +185,8 @@ class Score:
 		self.weight_above_fixed = weights[1]
 		self.weight_derivative = weights[2]
 		self.weight_jaccard = weights[3]
+		# Shared between every pair of genotypes. The areas are calculated for each pair if not given.
+		self.area_cache = area_cache
 
 		self.debug = False
 
@@ -263,30 +319,42 @@ class Score:
 
 		"""
 
-		# If the nested genotype is not fixed, group the remaining frequencies into an `other` category.
-		difference_series = nested_genotype - unnested_genotype
-		if difference_series.mean() > 0:
-			# noinspection PyTypeChecker
-			other_genotypes: pandas.Series = self.flimit - nested_genotype
+		if not nested_genotype.index.equals(unnested_genotype.index):
+			nested_genotype, unnested_genotype = nested_genotype.align(unnested_genotype)
+			area_cache = None  # The aligned series don't match the cached genotypes.
 		else:
-			# noinspection PyTypeChecker
-			other_genotypes: pandas.Series = self.flimit - unnested_genotype  # In case we're testing if a small genotype contains a large genotype
-
-		other_genotypes = other_genotypes.mask(lambda s: s < 0, 0.0001)  # Since the flimit is not exactly 1.
+			area_cache = self.area_cache
+		if area_cache is None:
+			nested = AreaCache.calculate(nested_genotype.values.astype(float), self.flimit)
+			unnested = AreaCache.calculate(unnested_genotype.values.astype(float), self.flimit)
+		else:
+			nested = area_cache.get(nested_genotype, self.flimit)
+			unnested = area_cache.get(unnested_genotype, self.flimit)
 
-		unnested_polygon = polygon.as_polygon(unnested_genotype)
+		difference = nested.values - unnested.values
+		# If the nested genotype is not fixed, group the remaining frequencies into an `other` category.
+		# Only the sign of the mean difference (ignoring `nan`) matters.
+		if difference[~numpy.isnan(difference)].sum() > 0:
+			other_curve, other_area = nested.complement_curve, nested.complement_area
+		else:
+			# In case we're testing if a small genotype contains a large genotype
+			other_curve, other_area = unnested.complement_curve, unnested.complement_area
 
-		nested_polygon = polygon.as_polygon(nested_genotype)
-		other_polygon = polygon.as_polygon(other_genotypes)
+		# Every area needed for the score can be derived from the area of each series and these two differences.
+		nested_area = nested.area
+		unnested_area = unnested.area
+		nested_not_unnested, other_not_unnested = piecewise_area.difference_area(
+			numpy.stack([nested.curve, other_curve]), unnested.curve
+		).tolist()
+		unnested_not_nested = nested_not_unnested - nested_area + unnested_area
+		unnested_not_other = other_not_unnested - other_area + unnested_area
 
-		is_subset_nested = areascore.is_subset_polygon(nested_polygon, unnested_polygon)
-		is_subset_other = areascore.is_subset_polygon(other_polygon, unnested_polygon)
-		is_subset_nested_reversed = areascore.is_subset_polygon(unnested_polygon, nested_polygon)  # Check the reverse case
+		is_subset_nested = areascore.is_subset_numeric(nested_area, unnested_area, nested_not_unnested)
+		is_subset_other = areascore.is_subset_numeric(other_area, unnested_area, other_not_unnested)
+		is_subset_nested_reversed = areascore.is_subset_numeric(unnested_area, nested_area, unnested_not_nested)  # Check the reverse case
 
-		nested_area = areascore.area_of_series(nested_genotype)
-		unnested_area = areascore.area_of_series(unnested_genotype)
-		common_area_nested = areascore.X_and_Y_polygon(unnested_polygon, nested_polygon)
-		xor_area_unnested = areascore.difference_polygon(unnested_polygon, nested_polygon)  # This does not distinguish between xor left vs xor right
+		common_area_nested = unnested_area - unnested_not_nested
+		xor_area_unnested = unnested_not_nested  # This does not distinguish between xor left vs xor right
 
 
 		if self.debug:
@@ -296,8 +364,7 @@ class Score:
 			# Evidence for both scenarios
 			# Test if the nested genotype is sufficiently large to assume the unnested genotype is a subset.
 			# Test only the area where the unnested genotype was detected.
-			other_polygon = polygon.as_polygon(other_genotypes)
-			common_area_other = areascore.X_and_Y_polygon(unnested_polygon, other_polygon)
+			common_area_other = unnested_area - unnested_not_other
 			score = int(common_area_nested > 2 * common_area_other)
 
 		elif is_subset_nested:
@@ -395,6 +462,33 @@ class Score:
 		}
 		return score_data
 
+	def score_pruned_pair(self, nested_genotype: pandas.Series, unnested_trajectory: pandas.Series) -> Dict[str, float]:
+		"""
+			Same as `score_pair` for genotypes which were never detected at the same timepoint, and were detected across at least
+			3 timepoints (see `genotype_intervals.GenotypeIntervals`). There are no timepoints where both genotypes were detected,
+			so the greater score is always the negative weight and the above-fixed and derivative scores are 0. Only the area
+			score has to be calculated.
+		"""
+		score_greater = self.weight_greater * -1
+		score_fixed = 0
+		score_area = self.calculate_score_area(nested_genotype, unnested_trajectory)
+		total_score = score_fixed + score_greater + score_area
+		if total_score > 0:
+			# `calculate_score_derivative` scores an empty series as 0.
+			score_derivative = 0 * self.weight_derivative
+			total_score += score_derivative
+		else:
+			score_derivative = 0
+		return {
+			'nestedGenotype':   nested_genotype.name,
+			'unnestedGenotype': unnested_trajectory.name,
+			'scoreGreater':     score_greater,
+			'scoreFixed':       score_fixed,
+			'scoreArea':        score_area,
+			'scoreDerivative':  score_derivative,
+			'totalScore':       total_score
+		}
+
 	def derivative(self, left: pandas.Series, right: pandas.Series) -> Tuple[float, int]:
 		# l, r = widgets.get_valid_points(left, right, 0.03, 0.97, inner = True)
 		l, r = left, right
@@ -47,6 +47,7 @@ pandas.set_option('mode.chained_assignment',
 from loguru import logger
 
 from muller import clustering, dataio, inheritance, commandline_parser
+from muller.inheritance import lineage_sweep
 from muller.dataio import projectdata, annotations, projectpaths
 
 logger.remove()  # Need to remove the default sink so that the logger doesn't print messages twice.
@@ -61,7 +62,13 @@ else:
 def run_genotype_inference_workflow(trajectoryio: Union[str, Path, pandas.DataFrame], metric: str, dlimit: float,
 		flimit: float,
 		similarity_cutoff: float, known_genotypes: Optional[Path] = None, threads: Optional[int] = None,
-		is_genotype: bool = False) -> projectdata.DataGenotypeInference:
+		is_genotype: bool = False, engine: str = 'vectorized', filename_memmap: Optional[Path] = None,
+		filename_pairwise: Optional[Path] = None, filename_distance_cache: Optional[Path] = None,
+		distance_cache_size: Optional[int] = None, prune_cutoff: Optional[float] = None,
+		quantile_method: str = 'exact', similarity_sweep: Optional[List[float]] = None,
+		sweep_genotypes: Optional[List[float]] = None, binned: bool = False,
+		maximum_bin_size: Optional[int] = None, collapse_tolerance: Optional[float] = None, method: str = 'hierarchy',
+		difference_cutoff: float = 0.10) -> projectdata.DataGenotypeInference:
 	"""
 	Parameters
 	----------
@@ -79,6 +86,34 @@ def run_genotype_inference_workflow(trajectoryio: Union[str, Path, pandas.DataFr
 	known_genotypes
 	threads
 	is_genotype: bool
+	engine: Literal['pairwise', 'vectorized']
+		How the pairwise distances should be calculated.
+	filename_memmap: Optional[Path]
+		Enables the out-of-core mode. The pairwise distances are stored in a memory-mapped file at this location.
+	filename_pairwise: Optional[Path]
+		Distances calculated in a previous run, either as a binary distance file or a square table.
+	filename_distance_cache: Optional[Path]
+		A database of pairwise distances which is shared between runs. Only the missing distances are calculated.
+	distance_cache_size: Optional[int]
+		The maximum number of distances to keep in `filename_distance_cache`.
+	prune_cutoff: Optional[float]
+		Skips the pairwise distances which are provably larger than this distance and clusters with single linkage at this distance.
+	quantile_method: Literal['exact', 'approximate']
+		How the distance cutoff is calculated from `similarity_cutoff`.
+	similarity_sweep: Optional[List[float]]
+		If given, the trajectories are also grouped at each of these similarity cutoffs, reusing the distances and linkage.
+	sweep_genotypes: Optional[List[float]]
+		The similarity cutoffs to generate a genotype table for when sweeping the similarity cutoff.
+	binned: bool
+		Clusters the trajectories within coarse bins and then merges the clusters, rather than comparing every pair.
+	maximum_bin_size: Optional[int]
+		The maximum number of trajectories in each bin.
+	collapse_tolerance: Optional[float]
+		Collapses the trajectories which are identical after rounding to this precision before calculating the distances.
+	method: {'hierarchy', 'matlab', 'twostep'}
+		The clustering method.
+	difference_cutoff: float
+		Used to unlink unrelated trajectories when `method` is 'twostep'.
 	"""
 	if isinstance(trajectoryio, (str, Path)):
 		logger.info(f"Reading '{trajectoryio}' as the trajectory table.")
@@ -96,7 +131,19 @@ def run_genotype_inference_workflow(trajectoryio: Union[str, Path, pandas.DataFr
 		dlimit = dlimit,
 		flimit = flimit,
 		starting_genotypes = known_genotypes,
-		threads = threads
+		threads = threads,
+		engine = engine,
+		filename_memmap = filename_memmap,
+		filename_pairwise = filename_pairwise,
+		filename_distance_cache = filename_distance_cache,
+		distance_cache_size = distance_cache_size,
+		prune_cutoff = prune_cutoff,
+		quantile_method = quantile_method,
+		binned = binned,
+		maximum_bin_size = maximum_bin_size,
+		collapse_tolerance = collapse_tolerance,
+		method = method,
+		difference_cutoff = difference_cutoff
 	)
 	if is_genotype:
 		logger.info(f"Skipping genotype inference...")
@@ -117,12 +164,24 @@ def run_genotype_inference_workflow(trajectoryio: Union[str, Path, pandas.DataFr
 		)
 	else:
 		genotype_data = genotype_generator.run(trajectories, distance_cutoff = similarity_cutoff)
+		if similarity_sweep or sweep_genotypes:
+			if prune_cutoff is not None or binned:
+				logger.warning(f"Skipping the similarity cutoff sweep since some of the pairwise distances were skipped.")
+			elif collapse_tolerance is not None:
+				logger.warning(f"Skipping the similarity cutoff sweep since the duplicate trajectories were collapsed.")
+			elif method != 'hierarchy':
+				logger.warning(f"Skipping the similarity cutoff sweep since it requires hierarchical clustering.")
+			else:
+				genotype_data.clustersweep = genotype_generator.sweep(genotype_data, similarity_sweep or [], sweep_genotypes or [])
 	genotype_data.table_trajectories_info = trajectory_info
 	return genotype_data
 
 
 def run_genotype_lineage_workflow(genotypeio: Union[str, Path, pandas.DataFrame], dlimit: float, flimit: float,
-		pvalue: float, known_ancestry: Optional[Path], conservative: bool) -> projectdata.DataGenotypeLineage:
+		pvalue: float, known_ancestry: Optional[Path], conservative: bool, threads: Optional[int] = None,
+		filename_lineage_cache: Optional[Path] = None, lineage_cache_size: Optional[int] = None, bootstrap: int = 0,
+		bootstrap_depth: Optional[int] = None, sweep_weights: Optional[List[Tuple[int, int, int, int]]] = None,
+		sweep_pvalues: Optional[List[float]] = None) -> projectdata.DataGenotypeLineage:
 	"""
 
 	Parameters
@@ -133,16 +192,42 @@ def run_genotype_lineage_workflow(genotypeio: Union[str, Path, pandas.DataFrame]
 	pvalue
 	known_ancestry
 	conservative
+	threads
+		The number of processes used to score the genotype pairs when the table cannot be scored as arrays.
+	filename_lineage_cache: Optional[Path]
+		A database of the lineage scores calculated in previous runs. Only the pairs which include new or modified genotypes are scored.
+	lineage_cache_size: Optional[int]
+		The maximum number of pairs to keep in `filename_lineage_cache`.
+	bootstrap: int
+		The number of bootstrap replicates used to estimate the support of each edge.
+	bootstrap_depth: Optional[int]
+		The number of reads used to resample each frequency in the bootstrap replicates.
+	sweep_weights: Optional[List[Tuple[int, int, int, int]]]
+		If given, the lineage is also inferred with each of these sets of score weights (see `lineage_sweep.run_lineage_sweep`).
+	sweep_pvalues: Optional[List[float]]
+		The pvalues to combine with each of `sweep_weights`. Defaults to `pvalue`.
 
 	Returns
 	-------
 
 	"""
+	if filename_lineage_cache:
+		if lineage_cache_size:
+			score_store = inheritance.LineageScoreStore(filename_lineage_cache, lineage_cache_size)
+		else:
+			score_store = inheritance.LineageScoreStore(filename_lineage_cache)
+	else:
+		score_store = None
+
 	lineage_generator = inheritance.LineageWorkflow(
 		dlimit = dlimit,
 		flimit = flimit,
 		pvalue = pvalue,
-		conservative = conservative
+		conservative = conservative,
+		threads = threads,
+		score_store = score_store,
+		bootstrap = bootstrap if bootstrap else 0,
+		bootstrap_depth = bootstrap_depth if bootstrap_depth else inheritance.lineage_bootstrap.DEFAULT_DEPTH
 	)
 
 	# Read in the input data if it is not already a pandas.DataFrame object
@@ -161,6 +246,16 @@ def run_genotype_lineage_workflow(genotypeio: Union[str, Path, pandas.DataFrame]
 			known_ancestry.pop('Identity')
 
 	lineage_data = lineage_generator.run(genotypes, known_ancestry)
+	if sweep_weights or sweep_pvalues:
+		lineage_data.lineage_sweep = lineage_sweep.run_lineage_sweep(
+			genotypes,
+			dlimit = dlimit,
+			flimit = flimit,
+			weights = sweep_weights or [lineage_sweep.DEFAULT_WEIGHTS],
+			pvalues = sweep_pvalues or [pvalue],
+			known_ancestry = known_ancestry,
+			conservative = conservative
+		)
 	return lineage_data
 
 
@@ -242,7 +337,21 @@ def run_workflow(program_options: argparse.Namespace):
 		similarity_cutoff = program_options.similarity_cutoff,
 		known_genotypes = program_options.known_genotypes,
 		threads = program_options.threads,
-		is_genotype = program_options.is_genotype
+		is_genotype = program_options.is_genotype,
+		engine = program_options.engine,
+		filename_memmap = paths.filename_table_distance_binary if program_options.out_of_core else None,
+		filename_pairwise = program_options.filename_pairwise,
+		filename_distance_cache = program_options.filename_distance_cache,
+		distance_cache_size = program_options.distance_cache_size,
+		prune_cutoff = program_options.prune_cutoff,
+		quantile_method = program_options.quantile_method,
+		similarity_sweep = program_options.similarity_sweep,
+		sweep_genotypes = program_options.sweep_genotypes,
+		binned = program_options.binned_clustering,
+		maximum_bin_size = program_options.maximum_bin_size,
+		collapse_tolerance = program_options.collapse_tolerance,
+		method = program_options.method,
+		difference_cutoff = program_options.difference_cutoff
 	)
 
 	if result_genotype_inference.table_trajectories_info is None:
@@ -257,7 +366,14 @@ def run_workflow(program_options: argparse.Namespace):
 		flimit = program_options.flimit,
 		pvalue = program_options.pvalue,
 		known_ancestry = program_options.known_ancestry,
-		conservative = program_options.conservative
+		conservative = program_options.conservative,
+		threads = program_options.threads,
+		filename_lineage_cache = program_options.filename_lineage_cache,
+		lineage_cache_size = program_options.lineage_cache_size,
+		bootstrap = program_options.bootstrap,
+		bootstrap_depth = program_options.bootstrap_depth,
+		sweep_weights = program_options.lineage_sweep_weights,
+		sweep_pvalues = program_options.lineage_sweep_pvalues
 	)
 
 	# Generate the tables needed for generating the muller plots.
@@ -265,12 +381,12 @@ def run_workflow(program_options: argparse.Namespace):
 		table_genotypes = result_genotype_inference.table_genotypes,
 		series_edges = result_genotype_lineage.clusters.as_ancestry_table(),
 		dlimit = data_basic.program_options.dlimit,
-		smooth_values = data_basic.program_options.smooth_plot
+		smooth_values = data_basic.program_options.smooth_plot,
+		series_support = result_genotype_lineage.series_support
 	)
 
 	paths.save_projectdata_basic(data_basic)
 	paths.save_workflow_clustering(result_genotype_inference)
-	paths.save_workflow_hierarchy(result_genotype_inference.clusterdata)
 	paths.save_workflow_lineage(result_genotype_lineage)
 	paths.save_workflow_ggmuller(result_ggmuller)
 	# save_tables(data_basic, result_genotype_inference, result_genotype_lineage, genotype_annotations)
@@ -282,12 +398,15 @@ def run_workflow(program_options: argparse.Namespace):
 		data_ggmuller = result_ggmuller,
 		genotype_annotations = genotype_annotations
 	)
+	# Saved after the graphics so that the time taken to order the dendrogram is included, and so that the linkage table
+	# has the same leaf order as the dendrogram.
+	paths.save_workflow_hierarchy(result_genotype_inference.clusterdata)
 
 	data_basic.save(output_folder)
 
 
 def run_workflow_ggmuller(table_genotypes: pandas.DataFrame, series_edges: pandas.Series, dlimit: float,
-		smooth_values: bool):
+		smooth_values: bool, series_support: Optional[pandas.Series] = None):
 	""" Generates the population and edges table used in the muller plot.
 		Parameters
 		----------
@@ -297,6 +416,8 @@ def run_workflow_ggmuller(table_genotypes: pandas.DataFrame, series_edges: panda
 			predicted parent genotype.
 		dlimit:float
 		smooth_values:bool
+		series_support: Optional[pandas.Series]
+			The bootstrap support of the edge to each genotype, which is added to the edges table and the lineage plot.
 	"""
 
 	generator_table_population = dataio.GGMuller(cutoff_detection = dlimit, adjust_populations = True)
@@ -307,7 +428,8 @@ def run_workflow_ggmuller(table_genotypes: pandas.DataFrame, series_edges: panda
 	result = projectdata.DataGGmuller(
 		table_populations = table_population,
 		series_edges = series_edges,
-		table_muller = table_muller
+		table_muller = table_muller,
+		series_support = series_support
 	)
 
 	return result
@@ -396,19 +518,32 @@ def render_graphics(paths: projectpaths.OutputFilenames, data_basic: projectdata
 		render = True
 	)
 
-	# Plot the figures that aren't parametrized
-	if data_inference.clusterdata is not None:
-		workflow_graphics.generate_dendrogram(data_inference.clusterdata.table_linkage, data_inference.matrix_distance,
-			paths.filename_figure_linkage_plot)
-	if data_inference.matrix_distance is not None:
+	# The heatmap and distance distribution can't be generated for datasets too large to hold the distance matrix in memory,
+	# or when only some of the pairwise distances were calculated.
+	is_out_of_core = getattr(data_inference.matrix_distance, 'out_of_core', False)
+	is_sparse = getattr(data_inference.matrix_distance, 'is_sparse', False)
+	# Plot the figures that aren't parametrized. The binned clustering mode does not generate a linkage table.
+	if data_inference.clusterdata is not None and data_inference.clusterdata.table_linkage is not None:
+		# The leaves are only reordered for the dendrogram. The optimal ordering would read the entire distance matrix into memory.
+		leaf_ordering = data_basic.program_options.leaf_ordering
+		if (is_out_of_core or is_sparse) and leaf_ordering == 'optimal':
+			logger.info("Using the approximate leaf ordering for the dendrogram of the out-of-core or sparse distance matrix.")
+			leaf_ordering = 'approximate'
+		# The approximate ordering only reads the known pairs of a sparse distance matrix.
+		distances = data_inference.matrix_distance if is_sparse else data_inference.matrix_distance.triangle()
+		table_linkage = clustering.hierarchy.get_ordered_linkage(data_inference.clusterdata, distances, leaf_ordering)
+		workflow_graphics.generate_dendrogram(table_linkage, data_inference.matrix_distance, paths.filename_figure_linkage_plot)
+	if is_out_of_core or is_sparse:
+		logger.info("Skipping the distance heatmap and distribution plots for the out-of-core or sparse distance matrix.")
+	elif data_inference.matrix_distance is not None:
 		workflow_graphics.generate_heatmap(data_inference.matrix_distance.squareform(),
 			paths.filename_figure_distance_heatmap)
-	if data_inference.clusterdata is not None and data_inference.matrix_distance is not None:
-		graphics.generate_distance_plot(
-			data_inference.matrix_distance.values,
-			data_inference.clusterdata.distance_cutoff,
-			paths.filename_figure_distribution
-		)
+		if data_inference.clusterdata is not None:
+			graphics.generate_distance_plot(
+				data_inference.matrix_distance.values,
+				data_inference.clusterdata.distance_cutoff,
+				paths.filename_figure_distribution
+			)
 	# Set up the generators
 	generator_panel_timeseries = graphics.TimeseriesPanel(render = data_basic.program_options.render)
 	generator_plot_timeseries = graphics.TimeseriesPlot(render = data_basic.program_options.render)
@@ -499,8 +634,11 @@ def render_graphics(paths: projectpaths.OutputFilenames, data_basic: projectdata
 				filename = filename_mullerplot_unannotated
 			)
 			logger.info("Generating the lineageplot...")
+			table_edges = data_ggmuller.series_edges.reset_index()
+			if data_ggmuller.series_support is not None:
+				table_edges['Support'] = table_edges['Identity'].map(data_ggmuller.series_support)
 			lineageplot = graphics.flowchart(
-				edges = data_ggmuller.series_edges.reset_index(),
+				edges = table_edges,
 				palette = current_palette.get_genotype_palette(),
 				annotations = genotype_annotations,
 				filename = filename_lineageplot,
@@ -1,10 +1,15 @@
 from pathlib import Path
 
+import numpy
 import pandas
 import pytest
+from scipy.cluster import hierarchy as scipy_hierarchy
+from scipy.spatial import distance as scipy_distance
 
 from muller import dataio
-from muller.clustering import ClusterMutations
+from muller.dataio import projectdata, projectpaths
+from muller.clustering import ClusterMutations, binned_clustering, hierarchy, iterative_clustering
+from muller.clustering.metrics import SparseDistanceCache, distance_memmap, distance_quantile
 from .. import filenames
 
 
@@ -54,3 +59,288 @@ def test_clustering_algorithm_on_real_tables(cluster, filename):
 	result = cluster.run(trajectories, distance_cutoff = 0.2)
 
 	assert sorted(result.genotype_members.values()) == sorted(expected_members.values())
+
+
+@pytest.mark.parametrize("quantile", [0, 0.05, 0.33, 0.5, 1])
+def test_adjust_similarity_cutoff_counts_both_directions(quantile):
+	condensed = [0, 0.3, 0.1, 0.9, 0.2, 0.5, 0.9, 0.05]
+	filtered = [i for i in condensed if 0 < i < max(condensed)]
+	expected = pandas.Series(filtered * 2).quantile(quantile)
+	result = hierarchy.HierarchalCluster.adjust_similarity_cutoff(quantile, condensed)
+	assert result == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("quantile", [0.05, 0.5])
+def test_adjust_similarity_cutoff_out_of_core(tmp_path, quantile):
+	condensed = numpy.random.default_rng(0).random(5000)
+	condensed[::7] = 0
+	filtered = condensed[(condensed > 0) & (condensed < condensed.max())]
+	expected = pandas.Series(numpy.repeat(filtered, 2)).quantile(quantile)
+
+	memmap = distance_memmap.create_distance_memmap(tmp_path / "distance.bin", len(condensed))
+	memmap[:] = condensed
+	assert distance_quantile.get_filtered_quantile(memmap, quantile, chunk_size = 100) == pytest.approx(expected)
+	approximate = hierarchy.HierarchalCluster.adjust_similarity_cutoff(quantile, memmap, method = 'approximate')
+	assert approximate == pytest.approx(expected, rel = 0.01)
+
+
+@pytest.mark.parametrize("filename", [filenames.real_tables['nature12344']])
+def test_clustering_with_precomputed_distances(tmp_path, cluster, filename):
+	trajectories = dataio.import_table(filename, sheet_name = 'trajectory', index = 'Trajectory')
+	expected = cluster.run(trajectories, distance_cutoff = 0.2)
+
+	filename_binary = tmp_path / "distance.bin"
+	filename_table = tmp_path / "distance.tsv"
+	expected.matrix_distance.save_binary(filename_binary)
+	expected.matrix_distance.squareform().to_csv(filename_table, sep = "\t")
+
+	for filename_pairwise in [filename_binary, filename_table]:
+		precomputed = ClusterMutations(metric = 'binomial', dlimit = 0.03, flimit = 0.97, filename_pairwise = filename_pairwise)
+		result = precomputed.run(trajectories, distance_cutoff = 0.2)
+		assert result.genotype_members == expected.genotype_members
+
+
+def test_clustering_with_previous_distances_for_fewer_trajectories(tmp_path, cluster):
+	trajectories = dataio.import_table(filenames.generic_tables['generic.genotypes.10'], sheet_name = 'trajectory', index = 'Trajectory')
+	expected = cluster.run(trajectories, distance_cutoff = 0.2)
+
+	filename_binary = tmp_path / "distance.bin"
+	previous = cluster.run(trajectories.iloc[:len(trajectories) // 2], distance_cutoff = 0.2)
+	previous.matrix_distance.save_binary(filename_binary)
+
+	incremental = ClusterMutations(metric = 'binomial', dlimit = 0.03, flimit = 0.97, filename_pairwise = filename_binary)
+	result = incremental.run(trajectories, distance_cutoff = 0.2)
+	assert result.genotype_members == expected.genotype_members
+	assert list(result.matrix_distance.values) == pytest.approx(list(expected.matrix_distance.values))
+
+
+@pytest.mark.parametrize("filename", [filenames.real_tables['nature12344']])
+def test_clustering_with_skipped_distances_matches_single_linkage(filename):
+	trajectories = dataio.import_table(filename, sheet_name = 'trajectory', index = 'Trajectory')
+	labels = sorted(trajectories.index)
+	condensed = ClusterMutations(metric = 'binomial', dlimit = 0.03, flimit = 0.97).get_pairwise_distances(trajectories)
+	linkage_table = scipy_hierarchy.linkage(condensed.triangle(), method = 'single')
+	clusters = scipy_hierarchy.fcluster(linkage_table, t = 0.2, criterion = 'distance')
+	expected = hierarchy.HierarchalCluster._label_clusters(clusters, labels)
+
+	result = ClusterMutations(metric = 'binomial', dlimit = 0.03, flimit = 0.97, prune_cutoff = 0.2).run(trajectories)
+	assert result.matrix_distance.total_pruned > 0
+	assert sorted(result.genotype_members.values()) == sorted(expected)
+
+
+@pytest.mark.parametrize("filename", [filenames.real_tables['nature12344']])
+def test_similarity_sweep_matches_separate_runs(cluster, filename):
+	trajectories = dataio.import_table(filename, sheet_name = 'trajectory', index = 'Trajectory')
+	result = cluster.run(trajectories, distance_cutoff = 0.05)
+	quantiles = [0.01, 0.05, 0.2, 0.5]
+	sweep = cluster.sweep(result, quantiles, selected = [0.2])
+	assert list(sweep.table_sweep['quantile']) == quantiles
+
+	for quantile in quantiles:
+		expected = ClusterMutations(metric = 'binomial', dlimit = 0.03, flimit = 0.97).run(trajectories, distance_cutoff = quantile)
+		assert sweep.clusters[quantile] == expected.clusterdata.clusters
+		row = sweep.table_sweep.set_index('quantile').loc[quantile]
+		assert row['distanceCutoff'] == expected.clusterdata.distance_cutoff
+		assert row['genotypes'] == len(expected.genotype_members)
+	expected = ClusterMutations(metric = 'binomial', dlimit = 0.03, flimit = 0.97).run(trajectories, distance_cutoff = 0.2)
+	assert sorted(sweep.table_genotypes[0.2]['members']) == sorted('|'.join(i) for i in expected.genotype_members.values())
+
+
+def test_get_cluster_separation():
+	condensed = numpy.random.default_rng(0).random(45)
+	linkage_table = scipy_hierarchy.linkage(condensed, method = 'ward')
+	cutoffs = [1.5, 0.2, 0.8]
+	result = hierarchy.get_cluster_separation(linkage_table, condensed, cutoffs, chunk_size = 7)
+	square = scipy_distance.squareform(condensed)
+	rows, columns = numpy.triu_indices(len(square), 1)
+	for index, cutoff in enumerate(cutoffs):
+		clusters = scipy_hierarchy.fcluster(linkage_table, t = cutoff, criterion = 'distance')
+		is_within = clusters[rows] == clusters[columns]
+		assert result['meanWithin'][index] == pytest.approx(square[rows, columns][is_within].mean(), nan_ok = True)
+		assert result['meanBetween'][index] == pytest.approx(square[rows, columns][~is_within].mean(), nan_ok = True)
+
+
+@pytest.mark.parametrize("method", ['optimal', 'approximate', 'none'])
+def test_get_ordered_linkage_keeps_clusters(method):
+	condensed = numpy.random.default_rng(0).random(190)
+	linkage_table = scipy_hierarchy.linkage(condensed, method = 'ward')
+	clusterdata = projectdata.DataHierarchalCluster([], hierarchy.format_linkage_matrix(linkage_table, 20), 0.5, 0.05)
+	result = hierarchy.get_ordered_linkage(clusterdata, condensed, method)
+	assert hierarchy.get_ordered_linkage(clusterdata, condensed, method) is result
+	assert f'leafOrdering.{method}' in clusterdata.timings
+
+	ordered = result[['left', 'right', 'distance', 'observations']].values
+	assert sorted(scipy_hierarchy.leaves_list(ordered)) == list(range(20))
+	assert list(ordered[:, 2]) == list(linkage_table[:, 2])
+	for cutoff in [0.2, 0.6, 1.0]:
+		expected = scipy_hierarchy.fcluster(linkage_table, t = cutoff, criterion = 'distance')
+		clusters = scipy_hierarchy.fcluster(ordered, t = cutoff, criterion = 'distance')
+		# The clusters are the same, although they may be numbered differently.
+		assert len(set(zip(expected, clusters))) == len(set(expected)) == len(set(clusters))
+
+
+def test_saved_linkage_matches_dendrogram(tmp_path):
+	condensed = numpy.random.default_rng(0).random(190)
+	linkage_table = hierarchy.format_linkage_matrix(scipy_hierarchy.linkage(condensed, method = 'ward'), 20)
+	clusterdata = projectdata.DataHierarchalCluster([], linkage_table, 0.5, 0.05)
+	paths = projectpaths.OutputFilenames(tmp_path / "output", "test")
+
+	paths.save_workflow_hierarchy(clusterdata)
+	pandas.testing.assert_frame_equal(pandas.read_csv(paths.filename_table_linkage, sep = '\t', index_col = 0), linkage_table, check_dtype = False)
+
+	expected = hierarchy.get_ordered_linkage(clusterdata, condensed, 'optimal')
+	paths.save_workflow_hierarchy(clusterdata)
+	pandas.testing.assert_frame_equal(pandas.read_csv(paths.filename_table_linkage, sep = '\t', index_col = 0), expected, check_dtype = False)
+
+
+def test_approximate_leaf_ordering_with_sparse_distances():
+	condensed = numpy.random.default_rng(0).random(190)
+	linkage_table = scipy_hierarchy.linkage(condensed, method = 'single')
+	rows, columns = numpy.triu_indices(20, 1)
+	sparse = SparseDistanceCache([f"trajectory-{index}" for index in range(20)], rows, columns, condensed, far = 2.0)
+	expected = hierarchy.order_leaves_approximate(linkage_table, condensed)
+	assert (hierarchy.order_leaves_approximate(linkage_table, sparse) == expected).all()
+
+	clusterdata = projectdata.DataHierarchalCluster([], hierarchy.format_linkage_matrix(linkage_table, 20), 0.5, 0.05)
+	with pytest.raises(ValueError):
+		hierarchy.get_ordered_linkage(clusterdata, sparse, 'optimal')
+
+
+@pytest.mark.parametrize("filename", [filenames.real_tables['nature12344']])
+def test_binned_clustering_on_real_tables(filename):
+	trajectories = dataio.import_table(filename, sheet_name = 'trajectory', index = 'Trajectory')
+	result = ClusterMutations(metric = 'binomial', dlimit = 0.03, flimit = 0.97, binned = True, maximum_bin_size = 10).run(trajectories)
+	assert result.matrix_distance is None
+	assert result.clusterdata.table_linkage is None
+	members = [label for cluster in result.genotype_members.values() for label in cluster]
+	assert sorted(members) == sorted(trajectories.index)
+
+
+@pytest.mark.parametrize("quantile", [0.05, 0.2])
+@pytest.mark.parametrize("name", ['nature12344', 'B1'])
+def test_binned_clustering_compared_to_full_clustering(name, quantile):
+	trajectories = dataio.import_table(filenames.real_tables[name], sheet_name = 'trajectory', index = 'Trajectory')
+	expected = ClusterMutations(metric = 'binomial', dlimit = 0.03, flimit = 0.97).run(trajectories, distance_cutoff = quantile)
+	result = ClusterMutations(metric = 'binomial', dlimit = 0.03, flimit = 0.97, binned = True).run(trajectories, distance_cutoff = quantile)
+	# Every trajectory is used to estimate the distance cutoff when the table is smaller than the sample size.
+	assert result.clusterdata.distance_cutoff == pytest.approx(expected.clusterdata.distance_cutoff)
+	if name == 'nature12344':
+		assert result.clusterdata.clusters == expected.clusterdata.clusters
+	else:
+		# Binned clustering is an approximation, so some genotypes can be merged differently.
+		assert abs(len(result.genotype_members) - len(expected.genotype_members)) <= 1
+
+
+def test_binned_clustering_merges_clusters_in_bounded_windows(monkeypatch):
+	trajectories = dataio.import_table(filenames.real_tables['B1'], sheet_name = 'trajectory', index = 'Trajectory')
+	sizes = list()
+	cluster_table = binned_clustering.BinnedCluster.cluster_table
+
+	def record_size(self, table, *args, **kwargs):
+		sizes.append(len(table))
+		return cluster_table(self, table, *args, **kwargs)
+
+	monkeypatch.setattr(binned_clustering.BinnedCluster, 'cluster_table', record_size)
+	result = ClusterMutations(metric = 'binomial', dlimit = 0.03, flimit = 0.97, binned = True, maximum_bin_size = 8).run(trajectories)
+	bins = binned_clustering.get_bins(trajectories.values.astype(float), 0.03, 0.97, 8)
+	# Check that the clusters from every bin were merged in more than one window.
+	assert len(sizes) > len(bins) + 1
+	assert max(sizes) <= 8
+	members = [label for cluster in result.genotype_members.values() for label in cluster]
+	assert sorted(members) == sorted(map(str, trajectories.index))
+
+
+def test_get_windows():
+	assert [list(i) for i in binned_clustering.get_windows(7, 3)] == [[0, 1, 2], [3, 4, 5], [6]]
+	assert [list(i) for i in binned_clustering.get_windows(7, 3, 1)] == [[0], [1, 2, 3], [4, 5, 6]]
+
+
+def test_get_bins_partitions_rows():
+	values = numpy.random.default_rng(0).random((200, 6))
+	bins = binned_clustering.get_bins(values, 0.03, 0.97, maximum_bin_size = 5)
+	assert all(len(positions) <= 5 for positions in bins)
+	assert sorted(numpy.concatenate(bins)) == list(range(200))
+	signatures = binned_clustering.get_signatures(values, 0.03, 0.97)
+	for positions in bins:
+		assert len(numpy.unique(signatures[positions], axis = 0)) == 1
+
+
+def test_merge_known_genotypes():
+	clusters = [['A', 'B'], ['C'], ['D', 'E'], ['F']]
+	result = binned_clustering.merge_known_genotypes(clusters, [['B', 'D'], ['E', 'X']])
+	assert result == [['A', 'B', 'D', 'E'], ['C'], ['F']]
+
+
+@pytest.mark.parametrize("method", ['ward', 'average'])
+def test_weighted_linkage_matches_repeated_points(method):
+	generator = numpy.random.default_rng(0)
+	points = generator.random((15, 3))
+	weights = generator.integers(1, 4, len(points))
+	expected = scipy_hierarchy.linkage(scipy_distance.pdist(numpy.repeat(points, weights, axis = 0)), method = method)
+	result = hierarchy.weighted_linkage(scipy_distance.pdist(points), weights, method)
+	# The repeated points are merged first, at a distance of 0.
+	assert result[:, 2] == pytest.approx(expected[weights.sum() - len(points):, 2])
+
+	leaves = numpy.repeat(numpy.arange(len(points)), weights)
+	for cutoff in (result[:-1, 2] + result[1:, 2]) / 2:
+		clusters = scipy_hierarchy.fcluster(result, t = cutoff, criterion = 'distance')[leaves]
+		expected_clusters = scipy_hierarchy.fcluster(expected, t = cutoff, criterion = 'distance')
+		assert len(set(zip(expected_clusters, clusters))) == len(set(expected_clusters)) == len(set(clusters))
+
+
+@pytest.mark.parametrize("metric", ['binomial', 'pearson'])
+def test_clustering_with_collapsed_duplicates(metric):
+	trajectories = dataio.import_table(filenames.real_tables['nature12344'], sheet_name = 'trajectory', index = 'Trajectory')
+	duplicates = trajectories.iloc[[0, 0, 3, 5, 5, 5]]
+	duplicates.index = [f"{label}-copy{index}" for index, label in enumerate(duplicates.index)]
+	# Constant within its comparison window, so the pearson distance between the copies is not 0.
+	constant = pandas.DataFrame(
+		[[0] + [0.5] * (len(trajectories.columns) - 1)] * 3, columns = trajectories.columns, index = ['constant-0', 'constant-1', 'constant-2']
+	)
+	trajectories = pandas.concat([trajectories, duplicates, constant])
+	collapsed = len(duplicates) + (len(constant) - 1 if metric == 'binomial' else 0)
+
+	for quantile in [0.05, 0.2]:
+		expected = ClusterMutations(metric = metric, dlimit = 0.03, flimit = 0.97).run(trajectories, distance_cutoff = quantile)
+		result = ClusterMutations(metric = metric, dlimit = 0.03, flimit = 0.97, collapse_tolerance = 0).run(trajectories, distance_cutoff = quantile)
+		assert result.clusterdata.to_dict()['collapsedTrajectories'] == collapsed
+		assert len(result.matrix_distance.labels) == len(trajectories) - collapsed
+		assert result.clusterdata.distance_cutoff == pytest.approx(expected.clusterdata.distance_cutoff)
+		assert result.genotype_members == expected.genotype_members
+
+
+def test_merge_genotypes_matches_average_linkage():
+	generator = numpy.random.default_rng(0)
+	points = generator.random((30, 3))
+	groups = generator.integers(0, 2, len(points))
+	condensed = scipy_distance.pdist(points)
+	cutoff = numpy.quantile(condensed, 0.2)
+	result = iterative_clustering.merge_genotypes(condensed, groups, cutoff)
+
+	expected = list()
+	for group in [0, 1]:
+		positions = numpy.flatnonzero(groups == group)
+		linkage_table = scipy_hierarchy.linkage(scipy_distance.pdist(points[positions]), method = 'average')
+		clusters = scipy_hierarchy.fcluster(linkage_table, t = cutoff, criterion = 'distance')
+		expected += [sorted(positions[clusters == cluster].tolist()) for cluster in set(clusters)]
+	assert sorted(result) == sorted(expected)
+
+
+def test_unlink_genotypes():
+	points = numpy.array([[0.0], [0.1], [0.2], [1.0], [1.1], [3.0]])
+	condensed = scipy_distance.pdist(points)
+	result = iterative_clustering.unlink_genotypes(condensed, [[0, 1, 2, 3, 4], [5]], cutoff = 0.5)
+	assert sorted(result) == [[0, 1, 2], [3, 4], [5]]
+
+
+@pytest.mark.parametrize("method", ['matlab', 'twostep'])
+@pytest.mark.parametrize("filename", [filenames.real_tables['nature12344']])
+def test_iterative_clustering_on_real_tables(method, filename):
+	trajectories = dataio.import_table(filename, sheet_name = 'trajectory', index = 'Trajectory')
+	result = ClusterMutations(metric = 'binomial', dlimit = 0.03, flimit = 0.97, method = method).run(trajectories, distance_cutoff = 0.2)
+	members = [label for cluster in result.genotype_members.values() for label in cluster]
+	assert sorted(members) == sorted(trajectories.index)
+	assert result.clusterdata.table_linkage is None
+	# Trajectories which fix are never grouped with trajectories which do not fix.
+	is_fixed = (trajectories >= 0.97).any(axis = 1)
+	assert all(is_fixed[cluster].nunique() == 1 for cluster in result.genotype_members.values())
@@ -1,7 +1,13 @@
+import itertools
 from pathlib import Path
 from typing import *
+import numpy
 import pytest
-from muller.clustering.metrics import distance_calculator
+import pandas
+from scipy.spatial import distance as scipy_distance
+from muller.clustering.metrics import distance_calculator, distance_kernels, distance_memmap, distance_parallel, distance_quantile
+from muller.clustering.metrics import CondensedDistanceCache, DistanceStore
+from muller.clustering.metrics.trajectory_states import PAIR_CATEGORIES, TrajectoryStates
 
 
 @pytest.mark.parametrize(
@@ -16,4 +22,293 @@ from muller.clustering.metrics import distance_calculator
 )
 def test_categorize_series(left, right, expected):
 	result = distance_calculator.get_pair_category(left, right, dlimit = 0.03, flimit = 0.90)
-	assert result == expected
\ No newline at end of file
+	assert result == expected
+
+
+@pytest.mark.parametrize(
+	"left, right, expected",
+	[
+		([0.00, 0.00, 0.00, 1.00, 1.00, 1.00, 1.00], [0.00, 1.00, 1.00, 1.00, 1.00, 1.00, 1.00], "onlyFixed"),
+		([0.00, 0.00, 0.00, 1.00, 1.00, 1.00, 1.00], [0.00, 0.00, 0.00, 0.52, 0.45, 0.91, 0.91], "partiallyFixed"),
+		([0.00, 0.01, 0.26, 1.00, 1.00, 1.00, 1.00], [0.00, 0.00, 0.00, 0.52, 0.45, 0.91, 0.91], "bothFixed"),
+		([0.00, 0.01, 0.26, 1.00, 1.00, 1.00, 1.00], [0.00, 0.00, 0.00, 0.18, 0.17, 0.23, 0.24], "oneFixed"),
+		([0.00, 0.00, 0.00, 0.11, 0.00, 0.11, 0.12], [0.00, 0.00, 0.00, 0.18, 0.17, 0.23, 0.24], "notFixed"),
+	]
+)
+def test_categorize_series_with_trajectory_states(left, right, expected):
+	states = TrajectoryStates([left, right], dlimit = 0.03, flimit = 0.90, labels = ['left', 'right'])
+	assert states.get_pair_category('left', 'right') == expected
+	assert PAIR_CATEGORIES[states.get_pair_categories()[0]] == expected
+
+@pytest.fixture
+def trajectory_table() -> pandas.DataFrame:
+	data = [
+		[0.00, 0.00, 0.00, 1.00, 1.00, 1.00, 1.00],
+		[0.00, 1.00, 1.00, 1.00, 1.00, 1.00, 1.00],
+		[0.00, 0.00, 0.00, 1.00, 1.00, 1.00, 1.00],
+		[0.00, 0.00, 0.00, 0.52, 0.45, 0.91, 0.91],
+		[0.00, 0.01, 0.26, 1.00, 1.00, 1.00, 1.00],
+		[0.00, 0.00, 0.00, 0.18, 0.17, 0.23, 0.24],
+		[0.00, 0.00, 0.00, 0.11, 0.00, 0.11, 0.12],
+		[0.00, 0.00, 0.20, 0.40, 0.00, 0.00, 0.00],
+		[0.00, 0.00, 0.00, 0.00, 0.00, 0.00, 0.02]
+	]
+	return pandas.DataFrame(data, index = [f"trajectory-{i}" for i in range(len(data))], columns = [0, 1, 2, 3, 4, 5, 6])
+
+
+@pytest.mark.parametrize("dlimit, flimit", [(0.03, 0.97), (0.03, 0.90), (0.0, 1.0)])
+def test_vectorized_engine_matches_pairwise_engine(trajectory_table, dlimit, flimit):
+	expected = distance_calculator.DistanceCalculator(dlimit, flimit, 'binomial', engine = 'pairwise').run(trajectory_table)
+	result = distance_calculator.DistanceCalculator(dlimit, flimit, 'binomial', engine = 'vectorized').run(trajectory_table)
+
+	assert result.keys() == expected.keys()
+	for key, value in expected.items():
+		assert result[key] == pytest.approx(value)
+
+
+@pytest.mark.parametrize("metric", ['pearson', 'minkowski', 'combined'])
+def test_vectorized_metrics_match_pairwise_engine(trajectory_table, metric):
+	table = pandas.concat([trajectory_table, pandas.DataFrame(numpy.random.default_rng(5).random((20, 7)).round(2), columns = trajectory_table.columns)])
+	table.index = [f"trajectory-{i}" for i in range(len(table))]
+	expected = distance_calculator.DistanceCalculator(0.03, 0.97, metric, engine = 'pairwise').run_condensed(table)
+	calculator = distance_calculator.DistanceCalculator(0.03, 0.97, metric, engine = 'vectorized')
+	assert calculator.use_vectorized_engine()
+	result = calculator.run_condensed(table)
+
+	assert list(result.values) == pytest.approx(list(expected.values))
+	assert list(result.get_missing()) == list(expected.get_missing())
+
+
+def test_binomial_distance_matrix_is_condensed(trajectory_table):
+	values = trajectory_table.values
+	result = distance_kernels.binomial_distance_matrix(values, 0.03, 0.97, block_elements = 1)
+	total = len(trajectory_table)
+	assert len(result) == total * (total - 1) // 2
+	# The first trajectory and the third trajectory are identical and only ever fixed.
+	assert result[distance_kernels.get_condensed_index(total, 0, 2)] == 0
+
+
+def test_trajectory_states_match_filter_timepoints(trajectory_table):
+	states = TrajectoryStates.from_table(trajectory_table, 0.03, 0.97)
+	for left, right in itertools.combinations(trajectory_table.index, 2):
+		left_trajectory = trajectory_table.loc[left]
+		right_trajectory = trajectory_table.loc[right]
+		expected_left, expected_right = distance_calculator.filter_timepoints(left_trajectory, right_trajectory, 0.03, 0.97)
+		window = states.get_pair_window(left, right)
+		if expected_left is None:
+			assert window is None
+		else:
+			pandas.testing.assert_series_equal(expected_left, left_trajectory.iloc[window])
+			pandas.testing.assert_series_equal(expected_right, right_trajectory.iloc[window])
+
+
+def test_get_pair_categories(trajectory_table):
+	calculator = distance_calculator.DistanceCalculator(0.03, 0.97, 'binomial')
+	calculator.run(trajectory_table)
+	result = calculator.get_pair_categories()
+	expected = [
+		distance_calculator.get_pair_category(trajectory_table.loc[left], trajectory_table.loc[right], 0.03, 0.97)
+		for left, right in itertools.combinations(trajectory_table.index, 2)
+	]
+	assert list(result) == expected
+
+
+@pytest.mark.parametrize("total_rows, total_blocks", [(2, 1), (10, 3), (100, 16), (5, 50)])
+def test_get_row_blocks(total_rows, total_blocks):
+	blocks = distance_parallel.get_row_blocks(total_rows, total_blocks)
+	# The blocks should be contiguous and cover every row which has pairs.
+	assert blocks[0][0] == 0
+	assert blocks[-1][1] == total_rows - 1
+	for (_, previous_stop), (start, _) in zip(blocks[:-1], blocks[1:]):
+		assert previous_stop == start
+
+
+@pytest.mark.parametrize("engine, metric", [('vectorized', 'binomial'), ('pairwise', 'binomial'), ('pairwise', 'pearson'), ('vectorized', 'pearson')])
+def test_threaded_engine_matches_serial_engine(trajectory_table, engine, metric):
+	expected = distance_calculator.DistanceCalculator(0.03, 0.97, metric, engine = 'pairwise').run(trajectory_table)
+	result = distance_calculator.DistanceCalculator(0.03, 0.97, metric, threads = 2, engine = engine).run(trajectory_table)
+
+	assert result.keys() == expected.keys()
+	for key, value in expected.items():
+		assert result[key] == pytest.approx(value)
+
+
+@pytest.mark.parametrize("engine, threads", [('vectorized', None), ('pairwise', None), ('vectorized', 2)])
+def test_out_of_core_matches_in_memory(tmp_path, trajectory_table, engine, threads):
+	expected = distance_calculator.DistanceCalculator(0.03, 0.97, 'binomial', engine = engine).run_condensed(trajectory_table)
+	filename = tmp_path / "distances.bin"
+	calculator = distance_calculator.DistanceCalculator(0.03, 0.97, 'binomial', threads = threads, engine = engine, filename_memmap = filename)
+	result = calculator.run_condensed(trajectory_table)
+
+	assert filename.exists()
+	assert result.is_memmap
+	assert result.labels == expected.labels
+	assert list(result.values) == pytest.approx(list(expected.values))
+	# The out-of-core file can be reloaded as-is.
+	reloaded = CondensedDistanceCache.read_binary(filename)
+	assert reloaded.parameters == {'metric': 'binomial', 'dlimit': 0.03, 'flimit': 0.97}
+	assert list(reloaded.values) == list(result.values)
+
+
+@pytest.mark.parametrize("engine, metric", [('vectorized', 'binomial'), ('pairwise', 'pearson')])
+def test_distance_store_reuses_distances(tmp_path, trajectory_table, engine, metric):
+	filename = tmp_path / "distances.sqlite"
+	expected = distance_calculator.DistanceCalculator(0.03, 0.97, metric, engine = engine).run_condensed(trajectory_table)
+
+	store = DistanceStore(filename)
+	result = distance_calculator.DistanceCalculator(0.03, 0.97, metric, engine = engine, distance_store = store).run_condensed(trajectory_table)
+	assert (store.hits, store.misses) == (0, 36)
+	assert list(result.values) == pytest.approx(list(expected.values))
+
+	# The trajectories are matched by their values, so the labels and order can change.
+	table = trajectory_table.iloc[::-1].iloc[:-2]
+	table.index = [f"renamed-{i}" for i in range(len(table))]
+	table.loc['new'] = [0.00, 0.10, 0.30, 0.50, 0.60, 0.80, 0.90]
+	expected = distance_calculator.DistanceCalculator(0.03, 0.97, metric, engine = engine).run_condensed(table)
+
+	store = DistanceStore(filename)
+	result = distance_calculator.DistanceCalculator(0.03, 0.97, metric, engine = engine, distance_store = store).run_condensed(table)
+	assert (store.hits, store.misses) == (21, 7)
+	assert list(result.values) == pytest.approx(list(expected.values))
+
+
+def test_distance_store_evicts_least_recently_used(tmp_path, trajectory_table):
+	filename = tmp_path / "distances.sqlite"
+	store = DistanceStore(filename, maximum_pairs = 40)
+	distance_calculator.DistanceCalculator(0.03, 0.97, 'binomial', distance_store = store).run_condensed(trajectory_table)
+	assert len(store) == 36
+
+	other = trajectory_table + 0.001
+	store = DistanceStore(filename, maximum_pairs = 40)
+	distance_calculator.DistanceCalculator(0.03, 0.97, 'binomial', distance_store = store).run_condensed(other.iloc[:4])
+	# Only the newest distances are kept.
+	assert len(store) <= 40
+	store = DistanceStore(filename, maximum_pairs = 40)
+	distance_calculator.DistanceCalculator(0.03, 0.97, 'binomial', distance_store = store).run_condensed(other.iloc[:4])
+	assert store.misses == 0
+
+
+@pytest.mark.parametrize("engine", ['vectorized', 'pairwise'])
+def test_incremental_distances_match_full_calculation(tmp_path, trajectory_table, engine):
+	expected = distance_calculator.DistanceCalculator(0.03, 0.97, 'binomial', engine = engine).run_condensed(trajectory_table)
+	# The first five trajectories include pairs which could not be calculated, and a smaller maximum distance.
+	previous = distance_calculator.DistanceCalculator(0.03, 0.97, 'binomial', engine = engine).run_condensed(trajectory_table.iloc[:5])
+	assert previous.get_missing().sum() == 2
+	assert distance_memmap.get_maximum(previous.values) < distance_memmap.get_maximum(expected.values)
+
+	filename = tmp_path / "distances.bin"
+	previous.save_binary(filename)
+	previous = CondensedDistanceCache.read_binary(filename)
+	assert previous.get_changed_labels(trajectory_table.index) == list(trajectory_table.index[5:])
+
+	result = distance_calculator.DistanceCalculator(0.03, 0.97, 'binomial', engine = engine).run_condensed(trajectory_table, previous = previous)
+	assert list(result.values) == pytest.approx(list(expected.values))
+	assert list(result.get_missing()) == list(expected.get_missing())
+
+
+def test_incremental_distances_detect_modified_trajectories(tmp_path, trajectory_table):
+	previous = distance_calculator.DistanceCalculator(0.03, 0.97, 'binomial').run_condensed(trajectory_table)
+	table = trajectory_table.copy()
+	table.loc['trajectory-3'] = [0.00, 0.00, 0.10, 0.30, 0.50, 0.70, 0.90]
+	expected = distance_calculator.DistanceCalculator(0.03, 0.97, 'binomial').run_condensed(table)
+
+	# The new distances are written to the same file as the previous distances.
+	filename = tmp_path / "distances.bin"
+	previous.save_binary(filename)
+	previous = CondensedDistanceCache.read_binary(filename)
+	calculator = distance_calculator.DistanceCalculator(0.03, 0.97, 'binomial', filename_memmap = filename)
+	result = calculator.run_condensed(table, previous = previous)
+	result.save_binary(filename)
+
+	assert list(result.values) == pytest.approx(list(expected.values))
+	assert list(CondensedDistanceCache.read_binary(filename).get_missing()) == list(expected.get_missing())
+
+
+def test_binomial_lower_bound_does_not_exceed_distance(trajectory_table):
+	random_table = pandas.DataFrame(numpy.random.default_rng(7).random((30, 7)).round(2))
+	for table in [trajectory_table, random_table]:
+		values = table.values
+		states = TrajectoryStates(values, 0.03, 0.97)
+		expected = distance_kernels.binomial_distance_matrix(values, 0.03, 0.97)
+		prefix = distance_kernels.get_prefix_sums(values)
+		result = distance_kernels.binomial_lower_bound_block(prefix, states, slice(None), slice(None))
+		result = numpy.array([result[i, j] for i, j in itertools.combinations(range(len(values)), 2)])
+
+		is_bounded = ~numpy.isnan(result)
+		assert is_bounded.any()
+		assert (result[is_bounded] <= expected[is_bounded] + 1E-9).all()
+
+
+@pytest.mark.parametrize("prune_cutoff", [None, 0.5, 2.0])
+def test_sparse_distances_only_skip_distant_pairs(trajectory_table, prune_cutoff):
+	expected = distance_calculator.DistanceCalculator(0.03, 0.97, 'binomial').run_condensed(trajectory_table)
+	result = distance_calculator.DistanceCalculator(0.03, 0.97, 'binomial', prune_cutoff = prune_cutoff).run_sparse(trajectory_table)
+
+	assert result.labels == expected.labels
+	assert result.prune_ratio == result.total_pruned / len(expected)
+	for left, right in itertools.combinations(trajectory_table.index, 2):
+		if result[left, right] != pytest.approx(expected[left, right]):
+			# Skipped pairs are always further apart than the cutoff.
+			assert result[left, right] == result.far
+			assert expected[left, right] > prune_cutoff
+	if prune_cutoff is None:
+		assert result.total_pruned == 0
+		assert list(result.triangle()) == pytest.approx(list(expected.values))
+
+
+def test_sparse_distances_only_save_known_pairs(tmp_path, trajectory_table):
+	result = distance_calculator.DistanceCalculator(0.03, 0.97, 'binomial', prune_cutoff = 0.5).run_sparse(trajectory_table)
+	filename = tmp_path / "distances.sparse.tsv"
+	result.save(filename)
+
+	lines = filename.read_text().splitlines()
+	assert len(lines) == len(result.values)
+	for line in lines:
+		left, right, value = line.split('\t')
+		assert float(value) == pytest.approx(result[left, right])
+
+
+@pytest.mark.parametrize("chunk_size", [3, 16, 1000])
+def test_get_order_statistic(chunk_size):
+	values = numpy.array([0, 0.5, 0.25, 0.5, 0.9, 0.1, 0.5, 0.75, 0, 0.9, 0.3, 0.45])
+	expected = numpy.sort(values[(values > 0) & (values < 0.9)])
+	result = [distance_memmap.get_order_statistic(values, rank, 0, 0.9, chunk_size) for rank in range(len(expected))]
+	assert result == list(expected)
+	with pytest.raises(ValueError):
+		distance_memmap.get_order_statistic(values, len(expected), 0, 0.9, chunk_size)
+
+
+def test_get_nan_mask():
+	values = numpy.array([0.1, numpy.nan] * 10)
+	expected = numpy.packbits(numpy.isnan(values))
+	for chunk_size in [3, 8, 100]:
+		assert list(distance_memmap.get_nan_mask(values, chunk_size)) == list(expected)
+
+
+def test_replace_nan():
+	values = numpy.array([0.1, numpy.nan, 0.3, numpy.nan, 0.2])
+	assert distance_memmap.get_maximum(values, 2) == 0.3
+	assert distance_memmap.replace_nan(values, 0.3, 2) == 2
+	assert list(values) == [0.1, 0.3, 0.3, 0.3, 0.2]
+
+
+def test_tdigest_quantiles():
+	values = numpy.random.default_rng(0).beta(0.5, 3, 200000)
+	digest = distance_quantile.TDigest()
+	for chunk in distance_memmap.iterate_chunks(len(values), 30000):
+		digest.update(values[chunk])
+	assert len(digest) == len(values)
+	assert len(digest.means) <= digest.compression
+	for quantile in [0.01, 0.05, 0.5, 0.95]:
+		assert digest.quantile(quantile) == pytest.approx(numpy.quantile(values, quantile), rel = 0.01)
+	assert digest.quantile(0) == values.min()
+	assert digest.quantile(1) == values.max()
+
+
+def test_weighted_filtered_quantiles():
+	points = numpy.random.default_rng(0).random((12, 2)).round(1)
+	weights = numpy.array([1, 3, 1, 2, 1, 1, 4, 1, 1, 2, 1, 1])
+	quantiles = [0.01, 0.05, 0.3, 0.9]
+	expected = distance_quantile.get_filtered_quantiles(scipy_distance.pdist(numpy.repeat(points, weights, axis = 0)), quantiles)
+	result = distance_quantile.get_filtered_quantiles(scipy_distance.pdist(points), quantiles, weights = weights, chunk_size = 7)
+	assert list(result) == pytest.approx(list(expected))
@@ -1,3 +1,5 @@
+import pytest
+
 from muller.commandline_parser import *
 from muller.commandline_parser import _parse_frequency_option
 
@@ -79,3 +81,20 @@ def test_parse_lf_options():
 
 if __name__ == "__main__":
 	pass
+
+
+def test_parse_lineage_sweep_options():
+	commandline_parser = create_parser()
+	arguments = [
+		"lineage",
+		"--input", "test_table",
+		"--output", "output_files",
+		"--lineage-sweep-weights", "1,1,2,2;1,2,1,2",
+		"--lineage-sweep-pvalues", "0.01,0.05"
+	]
+	args = commandline_parser.parse_args(arguments)
+	assert args.lineage_sweep_weights == [(1, 1, 2, 2), (1, 2, 1, 2)]
+	assert args.lineage_sweep_pvalues == [0.01, 0.05]
+
+	with pytest.raises(SystemExit):
+		commandline_parser.parse_args(arguments[:4] + ["--lineage-sweep-weights", "1,1,2"])
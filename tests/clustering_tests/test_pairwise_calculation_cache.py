@@ -1,7 +1,8 @@
+import numpy
 import pandas
 import pytest
 
-from muller.clustering.metrics import DistanceCache
+from muller.clustering.metrics import CondensedDistanceCache, DistanceCache, is_binary_distance_file
 
 
 @pytest.fixture
@@ -104,3 +105,100 @@ def test_update(small_cache):
 
 	assert small_cache.get('14', '1') == 2
 	assert small_cache.get('1', '14') == 2
+
+
+@pytest.fixture
+def small_condensed_cache():
+	return CondensedDistanceCache("1 2 3 4".split(), [.5, .6, .7, .2, .3, .8])
+
+
+def test_condensed_cache_get(small_condensed_cache):
+	assert small_condensed_cache.get('1', '3') == .6
+	assert small_condensed_cache.get('3', '1') == .6
+	assert small_condensed_cache['4', '2'] == .3
+	assert small_condensed_cache.get('1', '1') is None
+	assert small_condensed_cache.get('1', '15', 0) == 0
+	with pytest.raises(KeyError):
+		small_condensed_cache['1', '15']
+
+
+def test_condensed_cache_matches_dict_cache(small_cache, small_condensed_cache):
+	assert small_condensed_cache.asdict() == small_cache.asdict()
+	assert list(small_condensed_cache.unique()) == list(small_cache.unique())
+	assert small_condensed_cache.labels == small_cache.labels
+	pandas.testing.assert_frame_equal(small_cache.squareform(), small_condensed_cache.squareform())
+	assert list(small_condensed_cache.triangle()) == list(small_cache.triangle())
+	assert sorted(small_condensed_cache.values) == sorted(set(small_cache.values))
+
+
+def test_condensed_cache_reduce(small_condensed_cache):
+	small_condensed_cache.reduce(['4', '2', '1'])
+	assert small_condensed_cache.labels == ['1', '2', '4']
+	assert list(small_condensed_cache.values) == [.5, .7, .3]
+	assert small_condensed_cache.get('2', '4') == .3
+
+
+def test_condensed_cache_reduce_keeps_hashes_and_missing_pairs():
+	missing = numpy.packbits([False, True, False, False, False, True])
+	cache = CondensedDistanceCache("1 2 3 4".split(), [.5, .8, .7, .2, .3, .8], hashes = [10, 20, 30, 40], missing = missing)
+	assert cache.get_changed_labels(['1', '2', '5'], [10, 21, 50]) == ['5', '2']
+
+	cache.reduce(['4', '3', '1'])
+	assert list(cache.hashes) == [10, 30, 40]
+	assert list(cache.get_missing()) == [True, False, True]
+
+
+def test_condensed_cache_update(small_condensed_cache):
+	new_elements = {
+		('15', '16'): 1,
+		('14', '1'):  2,
+		('2', '3'):   0
+	}
+
+	small_condensed_cache.update(new_elements)
+
+	assert small_condensed_cache.labels == "1 2 3 4 15 16 14".split()
+	assert small_condensed_cache.get('14', '1') == 2
+	assert small_condensed_cache.get('1', '14') == 2
+	assert small_condensed_cache.get('16', '15') == 1
+	assert small_condensed_cache.get('2', '3') == 0
+	# The existing values should not change.
+	assert small_condensed_cache.get('3', '4') == .8
+
+
+def test_condensed_cache_save_and_read(tmp_path, small_condensed_cache):
+	filename = tmp_path / "distances.tsv"
+	small_condensed_cache.save(filename)
+	result = CondensedDistanceCache.read(filename)
+	assert result.asdict() == small_condensed_cache.asdict()
+
+
+def test_condensed_cache_float32():
+	cache = CondensedDistanceCache("1 2 3".split(), [.5, .6, .7], dtype = numpy.float32)
+	assert cache.values.dtype == numpy.float32
+	assert cache.triangle().dtype == numpy.float64
+	assert cache.get('3', '2') == pytest.approx(.7)
+
+
+def test_condensed_cache_save_and_read_binary(tmp_path, small_condensed_cache):
+	filename = tmp_path / "distances.bin"
+	small_condensed_cache.parameters = {'metric': 'binomial', 'dlimit': 0.03, 'flimit': 0.97}
+	small_condensed_cache.save_binary(filename)
+
+	assert is_binary_distance_file(filename)
+	result = CondensedDistanceCache.read_binary(filename)
+	assert result.is_memmap
+	assert result.labels == small_condensed_cache.labels
+	assert list(result.values) == list(small_condensed_cache.values)
+	assert result.parameters == small_condensed_cache.parameters
+
+	# The default mode should not modify the file.
+	result.update({('1', '2'): 0})
+	assert result.get('1', '2') == 0
+	assert CondensedDistanceCache.read_binary(filename).get('1', '2') == .5
+
+
+def test_read_text_with_trailing_newline(tmp_path, small_cache):
+	filename = tmp_path / "distances.tsv"
+	small_cache.save(filename)
+	assert DistanceCache.read(filename).asdict() == small_cache.asdict()
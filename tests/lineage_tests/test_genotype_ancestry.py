@@ -0,0 +1,50 @@
+import pandas
+import pytest
+
+from muller.inheritance.genotype_ancestry import Ancestry
+
+
+@pytest.fixture
+def ancestry() -> Ancestry:
+	timepoints = pandas.DataFrame(
+		{
+			0: [0.0, 0.1, 0.0, 0.0],
+			1: [0.9, 0.5, 0.3, 0.1],
+			2: [1.0, 0.8, 0.5, 0.2]
+		},
+		index = ['genotype-A', 'genotype-B', 'genotype-C', 'genotype-D']
+	)
+	return Ancestry(timepoints.loc['genotype-A'], timepoints)
+
+
+def test_ancestry_table(ancestry):
+	ancestry.add_candidates('genotype-B', [('genotype-A', 5)])
+	ancestry.add_candidates('genotype-C', [('genotype-B', 4), ('genotype-A', 6)])
+	ancestry.add_candidates('genotype-D', [('genotype-C', 1), ('genotype-B', 10)])
+
+	expected = {
+		'genotype-A': 'genotype-0',
+		'genotype-B': 'genotype-A',
+		'genotype-C': 'genotype-B',  # Within 2 points of the maximum score, and added first.
+		'genotype-D': 'genotype-B'
+	}
+	assert ancestry.as_dict() == expected
+	assert ancestry.get_highest_priority('genotype-D') == ('genotype-B', 10)
+	assert ancestry.nests['genotype-C'] == ['genotype-B', 'genotype-A']
+
+
+def test_repeated_candidates_are_selected_in_order(ancestry):
+	# The first time `genotype-0` is added to `genotype-A` it isn't within the score window, so `genotype-B` is the newest ancestor.
+	ancestry.add_candidates('genotype-A', [('genotype-B', 100), ('genotype-0', 100)])
+	assert ancestry.get_parent('genotype-A') == 'genotype-B'
+	assert ancestry.confidence['genotype-A'] == [('genotype-0', 1), ('genotype-B', 100), ('genotype-0', 100)]
+
+
+def test_creates_cycle(ancestry):
+	ancestry.add_candidates('genotype-B', [('genotype-A', 5)])
+	ancestry.add_candidates('genotype-C', [('genotype-B', 5)])
+
+	assert ancestry.creates_cycle('genotype-A', 'genotype-C')
+	assert ancestry.creates_cycle('genotype-B', 'genotype-B')
+	assert not ancestry.creates_cycle('genotype-C', 'genotype-A')
+	assert not ancestry.creates_cycle('genotype-D', 'genotype-C')
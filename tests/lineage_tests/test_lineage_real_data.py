@@ -1,10 +1,13 @@
 import math
 
+import numpy
 import pandas
 import pytest
 
-from muller.inheritance import scoring
+from muller.dataio import projectpaths
+from muller.inheritance import genotype_intervals, lineage_bootstrap, lineage_parallel, lineage_sweep, score_matrix, scoring
 from muller.inheritance.genotype_lineage import LineageWorkflow
+from muller.inheritance.score_store import LineageScoreStore
 from .helpers import get_key_pairs, helper_test_score
 from ..filenames import real_tables
 
@@ -53,3 +56,183 @@ def test_lineage(nester):
 	actual_lineage = nester.run(table_genotype)
 
 	assert actual_lineage.clusters.as_dict() == expected_lineage.to_dict()
+
+
+def test_vectorized_scores_match_pairwise_scores():
+	filename = real_tables['nature12344']
+	table_genotype = pandas.read_excel(filename, sheet_name = 'genotype').set_index('Genotype')
+	assert score_matrix.is_supported(table_genotype)
+
+	expected = LineageWorkflow(0.03, 0.97, 0.05, engine = 'pairwise').run(table_genotype)
+	result = LineageWorkflow(0.03, 0.97, 0.05, engine = 'vectorized').run(table_genotype)
+
+	pandas.testing.assert_frame_equal(result.table_scores, expected.table_scores)
+	assert result.clusters.confidence == expected.clusters.confidence
+
+
+def test_score_matrix_pair_order():
+	table = pandas.DataFrame([[0, .1, .2]] * 4, index = ['A', 'B', 'C', 'D'])
+	scores = score_matrix.calculate_score_matrix(scoring.Score(0.03, 0.97, 0.05), table)
+	nested, unnested = scores.get_pairs()
+	assert [(scores.labels[i], scores.labels[j]) for i, j in zip(nested, unnested)] == [
+		('A', 'B'), ('B', 'C'), ('A', 'C'), ('C', 'D'), ('B', 'D'), ('A', 'D')
+	]
+
+
+def test_parallel_scores_match_single_process_scores():
+	filename = real_tables['nature12344']
+	table_genotype = pandas.read_excel(filename, sheet_name = 'genotype').set_index('Genotype')
+
+	expected = LineageWorkflow(0.03, 0.97, 0.05, engine = 'pairwise').run(table_genotype)
+	result = LineageWorkflow(0.03, 0.97, 0.05, engine = 'pairwise', threads = 2).run(table_genotype)
+
+	pandas.testing.assert_frame_equal(result.table_scores, expected.table_scores)
+	assert result.clusters.confidence == expected.clusters.confidence
+
+
+def test_parallel_vectorized_scores_match_single_process_scores():
+	filename = real_tables['nature12344']
+	table_genotype = pandas.read_excel(filename, sheet_name = 'genotype').set_index('Genotype')
+	scorer = scoring.Score(0.03, 0.97, 0.05)
+
+	expected = score_matrix.calculate_component_scores(scorer, table_genotype)
+	# Use small blocks so that each process scores several blocks.
+	result = lineage_parallel.calculate_component_scores_parallel(scorer, table_genotype, 2, block_elements = 500)
+	for key in expected.__dataclass_fields__:
+		numpy.testing.assert_array_equal(getattr(result, key), getattr(expected, key))
+
+	expected = LineageWorkflow(0.03, 0.97, 0.05, engine = 'vectorized').run(table_genotype)
+	result = LineageWorkflow(0.03, 0.97, 0.05, engine = 'vectorized', threads = 2).run(table_genotype)
+	pandas.testing.assert_frame_equal(result.table_scores, expected.table_scores)
+	assert result.clusters.confidence == expected.clusters.confidence
+
+
+@pytest.mark.parametrize("total", [2, 3, 10, 57])
+def test_get_unnested_groups(total):
+	groups = lineage_parallel.get_unnested_groups(total, 4)
+	# The groups should cover every unnested genotype exactly once, in order.
+	assert [i for start, stop in groups for i in range(start, stop)] == list(range(1, total))
+
+
+def test_lineage_sweep_matches_each_lineage():
+	filename = real_tables['nature12344']
+	table_genotype = pandas.read_excel(filename, sheet_name = 'genotype').set_index('Genotype')
+	weights = [(1, 1, 2, 2), (1, 2, 1, 2), (2, 1, 1, 1)]
+	pvalues = [0.01, 0.05]
+
+	result = lineage_sweep.run_lineage_sweep(table_genotype, 0.03, 0.97, weights, pvalues)
+
+	assert len(result.parents.columns) == 6
+	for setting_weights in weights:
+		for pvalue in pvalues:
+			expected = LineageWorkflow(0.03, 0.97, pvalue, setting_weights).run(table_genotype)
+			label = lineage_sweep.get_setting_label(setting_weights, pvalue)
+			assert result.parents[label].to_dict() == expected.clusters.as_dict()
+	assert list(result.summary.index) == list(result.parents.index)
+
+
+def test_lineage_sweep_is_saved(tmp_path):
+	table_genotype = pandas.read_excel(real_tables['nature12344'], sheet_name = 'genotype').set_index('Genotype')
+	result = LineageWorkflow(0.03, 0.97, 0.05).run(table_genotype)
+	result.lineage_sweep = lineage_sweep.run_lineage_sweep(table_genotype, 0.03, 0.97, [lineage_sweep.DEFAULT_WEIGHTS], [0.01, 0.05])
+
+	paths = projectpaths.OutputFilenames(tmp_path / "output", "test")
+	paths.save_workflow_lineage(result)
+	summary = pandas.read_csv(paths.filename_table_lineage_sweep, sep = '\t', index_col = 0)
+	parents = pandas.read_csv(paths.filename_table_lineage_sweep_parents, sep = '\t', index_col = 0)
+	assert list(summary.index) == list(result.lineage_sweep.summary.index)
+	assert list(parents.columns) == list(result.lineage_sweep.parents.columns)
+
+
+def test_component_scores_match_pairwise_scores():
+	filename = real_tables['nature12344']
+	table_genotype = pandas.read_excel(filename, sheet_name = 'genotype').set_index('Genotype')
+	components = score_matrix.calculate_component_scores(scoring.Score(0.03, 0.97, 0.05), table_genotype)
+	for pvalue in [0.01, 0.5]:
+		expected = LineageWorkflow(0.03, 0.97, pvalue, (1, 2, 1, 2), engine = 'pairwise').run(table_genotype)
+		result = components.score((1, 2, 1, 2), pvalue)
+		pandas.testing.assert_frame_equal(result.to_table(), expected.table_scores)
+
+
+def test_pruned_scores_match_unpruned_scores():
+	table = pandas.DataFrame(
+		[
+			[0, .2, .5, .9, 1, 1],
+			[0, .1, .3, 0, 0, 0],
+			[0, 0, 0, 0, .2, .4],
+			[0, 0, 0, .1, .3, .2],
+			[.1, .05, 0, 0, 0, 0]
+		],
+		index = ['genotype-1', 'genotype-2', 'genotype-3', 'genotype-4', 'genotype-5'],
+		columns = [0, 1, 2, 3, 4, 5]
+	)
+	intervals = genotype_intervals.GenotypeIntervals(table, 0.03)
+	assert intervals.count_pruned_pairs() > 0
+
+	expected = LineageWorkflow(0.03, 0.97, 0.05, engine = 'pairwise', prune = False).run(table)
+	result = LineageWorkflow(0.03, 0.97, 0.05, engine = 'pairwise', prune = True).run(table)
+
+	pandas.testing.assert_frame_equal(result.table_scores, expected.table_scores)
+	assert result.clusters.confidence == expected.clusters.confidence
+
+
+def test_genotype_intervals_candidates():
+	table = pandas.DataFrame(
+		[[.5, .5, 0, 0, 0], [0, 0, 0, .5, .5], [0, .5, .5, 0, 0], [0, 0, 0, 0, 0]],
+		index = ['A', 'B', 'C', 'D']
+	)
+	intervals = genotype_intervals.GenotypeIntervals(table, 0.03)
+	# `D` was never detected, but pairs detected within less than 3 timepoints are always candidates.
+	assert list(intervals.get_candidates('A')) == [True, False, True, True]
+	assert list(intervals.get_candidates('B')) == [False, True, False, True]
+
+
+@pytest.mark.parametrize("engine", ['pairwise', 'vectorized'])
+def test_lineage_score_store(tmp_path, engine):
+	filename = real_tables['nature12344']
+	table_genotype = pandas.read_excel(filename, sheet_name = 'genotype').set_index('Genotype')
+	total = len(table_genotype) * (len(table_genotype) - 1) // 2
+
+	store = LineageScoreStore(tmp_path / "scores.sqlite")
+	expected = LineageWorkflow(0.03, 0.97, 0.05, engine = 'pairwise').run(table_genotype)
+	result = LineageWorkflow(0.03, 0.97, 0.05, engine = engine, score_store = store).run(table_genotype)
+	assert (store.hits, store.misses) == (0, total)
+	pandas.testing.assert_frame_equal(result.table_scores, expected.table_scores)
+
+	# The genotypes are matched by their frequencies, so only the pairs with the modified genotype are scored again.
+	table = table_genotype.drop(table_genotype.index[2])
+	table.iloc[-1] = table.iloc[-1] * 0.9
+	expected = LineageWorkflow(0.03, 0.97, 0.05, engine = 'pairwise').run(table)
+
+	store = LineageScoreStore(tmp_path / "scores.sqlite")
+	result = LineageWorkflow(0.03, 0.97, 0.05, engine = engine, score_store = store).run(table)
+	assert store.misses == len(table) - 1
+	pandas.testing.assert_frame_equal(result.table_scores, expected.table_scores)
+	assert result.clusters.confidence == expected.clusters.confidence
+
+
+def test_lineage_bootstrap_support():
+	filename = real_tables['nature12344']
+	table_genotype = pandas.read_excel(filename, sheet_name = 'genotype').set_index('Genotype')
+	expected = LineageWorkflow(0.03, 0.97, 0.05).run(table_genotype)
+
+	# The replicates are essentially unchanged when the frequencies are resampled from a very large number of reads.
+	result = LineageWorkflow(0.03, 0.97, 0.05, bootstrap = 5, bootstrap_depth = 10 ** 9).run(table_genotype)
+	assert result.clusters.as_dict() == expected.clusters.as_dict()
+	assert result.series_support.to_dict() == {label: 1.0 for label in table_genotype.index}
+
+
+def test_lineage_bootstrap_does_not_depend_on_processes():
+	filename = real_tables['nature12344']
+	table_genotype = pandas.read_excel(filename, sheet_name = 'genotype').set_index('Genotype')
+	workflow = LineageWorkflow(0.03, 0.97, 0.05)
+	parents = workflow.run(table_genotype).clusters.as_ancestry_table()
+
+	expected = lineage_bootstrap.run_bootstrap(LineageWorkflow(0.03, 0.97, 0.05), table_genotype, parents, 12, depth = 20)
+	result = lineage_bootstrap.run_bootstrap(LineageWorkflow(0.03, 0.97, 0.05), table_genotype, parents, 12, depth = 20, processes = 2)
+
+	pandas.testing.assert_frame_equal(result.parents, expected.parents)
+	pandas.testing.assert_series_equal(result.support, expected.support)
+	assert list(result.parents.columns) == list(range(12))
+	assert ((result.support >= 0) & (result.support <= 1)).all()
+
@@ -0,0 +1,48 @@
+import numpy
+import pandas
+import pytest
+
+from muller.inheritance import areascore, piecewise_area, polygon
+
+
+@pytest.mark.parametrize(
+	"left, right",
+	[
+		([0, 0, 0, 0, 1, 1], [0, 0, 0, 0, .2, .3]),
+		([0, .3, .4, 0, 0, 0], [0, 0, 0, 0, .2, .3]),
+		([0, 1, 0, 1, 0], [0, 0, .5, 0, 0]),
+		([0.01, 0.279, 0.341, 0.568, 0.708, 0.913, 0.756, 0.455, 0.399, 0.13, 0.041], [0, 0, 0, 0, 0, 0.247, 0.388, 0.215, 0.399, 0.13, 0.028])
+	]
+)
+def test_piecewise_areas_match_polygons(left, right):
+	left_polygon = polygon.as_polygon(pandas.Series(left))
+	right_polygon = polygon.as_polygon(pandas.Series(right))
+	left_curve = piecewise_area.as_curve(left)
+	right_curve = piecewise_area.as_curve(right)
+
+	assert piecewise_area.area(left_curve) == pytest.approx(left_polygon.area)
+	assert piecewise_area.common_area(left_curve, right_curve) == pytest.approx(left_polygon.intersection(right_polygon).area)
+	assert piecewise_area.difference_area(left_curve, right_curve) == pytest.approx(left_polygon.difference(right_polygon).area)
+	assert piecewise_area.union_area(left_curve, right_curve) == pytest.approx(left_polygon.union(right_polygon).area)
+	assert piecewise_area.symmetric_difference_area(left_curve, right_curve) == pytest.approx(left_polygon.symmetric_difference(right_polygon).area)
+
+
+def test_positive_area_splits_crossing_segments():
+	# The first segment crosses 0 halfway, and the second segment is entirely below 0.
+	assert piecewise_area.positive_area([1, -1, -1]) == pytest.approx(0.25)
+	assert piecewise_area.positive_area([1, -1, -1], x = [0, 4, 10]) == pytest.approx(1)
+
+
+def test_piecewise_areas_of_each_row():
+	curves = numpy.random.default_rng(11).random((5, 8))
+	result = piecewise_area.common_area(curves, curves[0])
+	expected = [piecewise_area.common_area(curve, curves[0]) for curve in curves]
+	assert list(result) == pytest.approx(expected)
+	assert result[0] == pytest.approx(piecewise_area.area(curves[0]))
+
+
+def test_is_subset_curve():
+	left = piecewise_area.as_curve([0, 0, .1, .2, 1, 1])
+	right = piecewise_area.as_curve([0, 0, 0, 0, .2, .3])
+	assert areascore.is_subset_curve(left, right)
+	assert not areascore.is_subset_curve(right, left)
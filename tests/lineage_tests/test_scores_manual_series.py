@@ -98,3 +98,20 @@ def test_calculate_area_score(scorer, left, right, expected):
 	result = scorer.calculate_score_area(l, r)
 
 	assert result == expected
+
+
+def test_calculate_area_score_with_area_cache():
+	area_cache = scoring.AreaCache()
+	scorer = scoring.Score(0.03, 0.97, 0.05, weights = [1, 1, 1, 1], area_cache = area_cache)
+	nested = pandas.Series([0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9], name = 'genotype-1')
+	unnested = pandas.Series([0.0, 0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8], name = 'genotype-2')
+
+	assert scorer.calculate_score_area(nested, unnested) == 1
+	assert scorer.calculate_score_area(unnested, nested) == -1
+	assert (area_cache.hits, area_cache.misses) == (2, 2)
+
+	# A genotype which changed under the same label is calculated again.
+	changed = pandas.Series([0.1, 0.1, 0.3, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0], name = 'genotype-1')
+	assert scorer.calculate_score_area(changed, pandas.Series([0.0, 0.0, 0.0, 0.0, 0.0, 0.1, 0.1, 0.2, 0.0, 0.0], name = 'genotype-2')) == -1
+	assert (area_cache.hits, area_cache.misses) == (2, 4)
+	assert len(area_cache) == 2